@@ -0,0 +1,49 @@
+import hashlib
+import json
+import os
+import time
+
+
+def get_config_hash(*values) -> str:
+    """Hash the configuration values the outputs depend on."""
+    return hashlib.sha256(repr(values).encode('utf-8')).hexdigest()[:32]
+
+
+class BatchManifest:
+    """Records for every unit of work (e.g. a batch) its input fingerprint, the configuration hash, its output files
+    and its status in a JSON file. It is rewritten atomically after every change, so after a crash or a configuration
+    change only the units that are missing or stale have to be processed again."""
+
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.units = {}
+        if os.path.isfile(file_name):
+            with open(file_name) as manifest_file:
+                self.units = json.load(manifest_file)['units']
+
+    def is_done(self, unit_key: str, input_fingerprint, config_hash: str) -> bool:
+        """A unit is done if it was finished with the same input and configuration and its outputs still exist."""
+        unit = self.units.get(unit_key)
+        return unit is not None and unit['status'] == self.DONE and unit['config_hash'] == config_hash \
+            and unit['input'] == json.loads(json.dumps(input_fingerprint)) \
+            and all(os.path.exists(output) for output in unit['outputs'])
+
+    def mark(self, unit_key: str, status: str, input_fingerprint, config_hash: str, outputs: list = ()):
+        self.units[unit_key] = {
+            'status': status,
+            'input': input_fingerprint,
+            'config_hash': config_hash,
+            'outputs': list(outputs),
+            'updated': time.time()
+        }
+        self.save()
+
+    def save(self):
+        # Write to a temporary file first, so a crash never leaves a partial manifest.
+        temporary_file_name = self.file_name + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary_file_name, 'w') as manifest_file:
+            json.dump({'units': self.units}, manifest_file, indent=1)
+        os.replace(temporary_file_name, self.file_name)
@@ -1,63 +1,124 @@
+import logging
+import os
 import random
-import bisect
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from glob import glob
 from os import listdir
-from os.path import isfile, join
+from os.path import basename, dirname, isfile, join, splitext
 
+import numpy as np
 import pandas as pd
-import shapefile
-from shapely.geometry import Point, shape
 
 from configuration import config
+from data_preparation.BatchManifest import BatchManifest, get_config_hash
+from data_preparation.FeatureCache import get_file_fingerprint
+from data_preparation.GridIndexer import get_grid_name, get_grid_registry
+from data_preparation.Holidays import is_holiday
+from data_preparation.OutlierRules import evaluate_outlier_rules, get_outlier_rules
+from data_preparation.ReferenceDataStore import get_reference_data_store, get_shapefile_fingerprint
+from data_preparation.ShapeIndex import ShapeIndex
+from data_preparation.TravelTimeAggregator import PARTIAL_VERSION, build_travel_time_tables, \
+    get_duration_histograms, get_partials_directory, remove_stale_partials, write_partial
 from data_preparation.TripTransformer import TripTransformer
 
+logger = logging.getLogger(__name__)
+
+DC_TIME_ZONE = 'America/New_York'
+
+# Columns of the DC 2017 trip files that are used by the transformation.
+DC_TRIP_DTYPES = {
+    'StartDateTime': str,
+    'OriginLatitude': np.float32,
+    'OriginLongitude': np.float32,
+    'DestinationLatitude': np.float32,
+    'DestinationLongitude': np.float32,
+    'OriginCity': 'category',
+    'DestinationCity': 'category',
+    'Duration': np.float32
+}
+
 
 class DC2017TripTransformer(TripTransformer):
 
+    STAGE_VERSIONS = {
+        'time': 2,  # 2: Start times converted to the DC time zone.
+        'timeBins': 2,  # 2: timeBinWWDS separates weekdays, holiday column added.
+        'grid': 1,
+        'weather': 2,  # 2: Daily weather matched on the date in DC.
+        'districts': 1,
+        'distances': 1
+    }
+
     def __init__(self, taxi_trip_input_file_name: str, batch_id: int):
         self.taxi_trip_input_file_name = taxi_trip_input_file_name
         self.batch_id = batch_id
-        self.weather_hourly_df = pd.read_csv(
-            config.dc_wp_weather_output_file,
-            parse_dates=['reported_date_time', 'start_date_time'],
-            date_parser=lambda x: datetime.strptime(x, "%Y-%m-%d %H:%M:%S"))
-        cd_shapes = shapefile.Reader(config.di_cd_shapes_file)
-        self.cd_raw_shapes = cd_shapes.shapes()
-        self.cd_records = cd_shapes.records()
         super().__init__()
 
+    # The reference data is loaded on first use, so stages that are cached or not run never load it.
+    @property
+    def weather_hourly_df(self) -> pd.DataFrame:
+        return load_reference_data()[0]
+
+    @property
+    def weather_daily_df(self) -> pd.DataFrame:
+        return load_reference_data()[1]
+
+    @property
+    def cd_index(self) -> ShapeIndex:
+        return load_reference_data()[2]
+
     def import_trips_from_csv(self):
-        # Read in the original csv-file
-        self.data_frame = pd.read_csv(
-            self.taxi_trip_input_file_name,
-            # skiprows=self.batch_id * self.batch_size, # Iterate through a whole file
-            nrows=1000
-
-        )
-        # skiprows=self.get_random_sample_from_file(self.taxi_trip_input_file_name, self.batch_size),
-
-        self.data_frame['StartDateTime'] = pd.to_datetime(self.data_frame['StartDateTime'],
-                                                          format='%Y-%m-%d %H:%M:%S.%f %z')
-        self.data_frame = self.data_frame.sort_values(by=['StartDateTime'])
-        self.data_frame.update(self.data_frame[['OriginLatitude', 'OriginLongitude', 'DestinationLatitude',
-                                                "DestinationLongitude"]].fillna(0))
-        self.data_frame = self.data_frame.rename(columns={'OriginLatitude': 'pickup_latitude',
-                                                          'OriginLongitude': 'pickup_longitude',
-                                                          'DestinationLatitude': 'dropoff_latitude',
-                                                          'DestinationLongitude': 'dropoff_longitude'})
-
-
-        # I added this line
-        # print(self.datetime.strptime("%Y-%m-%d %H:%M:%S").strptime("%Y-%m-%d %H:%M:%S")
-        # print(self.data_frame.astype(str)
-        print(self.data_frame['StartDateTime'].head)
-        print(self.data_frame.dtypes)
-        print(self.data_frame.columns)
-        print(self.data_frame.head)
+        # Read a random sample of batch_size trips of the original csv-file. Every batch gets its own sample, which is
+        # reproducible if config.tt_random_seed is set.
+        random_seed = getattr(config, 'tt_random_seed', None)
+        seed = None if random_seed is None else str(random_seed) + '-' + str(self.batch_id)
+        self.data_frame = read_trips_from_csv(
+            self.get_random_sample_from_file(self.taxi_trip_input_file_name, self.batch_size, seed))
+        self.input_fingerprint = None if seed is None else (
+            get_file_fingerprint(self.taxi_trip_input_file_name), 'sample', self.batch_size, seed)
+        self.prepare_imported_trips()
+
+    def import_trips_in_chunks(self, chunk_size: int):
+        for chunk_id, chunk in enumerate(read_trips_from_csv(self.taxi_trip_input_file_name, chunksize=chunk_size)):
+            self.data_frame = chunk
+            self.input_fingerprint = (get_file_fingerprint(self.taxi_trip_input_file_name), 'chunk', chunk_size,
+                                      chunk_id)
+            self.prepare_imported_trips()
+            yield
+
+    def prepare_imported_trips(self):
+        """Parse the start time, fill missing coordinates and durations, rename the coordinate columns and sort the
+        trips."""
+        self.data_frame['StartDateTime'] = parse_start_date_times(self.data_frame['StartDateTime'])
+        coordinate_columns = ['OriginLatitude', 'OriginLongitude', 'DestinationLatitude', 'DestinationLongitude']
+        self.data_frame[coordinate_columns] = self.data_frame[coordinate_columns].fillna(0)
+        self.data_frame['Duration'] = self.data_frame['Duration'].fillna(0).astype(np.int32)
+        self.data_frame.rename(columns={'OriginLatitude': 'pickup_latitude',
+                                        'OriginLongitude': 'pickup_longitude',
+                                        'DestinationLatitude': 'dropoff_latitude',
+                                        'DestinationLongitude': 'dropoff_longitude'}, inplace=True)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Imported trips with dtypes:\n%s\n%s', self.data_frame.dtypes, self.data_frame.head())
 
         # Sort data_frame
         self.data_frame.sort_values(by=['StartDateTime'], inplace=True)
 
+    def get_stage_config_values(self, stage_name: str) -> tuple:
+        if stage_name == 'timeBins':
+            return tuple(config.tt_time_bins),
+        if stage_name == 'weather':
+            return get_file_fingerprint(config.dc_wp_weather_output_file), get_daily_weather_fingerprint()
+        if stage_name == 'districts':
+            return get_shapefile_fingerprint(config.di_cd_shapes_file),
+        if stage_name == 'grid':
+            # The grids cover the configured area. The memo of the registry is lossy if it quantizes coordinates.
+            return config.dc_grid_bl_lat, config.dc_grid_bl_lon, config.dc_grid_tr_lat, config.dc_grid_tr_lon, \
+                get_grid_registry().quantization_decimals
+        return ()
+
     def add_basic_time_features(self):
         self.data_frame['year'] = self.data_frame['StartDateTime'].dt.year
         self.data_frame['month'] = self.data_frame['StartDateTime'].dt.month
@@ -67,145 +128,279 @@ class DC2017TripTransformer(TripTransformer):
         self.data_frame['minute'] = self.data_frame['StartDateTime'].dt.minute
 
     def add_time_bin_features(self):
+        minute_of_day = self.get_minute_of_day(self.data_frame['hour'].to_numpy(), self.data_frame['minute'].to_numpy())
+        weekday = self.data_frame['weekday'].to_numpy()
         for time_bin_size in config.tt_time_bins:
             # Without weekday separation.
-            self.data_frame['timeBin' + str(time_bin_size)] = self.data_frame.apply(
-                lambda x: self.get_time_bin(x['hour'], x['minute'], time_bin_size), axis=1)
+            self.data_frame['timeBin' + str(time_bin_size)] = self.get_time_bins(minute_of_day, time_bin_size)
             # With weekday separation.
-            self.data_frame['timeBinWWDS' + str(time_bin_size)] = self.data_frame.apply(
-                lambda x: self.get_time_bin(x['hour'], x['minute'], time_bin_size), axis=1)
+            self.data_frame['timeBinWWDS' + str(time_bin_size)] = self.get_time_bins_with_wds(
+                minute_of_day, weekday, time_bin_size)
+        self.data_frame['holiday'] = is_holiday(self.data_frame['StartDateTime'].dt.tz_localize(None).to_numpy())
 
     def add_grid_indices(self):
-        for grid_cell_height in config.dc_grid_cell_heights:
-            self.create_index_for_grid('square', grid_cell_height)
-            self.create_index_for_grid('triangle', grid_cell_height)
-            self.create_index_for_grid('hexagon', grid_cell_height)
+        grids = [(grid_type, grid_cell_height) for grid_cell_height in config.dc_grid_cell_heights
+                 for grid_type in ['square', 'triangle', 'hexagon']]
+        values = self.get_stage_config_values('grid')
+        # Every grid is cached on its own, so only new grids are computed after the cell heights have changed.
+        missing_grids = [grid for grid in grids if not self.load_cached_features('grid', *grid, *values)]
+        if missing_grids:
+            self.create_indices_for_grids(missing_grids)
+            for grid_type, grid_cell_height in missing_grids:
+                grid_name = get_grid_name(grid_type, grid_cell_height)
+                self.store_cached_features([location + grid_name + index_dimension for location in ['PU', 'DO']
+                                            for index_dimension in ['X', 'Y']], 'grid', grid_type, grid_cell_height,
+                                           *values)
 
     def add_weather_features(self):
-        weather_df_for_trips = self.data_frame.apply(
-            lambda x: (
-                self.weather_hourly_df.iloc[
-                   self.get_weather_hourly_df_if_for_time(x['StartDateTime'].to_datetime64())].to_dict()
-            ), axis=1)
-        weather_df_for_trips = pd.json_normalize(weather_df_for_trips)
-        weather_df_for_trips.drop(['reported_date_time', 'start_date_time'], inplace=True, axis=1)
-        weather_df_for_trips = weather_df_for_trips.add_prefix('weather_hourly_')
-        weather_df_for_trips.rename(columns={weather_df_for_trips.columns[0]: 'weather_hourly_id'}, inplace=True)
-        self.data_frame = pd.concat([self.data_frame, weather_df_for_trips.reindex(self.data_frame.index)], axis=1)
+        start_date_times = self.data_frame['StartDateTime']
+        utc_times = local_times = start_date_times.to_numpy(dtype='datetime64[ns]')
+        if start_date_times.dt.tz is not None:
+            # Hourly records are compared in UTC, daily records are calendar days in DC like the holidays.
+            utc_times = start_date_times.dt.tz_convert(None).to_numpy(dtype='datetime64[ns]')
+            local_times = start_date_times.dt.tz_localize(None).to_numpy(dtype='datetime64[ns]')
+
+        weather_dfs_for_trips = []
+        for weather_df, period, prefix, times in [
+                (self.weather_hourly_df, np.timedelta64(1, 'h'), 'weather_hourly_', utc_times),
+                (self.weather_daily_df, np.timedelta64(1, 'D'), 'weather_daily_', local_times)]:
+            if weather_df is None:
+                continue
+            positions = self.get_weather_row_positions(weather_df['start_date_time'].to_numpy(), times, period)
+            weather_df_for_trips = self.join_weather(weather_df, positions, prefix)
+            weather_df_for_trips.index = self.data_frame.index
+            weather_dfs_for_trips.append(weather_df_for_trips)
+        self.data_frame = pd.concat([self.data_frame] + weather_dfs_for_trips, axis=1)
 
     def get_weather_hourly_df_if_for_time(self, time: datetime):
         """Returns the row id for the given time in the weather hourly df."""
-        weather_time_points = list(self.weather_hourly_df['start_date_time'])
-        if time > weather_time_points[-1] + pd.offsets.Hour(1) or time < weather_time_points[0]:
-            return None
-        else:
-            return bisect.bisect(weather_time_points, time) - 1
+        position = self.get_weather_row_positions(
+            self.weather_hourly_df['start_date_time'].to_numpy(), np.array([pd.Timestamp(time).to_datetime64()]),
+            np.timedelta64(1, 'h'))[0]
+        return None if position == -1 else int(position)
 
     def add_district_features(self):
-        self.data_frame['communityDistrictStart'] = self.data_frame.apply(
-            lambda x: self.get_community_district(
-                x['pickup_latitude'], x['pickup_longitude']
-            ), axis=1
-        )
-
-        self.data_frame['communityDistrictEnd'] = self.data_frame.apply(
-            lambda x: self.get_community_district(
-                x['dropoff_latitude'], x['dropoff_longitude']
-            ), axis=1
-        )
+        self.data_frame['communityDistrictStart'] = self.cd_index.get_shape_ids(
+            self.data_frame['pickup_latitude'].to_numpy(), self.data_frame['pickup_longitude'].to_numpy())
+        self.data_frame['communityDistrictEnd'] = self.cd_index.get_shape_ids(
+            self.data_frame['dropoff_latitude'].to_numpy(), self.data_frame['dropoff_longitude'].to_numpy())
 
     def get_community_district(self, latitude: float, longitude: float) -> int:
-        for curr_shape_id in range(len(self.cd_raw_shapes)):
-            if Point(longitude, latitude).within(shape(self.cd_raw_shapes[curr_shape_id])):
-                return curr_shape_id
-        return 999999999  # Not in any shape.
+        return self.cd_index.get_shape_id(latitude, longitude)  # 999999999 if not in any shape.
 
     def add_distance_features(self):
-        self.data_frame['haversineDistance'] = self.data_frame.apply(
-            lambda x: self.get_haversine_distance(
-                (x['pickup_latitude'], x['pickup_longitude']),
-                (x['dropoff_latitude'], x['dropoff_longitude'])
-            ), axis=1
-        )
-
-        self.data_frame['manhattanDistance'] = self.data_frame.apply(
-            lambda x: self.get_manhattan_distance(
-                (x['pickup_latitude'], x['pickup_longitude']),
-                (x['dropoff_latitude'], x['dropoff_longitude'])
-            ), axis=1
-
-        )
+        coordinates = [self.data_frame[column].to_numpy() for column in
+                       ['pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude']]
+        self.data_frame['haversineDistance'] = self.get_haversine_distances(*coordinates)
+        self.data_frame['manhattanDistance'] = self.get_manhattan_distances(*coordinates)
 
     def identify_outliers(self):
+        rules = get_outlier_rules(config.dc_grid_cell_heights)
+        for bitmask_column, bitmask in evaluate_outlier_rules(self.data_frame, rules).items():
+            self.data_frame[bitmask_column] = bitmask
 
-        # District-based
-        self.data_frame[config.tt_outlier_prefix + 'OriginCity'] = \
-            self.data_frame['OriginCity'].apply(lambda x: True if x == 999999999 else False)
-        self.data_frame[config.tt_outlier_prefix + 'DestinationCity'] = \
-            self.data_frame['DestinationCity'].apply(lambda x: True if x == 999999999 else False)
-
-        # Grid-based
-        for grid_cell_height in config.dc_grid_cell_heights:
-            for grid_type in ['S', 'T', 'H']:
-                for index_dimension in ['X', 'Y']:
-                    for location in ['PU', 'DO']:
-                        index_name = location + grid_type + 'GC' + str(grid_cell_height) + 'Index' + index_dimension
-                        self.data_frame[config.tt_outlier_prefix + index_name] = self.data_frame[index_name].apply(
-                            lambda x: True if x == 999999999 else False)
-
-        # Duration-based
-        self.data_frame[config.tt_outlier_prefix + 'unreasonable_high_duration'] = \
-            self.data_frame['Duration'].apply(
-                lambda x: True if x > 10902 else False)
-        self.data_frame[config.tt_outlier_prefix + 'zero_duration'] = self.data_frame['Duration'].apply(
-            lambda x: True if x == 0 else False)
-        self.data_frame[config.tt_outlier_prefix + 'very_low_duration'] = self.data_frame['Duration'].apply(
-            lambda x: True if x < 30 else False)
-        self.data_frame[config.tt_outlier_prefix + 'duration_is_much_higher_than_travelled_distance'] = \
-            self.data_frame.apply(lambda x:
-                                  True if (x['haversineDistance'] > 0 and x['haversineDistance'] / 11.4263 * 50 < x[
-                                      'Duration'])
-                                  else False, axis=1)
-        self.data_frame[config.tt_outlier_prefix + 'very_low_duration_despite_large_distance'] = \
-            self.data_frame.apply(lambda x:
-                                  True if (x['Duration'] > 0 and (
-                                              x['haversineDistance'] / 1000 / x['Duration'] / 60 * 60) > 112.654)
-                                  else False, axis=1)
-        self.data_frame[config.tt_outlier_prefix + 'very_low_duration_despite_large_haversine'] = \
-            self.data_frame.apply(lambda x:
-                                  True if (x['haversineDistance'] / 1000 / 11.4263 * 25 > x[
-                                      'Duration'] / 60 * 60) else False, axis=1)
-
-        # Distance-based
-        self.data_frame[config.tt_outlier_prefix + 'distance'] = self.data_frame['haversineDistance'].apply(
-            lambda x: True if x == 0 else False)
-
-        # Passenger-based
-        # self.data_frame[config.tt_outlier_prefix + 'passenger_count'] = self.data_frame['passenger_count'].apply(
-        #     lambda x: True if (x > 7 or x == 0) else False)
-
-    def export_to_csv(self):
-        file_name = 'DCExport' + str(self.batch_id) + '_' + str(self.batch_size) + '.csv'
-
-        # Separate inliers from outliers
+    def get_outlier_flags(self) -> np.ndarray:
+        """True for every trip that is identified as outlier by at least one rule."""
         outlier_columns = list(self.data_frame.filter(regex=config.tt_outlier_prefix, axis=1).columns)
-        outlier_df = self.data_frame[self.data_frame[outlier_columns].any(1)]
-        inlier_df = self.data_frame[~self.data_frame[outlier_columns].any(1)]
+        return (self.data_frame[outlier_columns].to_numpy() != 0).any(axis=1)
+
+    def aggregate_travel_times(self):
+        """Write the duration histograms of the inliers to the partials of the travel time tables (see
+        TravelTimeAggregator). Every batch and chunk gets its own file in the directory of the configuration, which is
+        overwritten if the batch is rerun."""
+        grid_names = [get_grid_name(grid_type, grid_cell_height)[:-len('Index')]
+                      for grid_cell_height in config.dc_grid_cell_heights
+                      for grid_type in ['square', 'triangle', 'hexagon']]
+        time_bin_columns = [prefix + str(time_bin_size) for time_bin_size in config.tt_time_bins
+                            for prefix in ['timeBin', 'timeBinWWDS']]
+        histograms = get_duration_histograms(self.data_frame[~self.get_outlier_flags()], grid_names, time_bin_columns)
+
+        if not self.chunk_id:
+            os.makedirs(dirname(self.get_partial_file_name(0)), exist_ok=True)
+            for file_name in glob(self.get_partial_file_name('*')):
+                os.remove(file_name)  # Partials of a previous run of this batch.
+        write_partial(histograms, self.get_partial_file_name(self.chunk_id or 0))
+
+    def get_partial_file_name(self, chunk_id) -> str:
+        """Get the file of the duration histograms of a chunk, or of the whole batch if it is not transformed in chunks
+        (chunk 0)."""
+        return join(get_partials_directory(getattr(config, 'tt_aggregation_directory', None),
+                                           get_transformation_config_hash()),
+                    splitext(self.get_export_file_name())[0] + '_' + str(chunk_id) + '.parquet')
+
+    def get_export_file_name(self) -> str:
+        """The file name contains the input file and the batch id, so batches never overwrite each other."""
+        input_file_name = splitext(basename(self.taxi_trip_input_file_name))[0]
+        return 'DCExport_' + input_file_name + '_' + str(self.batch_id) + '_' + str(self.batch_size) + '.csv'
+
+    def get_export_paths(self) -> list:
+        """Get the paths of the outlier and the inlier export. Parquet exports are directories."""
+        file_name = self.get_export_file_name()
+        paths = [config.tt_export_directory + config.tt_outlier_prefix + file_name,
+                 config.tt_export_directory + 'inlier_df' + file_name]
+        if getattr(config, 'tt_export_format', 'csv') == 'parquet':
+            return [splitext(path)[0] for path in paths]
+        return paths
+
+    def export_trips(self):
+        file_name = self.get_export_file_name()
 
-        # Export both datasets
-        outlier_df.to_csv(config.tt_export_directory + config.tt_outlier_prefix + file_name, sep=';')
-        inlier_df.to_csv(config.tt_export_directory + 'inlier_df' + file_name, sep=';')
+        # Separate inliers from outliers
+        is_outlier = self.get_outlier_flags()
+        outlier_df = self.data_frame[is_outlier]
+        inlier_df = self.data_frame[~is_outlier]
+
+        # Export both datasets. Chunks after the first one are appended.
+        if getattr(config, 'tt_export_format', 'csv') == 'parquet':
+            self.export_to_parquet(outlier_df, config.tt_export_directory + config.tt_outlier_prefix + file_name)
+            self.export_to_parquet(inlier_df, config.tt_export_directory + 'inlier_df' + file_name)
+            return
+        mode = 'a' if self.chunk_id else 'w'
+        outlier_df.to_csv(config.tt_export_directory + config.tt_outlier_prefix + file_name, sep=';', mode=mode,
+                          header=not self.chunk_id)
+        inlier_df.to_csv(config.tt_export_directory + 'inlier_df' + file_name, sep=';', mode=mode,
+                         header=not self.chunk_id)
+
+    def export_to_parquet(self, df: pd.DataFrame, file_name: str):
+        """Export the trips with compact dtypes to a parquet dataset partitioned by year and month. The dataset is a
+        directory named like the csv-file without extension. Every chunk adds new files to it."""
+        directory = splitext(file_name)[0]
+        if not self.chunk_id:
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+        df = self.get_compact_data_frame(df)
+        if df.empty:
+            # No partition would be written, so the first chunk writes a file with the schema only. It has no
+            # partition columns, since they have no values.
+            if not self.chunk_id:
+                df.drop(columns=['year', 'month']).to_parquet(join(directory, 'empty.parquet'))
+            return
+        df.to_parquet(directory, partition_cols=['year', 'month'])
+
+
+def read_trips_from_csv(file_name: str, engine: str = None, **kwargs):
+    """Read the DC 2017 trips with explicit dtypes. Only the columns used by the transformation are loaded. Missing
+    durations are read as float and converted afterwards. By default, the engine configured by config.dc_csv_engine
+    is only used for whole-file reads, since the pyarrow engine supports neither chunksize nor nrows."""
+    engine = engine or ('c' if kwargs else getattr(config, 'dc_csv_engine', 'c'))
+    return pd.read_csv(file_name, usecols=list(DC_TRIP_DTYPES), dtype=DC_TRIP_DTYPES, engine=engine, **kwargs)
+
+
+def parse_start_date_times(start_date_times: pd.Series) -> pd.Series:
+    """Parse times like '2017-01-13 04:29:30.000 -0500' in one vectorized pass. Parsing the offset with %z is slow
+    and fails for files with both standard and daylight saving time offsets. Therefore, the local time and the few
+    distinct offsets are parsed separately and the result is converted to the DC time zone."""
+    local_date_times = pd.to_datetime(start_date_times.str.slice(0, -6), format='%Y-%m-%d %H:%M:%S.%f', cache=True)
+    offsets = start_date_times.str.slice(-5).astype('category')
+    offset_minutes = np.array([int(offset[0] + '1') * (int(offset[1:3]) * 60 + int(offset[3:5]))
+                               for offset in offsets.cat.categories] + [0])  # Missing offsets (code -1) are UTC.
+    utc_date_times = local_date_times - pd.to_timedelta(offset_minutes[offsets.cat.codes.to_numpy()], unit='m')
+    return utc_date_times.dt.tz_localize('UTC').dt.tz_convert(DC_TIME_ZONE)
+
+
+def load_reference_data():
+    """Get the read-only data shared by all transformers: the hourly and daily weather and the community district
+    index. They are converted once by the reference data store of the process and shared by all batches processed in
+    that process. Daily weather is only loaded if config.dc_wp_weather_daily_output_file is set."""
+    store = get_reference_data_store()
+    weather_hourly_df = store.get_weather(config.dc_wp_weather_output_file, ['reported_date_time', 'start_date_time'],
+                                          '%Y-%m-%d %H:%M:%S')
+    weather_daily_df = None
+    if getattr(config, 'dc_wp_weather_daily_output_file', None):
+        weather_daily_df = store.get_weather(config.dc_wp_weather_daily_output_file, ['start_date_time'])
+    return weather_hourly_df, weather_daily_df, store.get_shape_index(config.di_cd_shapes_file)
+
+
+def initialize_worker():
+    """Load the reference data, create the grids and verify their kernels before the first batch of a worker process
+    starts."""
+    load_reference_data()
+    for grid_cell_height in config.dc_grid_cell_heights:
+        for grid_type in ['square', 'triangle', 'hexagon']:
+            get_grid_registry().get_grid(grid_type, grid_cell_height)
+            get_grid_registry().get_kernel(grid_type, grid_cell_height)
+
+
+def get_daily_weather_fingerprint():
+    """Fingerprint of the daily weather file or None if daily weather is not configured."""
+    daily_weather_file_name = getattr(config, 'dc_wp_weather_daily_output_file', None)
+    return daily_weather_file_name and get_file_fingerprint(daily_weather_file_name)
+
+
+def get_transformation_config_hash() -> str:
+    """Hash of the configuration values and reference files that the exported batches depend on."""
+    return get_config_hash(
+        config.tt_batch_size, getattr(config, 'tt_random_seed', None), tuple(config.tt_time_bins),
+        tuple(config.dc_grid_cell_heights), config.dc_grid_bl_lat, config.dc_grid_bl_lon, config.dc_grid_tr_lat,
+        config.dc_grid_tr_lon, get_grid_registry().quantization_decimals, config.tt_outlier_prefix,
+        getattr(config, 'tt_export_format', 'csv'), get_file_fingerprint(config.dc_wp_weather_output_file),
+        get_daily_weather_fingerprint(), get_shapefile_fingerprint(config.di_cd_shapes_file), PARTIAL_VERSION)
+
+
+def transform_batch(taxi_trip_input_file_name: str, batch_id: int) -> list:
+    """Transform a single batch. Returns the paths of the exports and of the partial of the travel time tables."""
+    importer = DC2017TripTransformer(taxi_trip_input_file_name, batch_id)
+    importer.transform_trips()
+    if getattr(config, 'tt_aggregation_directory', None):
+        return importer.get_export_paths() + [importer.get_partial_file_name(0)]
+    return importer.get_export_paths()
 
 
 def main():
-    """Transform multiple batches of trips randomly selected from files of the specified directory."""
-    list_of_files = [f for f in listdir(config.tt_trip_directory) if isfile(join(config.tt_trip_directory, f))]
-    for i in range(config.tt_number_of_batches):
-        importer = DC2017TripTransformer(
-            config.tt_trip_directory + '\\' + random.choice(list_of_files),
-            i)
-        importer.transform_trips()
-
+    """Transform multiple batches of trips randomly selected from files of the specified directory. The batches are
+    distributed over config.tt_number_of_workers processes. The files are chosen with config.tt_random_seed, so the
+    same batches are created in every run.
+
+    If config.tt_manifest_file is set, every finished batch is recorded in that manifest. A rerun after a crash or a
+    configuration change only transforms the batches that are missing, failed or stale, i.e. whose input file,
+    configuration or exports have changed since."""
+    list_of_files = sorted(f for f in listdir(config.tt_trip_directory) if isfile(join(config.tt_trip_directory, f)))
+    random_generator = random.Random(getattr(config, 'tt_random_seed', None))
+    input_file_names = [join(config.tt_trip_directory, random_generator.choice(list_of_files))
+                        for _ in range(config.tt_number_of_batches)]
+    manifest_file_name = getattr(config, 'tt_manifest_file', None)
+    manifest = BatchManifest(manifest_file_name) if manifest_file_name else None
+    aggregation_directory = getattr(config, 'tt_aggregation_directory', None)
+    config_hash = get_transformation_config_hash()
+    pending_batches = [(batch_id, input_file_name) for batch_id, input_file_name in enumerate(input_file_names)
+                       if not manifest or not manifest.is_done(str(batch_id), get_file_fingerprint(input_file_name),
+                                                               config_hash)]
+    logger.info('%d of %d batches have to be transformed.', len(pending_batches), len(input_file_names))
+    if aggregation_directory:
+        # Partials of other configurations would be merged into wrong tables. The batches they belong to are rerun,
+        # since the partials are outputs in the manifest.
+        remove_stale_partials(aggregation_directory, config_hash)
+
+    with ProcessPoolExecutor(max_workers=getattr(config, 'tt_number_of_workers', None),
+                             initializer=initialize_worker) as executor:
+        futures = {executor.submit(transform_batch, input_file_name, batch_id): (batch_id, input_file_name)
+                   for batch_id, input_file_name in pending_batches}
+        failed_batch_ids = []
+        for future in as_completed(futures):
+            batch_id, input_file_name = futures[future]
+            try:
+                export_paths = future.result()
+            except Exception:
+                logger.exception('Batch %d of %s failed.', batch_id, input_file_name)
+                failed_batch_ids.append(batch_id)
+                export_paths, status = [], BatchManifest.FAILED
+            else:
+                logger.info('Exported %s', export_paths)
+                status = BatchManifest.DONE
+            if manifest:
+                manifest.mark(str(batch_id), status, get_file_fingerprint(input_file_name), config_hash, export_paths)
+    if failed_batch_ids:
+        raise RuntimeError('Batches ' + str(sorted(failed_batch_ids)) + ' failed.')
+    if aggregation_directory:
+        # Only the partials of the batches of this run are merged.
+        partial_file_names = [DC2017TripTransformer(input_file_name, batch_id).get_partial_file_name(0)
+                              for batch_id, input_file_name in enumerate(input_file_names)]
+        missing_file_names = [file_name for file_name in partial_file_names if not isfile(file_name)]
+        if missing_file_names:
+            logger.warning('The travel time tables do not contain %d batches without partial: %s',
+                           len(missing_file_names), missing_file_names)
+        build_travel_time_tables(aggregation_directory,
+                                 [file_name for file_name in partial_file_names if isfile(file_name)])
 
 if __name__ == '__main__':
     main()
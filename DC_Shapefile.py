@@ -1,8 +1,23 @@
+from functools import lru_cache
+from glob import glob
+from os.path import join
 
-import pandas as pd
-import shapefile
-from shapely.geometry import Point, shape
+from data_preparation.ReferenceDataStore import get_reference_data_store
+from data_preparation.ShapeIndex import ShapeIndex
 
-import geopandas as gpd
-gdf = gpd.read_file('C:/Users/elham/Desktop/travel-time-prediction-2/data/original/Neighborhood_Cluster-shp')
-print (gdf)
\ No newline at end of file
+NEIGHBORHOOD_CLUSTER_DIRECTORY = 'C:/Users/elham/Desktop/travel-time-prediction-2/data/original/Neighborhood_Cluster-shp'
+
+
+@lru_cache(maxsize=None)
+def get_neighborhood_cluster_index() -> ShapeIndex:
+    """Get the index of the neighborhood clusters. The shapefile is converted on first use, not when importing."""
+    shapefile_names = sorted(glob(join(NEIGHBORHOOD_CLUSTER_DIRECTORY, '*.shp')))
+    if not shapefile_names:
+        raise FileNotFoundError('No shapefile in ' + NEIGHBORHOOD_CLUSTER_DIRECTORY)
+    return get_reference_data_store().get_shape_index(shapefile_names[0])
+
+
+if __name__ == '__main__':
+    neighborhood_cluster_index = get_neighborhood_cluster_index()
+    print(len(neighborhood_cluster_index), 'neighborhood clusters')
+    print(neighborhood_cluster_index.records)
@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from data_preparation.TripTransformer import TripTransformer
+
+
+def compare_export_formats(df: pd.DataFrame) -> dict:
+    """Write and read the trips as semicolon-separated csv-file and as parquet dataset with compact dtypes. Returns
+    the size in bytes and the write and read time in seconds of both formats."""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        csv_file_name = os.path.join(directory, 'export.csv')
+        start = time.perf_counter()
+        df.to_csv(csv_file_name, sep=';')
+        write_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pd.read_csv(csv_file_name, sep=';', index_col=0)
+        results['csv'] = {'size': os.path.getsize(csv_file_name), 'write_time': write_time,
+                          'read_time': time.perf_counter() - start}
+
+        parquet_directory = os.path.join(directory, 'export')
+        start = time.perf_counter()
+        TripTransformer.get_compact_data_frame(df).to_parquet(parquet_directory, partition_cols=['year', 'month'])
+        write_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pd.read_parquet(parquet_directory)
+        size = sum(os.path.getsize(os.path.join(path, file_name))
+                   for path, _, file_names in os.walk(parquet_directory) for file_name in file_names)
+        results['parquet'] = {'size': size, 'write_time': write_time, 'read_time': time.perf_counter() - start}
+    return results
+
+
+def main():
+    """Compare the export formats for one exported batch, e.g. python ExportBenchmark.py inlier_dfDCExport.csv"""
+    df = pd.read_csv(sys.argv[1], sep=';', index_col=0)
+    for export_format, result in compare_export_formats(df).items():
+        print(f'{export_format}: {result["size"] / 1024 / 1024:.2f} MiB, written in {result["write_time"]:.2f} s, '
+              f'read in {result["read_time"]:.2f} s')
+
+
+if __name__ == '__main__':
+    main()
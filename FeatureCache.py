@@ -0,0 +1,69 @@
+import hashlib
+import os
+
+import pandas as pd
+
+
+def get_file_fingerprint(file_name: str) -> tuple:
+    """Identify the content of a file by its path, size and modification time without reading it."""
+    if not os.path.exists(file_name):
+        return (file_name,)
+    file_stat = os.stat(file_name)
+    return os.path.abspath(file_name), file_stat.st_size, file_stat.st_mtime_ns
+
+
+class FeatureCache:
+    """On-disk cache for the columns a transformation stage adds. Every entry is a parquet file whose name contains
+    a hash of the input and the configuration values the stage depends on, so a stage is only recomputed if one of
+    those changes. If the cache grows beyond max_size bytes, the least recently used entries are removed. Without
+    max_size, the cache is not limited."""
+
+    def __init__(self, directory: str, max_size: int = None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_file_name(self, stage_name: str, *values) -> str:
+        key = hashlib.sha256(repr(values).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.directory, stage_name + '_' + key + '.parquet')
+
+    def load(self, stage_name: str, *values):
+        """Get the cached columns of the stage or None if they are not cached."""
+        file_name = self.get_file_name(stage_name, *values)
+        try:
+            df = pd.read_parquet(file_name)
+            os.utime(file_name)  # The modification time marks the last usage.
+        except (FileNotFoundError, OSError):  # Also if another worker has evicted the entry meanwhile.
+            return None
+        return df
+
+    def store(self, df: pd.DataFrame, stage_name: str, *values):
+        # Every process writes its own temporary file, since workers sharing the cache may store the same entry.
+        file_name = self.get_file_name(stage_name, *values)
+        temporary_file_name = file_name + '.' + str(os.getpid()) + '.tmp'
+        df.to_parquet(temporary_file_name)
+        os.replace(temporary_file_name, file_name)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is not larger than max_size. Entries that other
+        processes remove meanwhile are skipped."""
+        if self.max_size is None:
+            return
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.parquet'):
+                try:
+                    entry_stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry.path))
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
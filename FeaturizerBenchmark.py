@@ -0,0 +1,83 @@
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from configuration import config
+from data_preparation.SyntheticData import write_district_shapefile, write_trip_file, write_weather_file
+
+
+def measure_latencies(directory: str, number_of_trips: int, batch_size: int, repeats: int, seed: int) -> tuple:
+    """Featurize the synthetic trips one by one and in batches of batch_size. Every repeat gets its own trips, so the
+    memo of the grid registry does not favor later runs. Returns the latencies of the single trips of all repeats and
+    the time per trip of the batches in seconds. The first trips warm up the featurizer and are not measured."""
+    config.dc_wp_weather_output_file = os.path.join(directory, 'weather.csv')
+    config.dc_wp_weather_daily_output_file = None
+    config.di_cd_shapes_file = os.path.join(directory, 'districts.shp')
+    config.tt_cache_directory = None
+    config.tt_reference_data_directory = None
+    from data_preparation.DC2017TripTransformer import DC2017TripTransformer  # Imported after the configuration.
+    from data_preparation.TripFeaturizer import TripFeaturizer
+
+    trip_file_name = os.path.join(directory, 'trips.csv')
+    write_trip_file(trip_file_name, number_of_trips * repeats, seed)
+    importer = DC2017TripTransformer(trip_file_name, 0)
+    next(importer.import_trips_in_chunks(number_of_trips * repeats))
+    trips = importer.data_frame
+    start_date_times = list(trips['StartDateTime'])
+    origins = list(zip(trips['pickup_latitude'], trips['pickup_longitude']))
+    destinations = list(zip(trips['dropoff_latitude'], trips['dropoff_longitude']))
+
+    featurizer = TripFeaturizer()
+    for trip in range(min(100, number_of_trips)):
+        featurizer.featurize_trip(start_date_times[trip], origins[trip], destinations[trip])
+    gc.freeze()  # Like a server after start-up, so the collector does not scan the reference data again and again.
+    latencies = np.empty((repeats, number_of_trips))
+    for repeat in range(repeats):
+        for trip in range(number_of_trips):
+            first_trip = repeat * number_of_trips
+            start = time.perf_counter()
+            featurizer.featurize_trip(start_date_times[first_trip + trip], origins[first_trip + trip],
+                                      destinations[first_trip + trip])
+            latencies[repeat, trip] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for first_trip in range(0, number_of_trips, batch_size):
+        featurizer.featurize_trips(start_date_times[first_trip:first_trip + batch_size],
+                                   origins[first_trip:first_trip + batch_size],
+                                   destinations[first_trip:first_trip + batch_size])
+    return latencies, (time.perf_counter() - start) / number_of_trips
+
+
+def main():
+    """Measure the latency of TripFeaturizer.featurize_trip on synthetic DC data, e.g. python FeaturizerBenchmark.py
+    --trips 10000. The percentiles are taken over the latencies of all repeats. The exit code is 1 if the 99th
+    percentile is above --max-p99 seconds."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trips', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-p99', type=float, default=0.001)
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_weather_file(os.path.join(directory, 'weather.csv'), arguments.seed)
+        write_district_shapefile(os.path.join(directory, 'districts.shp'))
+        latencies, batch_time_per_trip = measure_latencies(directory, arguments.trips, arguments.batch_size,
+                                                           arguments.repeats, arguments.seed)
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f'Single trips: p50 {p50 * 1e6:.0f} us, p99 {p99 * 1e6:.0f} us')
+    print(f'Batches of {arguments.batch_size}: {batch_time_per_trip * 1e6:.1f} us per trip')
+    if p99 > arguments.max_p99:
+        print(f'The p99 latency is above {arguments.max_p99 * 1e6:.0f} us')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_preparation.GridIndexer import GRID_CLASSES, NOT_IN_GRID
+from data_preparation.ShapeIndex import NOT_IN_SHAPE
+
+logger = logging.getLogger(__name__)
+
+# Trip columns of the transformed data frame and the property names of the Trip nodes.
+TRIP_PROPERTIES = {
+    'StartDateTime': 'startDateTime',
+    'Duration': 'duration',
+    'haversineDistance': 'haversineDistance',
+    'manhattanDistance': 'manhattanDistance',
+    'year': 'year',
+    'month': 'month',
+    'weekday': 'weekday',
+    'hour': 'hour',
+    'holiday': 'holiday',
+    'weather_hourly_id': 'weatherHourlyId',
+    'weather_daily_id': 'weatherDailyId'
+}
+
+# Label of the filter node that connects a coordinate with the index nodes of all grids of a type.
+GRID_FILTER_LABELS = {
+    'square': 'SquareGridFilter',
+    'triangle': 'TriangleGridFilter',
+    'hexagon': 'HexagonGridFilter'
+}
+
+
+def get_coordinate_values(coordinates: pd.Series) -> np.ndarray:
+    """Get the coordinates as float64 values, which hold float32 coordinates exactly. They are not rounded, since
+    rounded coordinates of different grid cells or districts would share a node (like GridIndexer, every distinct
+    coordinate is kept)."""
+    return coordinates.to_numpy(dtype=np.float64)
+
+
+def get_trip_ids(df: pd.DataFrame, source: str) -> list:
+    """Get the tripId of every trip. The index of a data frame is only unique within that data frame (DC batches are
+    indexed from 0), so it is prefixed with the source of the trips, e.g. the export file name of a batch, which
+    contains the input file, the batch id and the batch size."""
+    if not df.index.is_unique:
+        raise ValueError('The index of the trips of ' + source + ' is not unique.')
+    return [source + ':' + str(index) for index in df.index.tolist()]
+
+
+class GraphLoader:
+    """Writes the trips of a transformed data frame (see DC2017TripTransformer) into the graph that OutlierIdentifier
+    works on:
+
+    (:Trip)-[:IS_PICKED_UP_AT|IS_DROPPED_OFF_AT]->(:Coordinate)-[:BELONGS_TO]->(:CD)
+    (:Coordinate)-[:HAS]->(:SquareGridFilter)-[:BELONGS_TO]->(:SGC500IndexX), (:SGC500IndexY), ...
+
+    Coordinates outside of a grid or district get no BELONGS_TO relationship. All rows are sent as parameters of
+    UNWIND queries in batches of batch_size, which are distributed over number_of_sessions sessions of the driver.
+    The transactions are run with execute_write, so transient errors like deadlocks between sessions are retried."""
+
+    def __init__(self, driver, batch_size: int = 10000, number_of_sessions: int = 4, database: str = None):
+        self.driver = driver
+        self.batch_size = batch_size
+        self.number_of_sessions = number_of_sessions
+        self.database = database
+
+    @staticmethod
+    def _check_label(label):
+        """Labels can not be passed as parameters, so they are checked before being inserted into a query."""
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', label):
+            raise ValueError('Invalid node label: ' + str(label))
+        return label
+
+    @staticmethod
+    def get_grid_names(df: pd.DataFrame) -> dict:
+        """Get the names of the grids in the data frame per grid type, e.g. {'square': ['SGC500', 'SGC100']}."""
+        grid_names = {}
+        for grid_type in GRID_CLASSES:
+            prefix = 'PU' + grid_type[0].upper() + 'GC'
+            grid_names[grid_type] = [column[2:-len('IndexX')] for column in df.columns
+                                     if column.startswith(prefix) and column.endswith('IndexX')]
+        return {grid_type: names for grid_type, names in grid_names.items() if names}
+
+    def get_schema_queries(self, grid_names: dict) -> list:
+        """Constraints for every node that is merged and indexes for the properties the outlier rules filter on."""
+        queries = [
+            'CREATE CONSTRAINT trip_id IF NOT EXISTS FOR (n:Trip) REQUIRE n.tripId IS UNIQUE',
+            'CREATE CONSTRAINT coordinate_key IF NOT EXISTS FOR (n:Coordinate) REQUIRE (n.latitude, n.longitude) '
+            'IS UNIQUE',
+            'CREATE CONSTRAINT cd_id IF NOT EXISTS FOR (n:CD) REQUIRE n.id IS UNIQUE',
+            'CREATE INDEX trip_duration IF NOT EXISTS FOR (n:Trip) ON (n.duration)',
+            'CREATE INDEX trip_haversine_distance IF NOT EXISTS FOR (n:Trip) ON (n.haversineDistance)',
+            'CREATE INDEX trip_outlier IF NOT EXISTS FOR (n:Trip) ON (n.outlier)'
+        ]
+        for grid_type, names in grid_names.items():
+            filter_label = self._check_label(GRID_FILTER_LABELS[grid_type])
+            queries.append('CREATE CONSTRAINT ' + filter_label.lower() + '_key IF NOT EXISTS FOR (n:' + filter_label +
+                           ') REQUIRE (n.latitude, n.longitude) IS UNIQUE')
+            for name in names:
+                for dimension in ['X', 'Y']:
+                    label = self._check_label(name + 'Index' + dimension)
+                    queries.append('CREATE CONSTRAINT ' + label.lower() + '_index IF NOT EXISTS FOR (n:' + label +
+                                   ') REQUIRE n.index IS UNIQUE')
+        return queries
+
+    def create_schema(self, grid_names: dict):
+        with self.driver.session(database=self.database) as session:
+            for query in self.get_schema_queries(grid_names):
+                session.run(query)
+
+    def _run_in_batches(self, query: str, rows: list):
+        """Send the rows in batches of batch_size, distributed round-robin over the sessions. Rows of different
+        batches must not merge the same nodes, otherwise those nodes would have to exist before."""
+        batches = [rows[start:start + self.batch_size] for start in range(0, len(rows), self.batch_size)]
+
+        def run_batches(session_batches):
+            with self.driver.session(database=self.database) as session:
+                for batch in session_batches:
+                    session.execute_write(lambda tx, rows_of_batch: tx.run(query, {'rows': rows_of_batch}).consume(),
+                                          batch)
+
+        number_of_sessions = max(1, min(self.number_of_sessions, len(batches)))
+        with ThreadPoolExecutor(max_workers=number_of_sessions) as executor:
+            # list() raises the first exception of the sessions.
+            list(executor.map(run_batches, [batches[i::number_of_sessions] for i in range(number_of_sessions)]))
+
+    @staticmethod
+    def get_coordinates(df: pd.DataFrame) -> pd.DataFrame:
+        """Get the distinct coordinates of pickups and dropoffs with the columns of their grid cells and district.
+        """
+        columns = {}
+        for location, prefix in [('pickup', 'PU'), ('dropoff', 'DO')]:
+            location_columns = {'latitude': get_coordinate_values(df[location + '_latitude']),
+                                'longitude': get_coordinate_values(df[location + '_longitude'])}
+            district_column = 'communityDistrictStart' if location == 'pickup' else 'communityDistrictEnd'
+            if district_column in df.columns:
+                location_columns['communityDistrict'] = df[district_column].to_numpy()
+            for column in df.columns:
+                if column.startswith(prefix) and 'GC' in column and column[-1] in 'XY':
+                    location_columns[column[len(prefix):]] = df[column].to_numpy()
+            columns[location] = pd.DataFrame(location_columns)
+        return pd.concat(columns.values(), ignore_index=True).drop_duplicates(['latitude', 'longitude'])
+
+    def load_coordinates(self, coordinates: pd.DataFrame):
+        rows = [{'latitude': latitude, 'longitude': longitude} for latitude, longitude in
+                zip(coordinates['latitude'].tolist(), coordinates['longitude'].tolist())]
+        if 'communityDistrict' in coordinates.columns:
+            for row, district in zip(rows, coordinates['communityDistrict'].tolist()):
+                row['communityDistrict'] = None if district == NOT_IN_SHAPE else district
+            # Districts are shared by many coordinates, so they are created before the coordinates.
+            districts = coordinates['communityDistrict'].unique().tolist()
+            self._run_in_batches("""UNWIND $rows AS district
+                MERGE (:CD {id: district})""", [district for district in districts if district != NOT_IN_SHAPE])
+        self._run_in_batches("""UNWIND $rows AS row
+            MERGE (a:Coordinate {latitude: row.latitude, longitude: row.longitude})
+            WITH a, row
+            WHERE row.communityDistrict IS NOT NULL
+            MATCH (cd:CD {id: row.communityDistrict})
+            MERGE (a)-[:BELONGS_TO]->(cd)""", rows)
+
+    def load_grid_cells(self, coordinates: pd.DataFrame, grid_names: dict):
+        """Create the index nodes of all grid cells and connect every coordinate via its filter node to them."""
+        for grid_type, names in grid_names.items():
+            filter_label = self._check_label(GRID_FILTER_LABELS[grid_type])
+            rows = [{'latitude': latitude, 'longitude': longitude} for latitude, longitude in
+                    zip(coordinates['latitude'].tolist(), coordinates['longitude'].tolist())]
+            query = """UNWIND $rows AS row
+                MATCH (a:Coordinate {latitude: row.latitude, longitude: row.longitude})
+                MERGE (a)-[:HAS]->(gf:""" + filter_label + """ {latitude: row.latitude, longitude: row.longitude})"""
+            for name in names:
+                label = self._check_label(name + 'Index')
+                x_indices = coordinates[name + 'IndexX'].to_numpy()
+                y_indices = coordinates[name + 'IndexY'].to_numpy()
+                in_grid = (x_indices != NOT_IN_GRID) & (y_indices != NOT_IN_GRID)
+                for dimension, indices in [('X', x_indices), ('Y', y_indices)]:
+                    # Index nodes are shared by many coordinates, so they are created before the relationships.
+                    self._run_in_batches("""UNWIND $rows AS index
+                        MERGE (:""" + label + dimension + """ {index: index})""",
+                                         np.unique(indices[in_grid]).tolist())
+                for row, x_index, y_index, is_in_grid in zip(rows, x_indices.tolist(), y_indices.tolist(),
+                                                              in_grid.tolist()):
+                    row[name] = [x_index, y_index] if is_in_grid else None
+                query += """
+                FOREACH (cell IN CASE WHEN row.""" + name + """ IS NULL THEN [] ELSE [row.""" + name + """] END |
+                    MERGE (x:""" + label + """X {index: cell[0]})
+                    MERGE (y:""" + label + """Y {index: cell[1]})
+                    MERGE (gf)-[:BELONGS_TO]->(x)
+                    MERGE (gf)-[:BELONGS_TO]->(y))"""
+            self._run_in_batches(query, rows)
+
+    @staticmethod
+    def get_trip_rows(df: pd.DataFrame, source: str) -> list:
+        """Get a row per trip with its id (see get_trip_ids), its properties and its coordinates. All values are
+        converted to Python types, which the driver can send."""
+        properties = {}
+        for column in df.columns:
+            name = TRIP_PROPERTIES.get(column, column if column.startswith('timeBin') else None)
+            if name is None:
+                continue
+            if pd.api.types.is_datetime64_any_dtype(df[column]):
+                properties[name] = list(df[column].dt.to_pydatetime())
+            else:
+                properties[name] = df[column].tolist()
+        coordinates = {name: get_coordinate_values(df[column]).tolist() for name, column in
+                       [('pickupLatitude', 'pickup_latitude'), ('pickupLongitude', 'pickup_longitude'),
+                        ('dropoffLatitude', 'dropoff_latitude'), ('dropoffLongitude', 'dropoff_longitude')]}
+        trip_ids = get_trip_ids(df, source)
+        rows = []
+        for i, trip_id in enumerate(trip_ids):
+            row = {name: values[i] for name, values in coordinates.items()}
+            row['tripId'] = trip_id
+            row['properties'] = {name: values[i] for name, values in properties.items()}
+            rows.append(row)
+        return rows
+
+    def load_trips(self, df: pd.DataFrame, source: str):
+        self._run_in_batches("""UNWIND $rows AS row
+            MATCH (pu:Coordinate {latitude: row.pickupLatitude, longitude: row.pickupLongitude})
+            MATCH (do:Coordinate {latitude: row.dropoffLatitude, longitude: row.dropoffLongitude})
+            MERGE (trip:Trip {tripId: row.tripId})
+            SET trip += row.properties, trip.outlier = FALSE, trip.outlierMethod = [0]
+            MERGE (trip)-[:IS_PICKED_UP_AT]->(pu)
+            MERGE (trip)-[:IS_DROPPED_OFF_AT]->(do)""", self.get_trip_rows(df, source))
+
+    def load(self, df: pd.DataFrame, source: str) -> dict:
+        """Load the trips and everything they are connected to. source identifies the data frame among all loaded ones
+        (see get_trip_ids), so loading another batch adds its trips instead of overwriting trips with the same index.
+        Returns the number of trips and coordinates, the seconds per step and the trips per second."""
+        timings = {}
+        grid_names = self.get_grid_names(df)
+        coordinates = self.get_coordinates(df)
+        for step, load_step in [('schema', lambda: self.create_schema(grid_names)),
+                                ('coordinates', lambda: self.load_coordinates(coordinates)),
+                                ('grids', lambda: self.load_grid_cells(coordinates, grid_names)),
+                                ('trips', lambda: self.load_trips(df, source))]:
+            start = time.perf_counter()
+            load_step()
+            timings[step] = time.perf_counter() - start
+        seconds = sum(timings.values())
+        report = {'trips': len(df), 'coordinates': len(coordinates), 'timings': timings,
+                  'trips_per_second': len(df) / seconds if seconds > 0 else 0.0}
+        logger.info('Loaded %d trips with %d coordinates in %.2f s (%.0f trips/s).', report['trips'],
+                    report['coordinates'], seconds, report['trips_per_second'])
+        return report
@@ -0,0 +1,132 @@
+import threading
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from data_preparation.GraphLoader import GraphLoader
+from data_preparation.OutlierIdentifierTest import FakeTransaction
+
+
+class FakeSession:
+    """Stand-in for a neo4j session that runs every transaction function on the transaction of its driver."""
+
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def run(self, query, parameters=None):
+        with self.driver.lock:
+            return self.driver.tx.run(query, parameters)
+
+    def execute_write(self, transaction_function, *arguments):
+        with self.driver.lock:
+            return transaction_function(self.driver.tx, *arguments)
+
+
+class FakeDriver:
+    """Stand-in for a neo4j driver. All sessions share one transaction, which records the queries."""
+
+    def __init__(self):
+        self.tx = FakeTransaction()
+        self.lock = threading.Lock()
+        self.number_of_sessions = 0
+
+    def session(self, database=None):
+        self.number_of_sessions += 1
+        return FakeSession(self)
+
+
+def get_transformed_trips():
+    return pd.DataFrame({
+        'pickup_latitude': np.array([38.9, 38.9, 38.95], dtype=np.float32),
+        'pickup_longitude': np.array([-77.0, -77.0, -77.05], dtype=np.float32),
+        'dropoff_latitude': np.array([38.95, 40.0, 38.9], dtype=np.float32),
+        'dropoff_longitude': np.array([-77.05, -75.0, -77.0], dtype=np.float32),
+        'StartDateTime': pd.to_datetime(['2017-01-01 10:00', '2017-01-01 11:00', '2017-01-02 12:00']).tz_localize(
+            'America/New_York'),
+        'Duration': np.array([600, 0, 1200], dtype=np.int32),
+        'haversineDistance': np.array([6000, 150000, 6000], dtype=np.int32),
+        'timeBin10': np.array([60, 66, 72], dtype=np.int16),
+        'PUSGC500IndexX': [3, 3, 10], 'PUSGC500IndexY': [7, 7, 12],
+        'DOSGC500IndexX': [10, 999999999, 3], 'DOSGC500IndexY': [12, 999999999, 7],
+        'communityDistrictStart': [1, 1, 2],
+        'communityDistrictEnd': [2, 999999999, 1]
+    }, index=[100, 101, 102])
+
+
+def get_coordinate(latitude, longitude) -> tuple:
+    """The coordinate of the node of a float32 coordinate."""
+    return float(np.float32(latitude)), float(np.float32(longitude))
+
+
+class GraphLoaderTest(unittest.TestCase):
+
+    def test_schema_is_created_first(self):
+        driver = FakeDriver()
+        GraphLoader(driver).load(get_transformed_trips(), 'batch')
+        queries = [query for query, _ in driver.tx.queries]
+        number_of_schema_queries = sum(query.startswith('CREATE ') for query in queries)
+        self.assertTrue(all(query.startswith('CREATE ') for query in queries[:number_of_schema_queries]))
+        self.assertIn('CREATE CONSTRAINT sgc500indexx_index IF NOT EXISTS FOR (n:SGC500IndexX) REQUIRE n.index IS '
+                      'UNIQUE', queries)
+
+    def test_trips_are_sent_in_batches(self):
+        driver = FakeDriver()
+        report = GraphLoader(driver, batch_size=2, number_of_sessions=2).load(get_transformed_trips(), 'batch')
+        self.assertEqual(3, report['trips'])
+        self.assertEqual(3, report['coordinates'])
+        trip_batches = [parameters['rows'] for query, parameters in driver.tx.queries if 'MERGE (trip:Trip' in query]
+        self.assertEqual([2, 1], sorted((len(rows) for rows in trip_batches), reverse=True))
+        trips = {row['tripId']: row for rows in trip_batches for row in rows}
+        self.assertEqual(['batch:100', 'batch:101', 'batch:102'], sorted(trips))
+        self.assertEqual(600, trips['batch:100']['properties']['duration'])
+        self.assertEqual(60, trips['batch:100']['properties']['timeBin10'])
+        self.assertEqual(get_coordinate(38.9, -77.0)[0], trips['batch:100']['pickupLatitude'])
+        self.assertNotIn('999999999', ''.join(query for query, _ in driver.tx.queries))
+
+    def test_batches_with_the_same_index_get_their_own_trips(self):
+        driver = FakeDriver()
+        loader = GraphLoader(driver)
+        loader.load(get_transformed_trips(), 'DCExport_trips_0_1000')
+        loader.load(get_transformed_trips(), 'DCExport_trips_1_1000')
+        trip_ids = [row['tripId'] for query, parameters in driver.tx.queries if 'MERGE (trip:Trip' in query
+                    for row in parameters['rows']]
+        self.assertEqual(6, len(trip_ids))
+        self.assertEqual(6, len(set(trip_ids)))
+
+    def test_coordinates_outside_of_grid_and_districts_get_no_cells(self):
+        driver = FakeDriver()
+        GraphLoader(driver).load(get_transformed_trips(), 'batch')
+        rows = {(row['latitude'], row['longitude']): row for query, parameters in driver.tx.queries
+                if ':SquareGridFilter {' in query for row in parameters['rows']}
+        self.assertEqual([3, 7], rows[get_coordinate(38.9, -77.0)]['SGC500'])
+        self.assertIsNone(rows[get_coordinate(40.0, -75.0)]['SGC500'])
+        districts = {(row['latitude'], row['longitude']): row['communityDistrict'] for query, parameters
+                     in driver.tx.queries if 'MERGE (a:Coordinate' in query for row in parameters['rows']}
+        self.assertEqual(2, districts[get_coordinate(38.95, -77.05)])
+        self.assertIsNone(districts[get_coordinate(40.0, -75.0)])
+        cells = [index for query, parameters in driver.tx.queries if 'MERGE (:SGC500IndexX' in query
+                 for index in parameters['rows']]
+        self.assertEqual([3, 10], cells)
+
+    def test_close_coordinates_keep_their_cells(self):
+        df = get_transformed_trips()
+        df['pickup_latitude'] = np.array([38.9, 38.900004, 38.9], dtype=np.float32)  # About 0.4 m apart.
+        df['PUSGC500IndexY'] = [7, 8, 7]
+        coordinates = GraphLoader.get_coordinates(df)
+        pickups = coordinates[coordinates['longitude'] == get_coordinate(38.9, -77.0)[1]]
+        self.assertEqual([7, 8], sorted(pickups['SGC500IndexY'].tolist()))
+
+    def test_invalid_label_is_rejected(self):
+        with self.assertRaises(ValueError):
+            GraphLoader(FakeDriver()).get_schema_queries({'square': ['SGC500) DETACH DELETE (n']})
+
+
+if __name__ == '__main__':
+    unittest.main()
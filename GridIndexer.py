@@ -0,0 +1,388 @@
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from configuration import config
+from data_preparation.Projection import project, unproject
+from grid_creation.PseudoGridCreator import PseudoSquareGrid, PseudoTriangleGrid, PseudoHexagonGrid
+
+logger = logging.getLogger(__name__)
+
+NOT_IN_GRID = 999999999  # Index used by the pseudo grids for coordinates outside of the grid.
+
+GRID_CLASSES = {
+    'square': PseudoSquareGrid,
+    'triangle': PseudoTriangleGrid,
+    'hexagon': PseudoHexagonGrid
+}
+
+
+def create_grid(grid_type: str, grid_cell_height: int):
+    """Create the pseudo grid of the given type and cell height that covers the configured area."""
+    return GRID_CLASSES[grid_type](
+        grid_cell_height,
+        None,  # Volume is None, so the grid_cell_height is used to create the grid.
+        config.dc_grid_bl_lat, config.dc_grid_bl_lon,
+        config.dc_grid_tr_lat, config.dc_grid_tr_lon
+    )
+
+
+# Up to this many coordinates, e.g. pickup and dropoff of a single trip, sorting out duplicates costs more than it
+# saves.
+MAX_UNDEDUPLICATED_COORDINATES = 2
+
+
+def get_grid_name(grid_type: str, grid_cell_height: int) -> str:
+    """Get the name that is used as part of the column names, e.g. SGC500Index for a square grid with 500m cells."""
+    return grid_type[0].capitalize() + 'GC' + str(grid_cell_height) + 'Index'
+
+
+class GridKernel:
+    """Locates whole arrays of coordinates in a grid with a single projection call, assuming cells of
+    grid_cell_height meters in Web Mercator laid out from the bottom left corner of the configured area.
+
+    Coordinates within tolerance (in cells) of a cell or grid border are reported as uncertain, since rounding may
+    put them into a different cell than the grid itself. They have to be located by the grid. Kernels whose cells
+    consist of whole cells of a kernel with a smaller cell height set nests (see GridRegistry.get_nested_indices)."""
+
+    nests = False
+
+    def __init__(self, grid_cell_height: int, tolerance: float = 1e-6):
+        self.grid_cell_height = grid_cell_height
+        self.tolerance = tolerance
+        self.x_min, self.y_min = project(config.dc_grid_bl_lat, config.dc_grid_bl_lon)
+        self.x_max, self.y_max = project(config.dc_grid_tr_lat, config.dc_grid_tr_lon)
+        self.xy_min = np.array([[self.x_min], [self.y_min]])
+        self.xy_max = np.array([[self.x_max], [self.y_max]])
+
+    def get_indices(self, latitudes: np.ndarray, longitudes: np.ndarray) -> tuple:
+        """Returns the (n, 2) array of x and y indices and a boolean array that is True for uncertain coordinates."""
+        return self.locate(np.array(project(np.asarray(latitudes, dtype=np.float64),
+                                            np.asarray(longitudes, dtype=np.float64))))
+
+    def locate(self, xy: np.ndarray) -> tuple:
+        """Like get_indices for the (2, n) array of projected coordinates."""
+        raise NotImplementedError
+
+    def is_outside(self, xy: np.ndarray) -> np.ndarray:
+        return ((xy < self.xy_min) | (xy > self.xy_max)).any(axis=0)
+
+    def is_close_to_border(self, xy: np.ndarray) -> np.ndarray:
+        """True for coordinates close to the right or top border of the grid."""
+        return (np.abs(xy - self.xy_max) <= self.tolerance * self.grid_cell_height).any(axis=0)
+
+    def get_edge_coordinates(self, number_of_samples: int, random_generator: np.random.Generator) -> tuple:
+        """Get coordinates in the last cell height before the right and the top border of the grid, where the last
+        column and row may be narrower than a cell, and coordinates just inside these borders. Random samples rarely
+        hit them for small cells. Returns the (latitudes, longitudes) tuple."""
+        inside = 100 * self.tolerance * self.grid_cell_height  # Far enough from the border to be certain.
+        x = []
+        y = []
+        for minimum, maximum, other_minimum, other_maximum, edge, other in [
+                (self.x_min, self.x_max, self.y_min, self.y_max, x, y),
+                (self.y_min, self.y_max, self.x_min, self.x_max, y, x)]:
+            last_border = minimum + (np.ceil((maximum - minimum) / self.grid_cell_height) - 1) * self.grid_cell_height
+            edge.append(random_generator.uniform(last_border, maximum, number_of_samples))
+            edge.append(np.full(number_of_samples, maximum - inside))
+            other.append(random_generator.uniform(other_minimum, other_maximum, 2 * number_of_samples))
+        return unproject(np.concatenate(x), np.concatenate(y))
+
+
+class SquareGridKernel(GridKernel):
+    """Square cells whose x and y index count the cells from the bottom left corner."""
+
+    nests = True
+
+    def locate(self, xy: np.ndarray) -> tuple:
+        """Both dimensions are computed together in the (2, n) array, which keeps the number of numpy calls low for
+        the few coordinates of single trips."""
+        cells = (xy - self.xy_min) / self.grid_cell_height
+        indices = np.floor(cells).T.astype(np.int64, order='C')
+        indices[self.is_outside(xy)] = NOT_IN_GRID
+        uncertain = (np.abs(cells - np.rint(cells)) < self.tolerance).any(axis=0) | self.is_close_to_border(xy)
+        return indices, uncertain
+
+
+class TriangleGridKernel(GridKernel):
+    """Rows of triangles whose height is the cell height, alternately pointing up and down. The first upward triangle
+    of the bottom row has its left corner at the bottom left corner of the grid. With shifted_rows, every other row is
+    shifted by half a side, so the corners of neighboring rows meet like in a regular triangular tiling. Otherwise,
+    every row starts like the bottom row.
+
+    The y index is the row. The x index counts the triangles of a row, starting with 0 for the downward triangle left
+    of the first upward one, which is cut by the left border."""
+
+    def __init__(self, grid_cell_height: int, shifted_rows: bool = False, tolerance: float = 1e-6):
+        super().__init__(grid_cell_height, tolerance)
+        self.shifted_rows = shifted_rows
+        self.half_side = grid_cell_height / np.sqrt(3)
+
+    def locate(self, xy: np.ndarray) -> tuple:
+        u = (xy[0] - self.x_min) / self.half_side
+        rows = (xy[1] - self.y_min) / self.grid_cell_height
+        row_indices = np.floor(rows)
+        v = rows - row_indices
+        if self.shifted_rows:
+            u = u + row_indices % 2
+        # The sides of the triangles are the lines u - v = 2k and u + v = 2k within a row.
+        rising = (u - v) / 2
+        falling = (u + v) / 2
+        indices = np.stack((np.floor(rising) + np.floor(falling) + 1, row_indices), axis=1).astype(np.int64)
+        indices[self.is_outside(xy)] = NOT_IN_GRID
+        uncertain = (np.abs(rising - np.rint(rising)) < self.tolerance) \
+            | (np.abs(falling - np.rint(falling)) < self.tolerance) | (np.abs(rows - np.rint(rows)) < self.tolerance) \
+            | self.is_close_to_border(xy)
+        return indices, uncertain
+
+
+class HexagonGridKernel(GridKernel):
+    """Hexagons whose height is the cell height. The first hexagon touches the bottom and the left border of the grid.
+    Flat-topped hexagons form columns, of which every odd one is shifted up by half a cell. The x index is the column
+    and the y index the hexagon within the column. Otherwise, the hexagons are pointy-topped and form rows, of which
+    every odd one is shifted right by half a hexagon. The x index is the hexagon within the row and the y index the
+    row."""
+
+    def __init__(self, grid_cell_height: int, flat_top: bool = True, tolerance: float = 1e-6):
+        super().__init__(grid_cell_height, tolerance)
+        self.flat_top = flat_top
+        # Distance between the centers of neighboring lines (columns or rows) and within a line.
+        if flat_top:
+            circumradius = grid_cell_height / np.sqrt(3)
+            self.line_distance, self.center_distance = 1.5 * circumradius, grid_cell_height
+        else:
+            circumradius = grid_cell_height / 2
+            self.line_distance, self.center_distance = 1.5 * circumradius, np.sqrt(3) * circumradius
+        self.circumradius = circumradius
+
+    def locate(self, xy: np.ndarray) -> tuple:
+        # p runs across the lines, q along them, both relative to the center of the first hexagon.
+        p, q = xy if self.flat_top else xy[::-1]
+        p_min, q_min = (self.x_min, self.y_min) if self.flat_top else (self.y_min, self.x_min)
+        lines = (p - p_min - self.circumradius) / self.line_distance
+        along = (q - q_min - self.center_distance / 2) / self.center_distance
+        # Only the hexagons of the two neighboring lines can be the closest.
+        line_indices = []
+        center_indices = []
+        distances = []
+        close_to_center_border = []
+        for line_index in [np.floor(lines), np.floor(lines) + 1]:
+            shifted_along = along - 0.5 * (line_index % 2)
+            center_index = np.rint(shifted_along)
+            line_indices.append(line_index)
+            center_indices.append(center_index)
+            distances.append(np.hypot((lines - line_index) * self.line_distance,
+                                      (shifted_along - center_index) * self.center_distance))
+            close_to_center_border.append(np.abs(np.abs(shifted_along - center_index) - 0.5) < self.tolerance)
+        second = distances[1] < distances[0]
+        line_indices = np.where(second, line_indices[1], line_indices[0])
+        center_indices = np.where(second, center_indices[1], center_indices[0])
+        indices = np.stack((line_indices, center_indices) if self.flat_top else (center_indices, line_indices),
+                           axis=1).astype(np.int64)
+        indices[self.is_outside(xy)] = NOT_IN_GRID
+        uncertain = (np.abs(distances[0] - distances[1]) < self.tolerance * self.grid_cell_height) \
+            | np.where(second, close_to_center_border[1], close_to_center_border[0]) | self.is_close_to_border(xy)
+        return indices, uncertain
+
+
+# Kernels of every grid type with the layouts they are tried in. The first one that locates coordinates like the grid
+# is used (see GridRegistry.get_kernel).
+KERNELS = {
+    'square': [(SquareGridKernel, {})],
+    'triangle': [(TriangleGridKernel, {'shifted_rows': False}), (TriangleGridKernel, {'shifted_rows': True})],
+    'hexagon': [(HexagonGridKernel, {'flat_top': True}), (HexagonGridKernel, {'flat_top': False})]
+}
+
+
+class GridRegistry:
+    """Creates every grid only once and remembers the cells of recently located coordinates.
+
+    The memo maps quantized coordinates to their cells and holds up to memo_size of them (least recently used ones are
+    dropped, 0 disables it). If quantization_decimals is set, the memo is lossy: coordinates located point by point
+    are rounded to that many decimals, so nearby coordinates share a memo entry and get the cell of the rounded
+    coordinate, which differs from their own cell close to a cell border. Without memo, coordinates are never rounded.
+
+    Grids with a verified kernel (see get_kernel) are located in one vectorized pass and only use the memo for
+    coordinates close to cell borders. With nest_grids, square grids whose cells consist of whole cells of a finer
+    square grid are derived from the finer cells (see get_nested_indices)."""
+
+    def __init__(self, memo_size: int = 0, quantization_decimals: int = None, use_kernels: bool = True,
+                 nest_grids: bool = True):
+        self.grids = {}
+        self.kernels = {}
+        self.memo = OrderedDict()
+        self.memo_size = memo_size
+        self.quantization_decimals = quantization_decimals
+        self.use_kernels = use_kernels
+        self.nest_grids = nest_grids
+        self.hits = 0
+        self.misses = 0
+
+    def get_grid(self, grid_type: str, grid_cell_height: int):
+        key = (grid_type, grid_cell_height)
+        if key not in self.grids:
+            self.grids[key] = create_grid(grid_type, grid_cell_height)
+        return self.grids[key]
+
+    def get_kernel(self, grid_type: str, grid_cell_height: int, number_of_samples: int = 2000):
+        """Get the vectorized kernel of a grid or None if there is none. The layouts of KERNELS are tried in order. A
+        kernel is only used if it locates a sample of coordinates in and around the grid and in its last column and row
+        exactly like the grid itself. Nested grids are derived from the finest kernel (see get_nested_indices), so its
+        last column and row matter for all of them."""
+        key = (grid_type, grid_cell_height)
+        if key not in self.kernels:
+            self.kernels[key] = None
+            if self.use_kernels:
+                self.kernels[key] = next((kernel for kernel in (
+                    kernel_class(grid_cell_height, **arguments) for kernel_class, arguments in KERNELS[grid_type])
+                    if self.is_verified(kernel, grid_type, number_of_samples)), None)
+                if self.kernels[key] is None:
+                    logger.info('The %s grid with %dm cells is located point by point, no vectorized kernel matches.',
+                                grid_type, grid_cell_height)
+        return self.kernels[key]
+
+    def is_verified(self, kernel: GridKernel, grid_type: str, number_of_samples: int) -> bool:
+        """Check whether the kernel locates the coordinates of a sample that it is certain about like the grid."""
+        random_generator = np.random.default_rng(kernel.grid_cell_height)
+        latitude_margin = (config.dc_grid_tr_lat - config.dc_grid_bl_lat) * 0.05
+        longitude_margin = (config.dc_grid_tr_lon - config.dc_grid_bl_lon) * 0.05
+        latitudes = random_generator.uniform(config.dc_grid_bl_lat - latitude_margin,
+                                             config.dc_grid_tr_lat + latitude_margin, number_of_samples)
+        longitudes = random_generator.uniform(config.dc_grid_bl_lon - longitude_margin,
+                                              config.dc_grid_tr_lon + longitude_margin, number_of_samples)
+        edge_latitudes, edge_longitudes = kernel.get_edge_coordinates(number_of_samples // 4, random_generator)
+        latitudes = np.concatenate((latitudes, edge_latitudes))
+        longitudes = np.concatenate((longitudes, edge_longitudes))
+        indices, uncertain = kernel.get_indices(latitudes, longitudes)
+        grid = self.get_grid(grid_type, kernel.grid_cell_height)
+        return all(tuple(index) == tuple(grid.get_index(latitude, longitude)) for index, latitude, longitude
+                   in zip(indices[~uncertain].tolist(), latitudes[~uncertain].tolist(),
+                          longitudes[~uncertain].tolist()))
+
+    def get_indices(self, grid_type: str, grid_cell_height: int, latitudes: np.ndarray,
+                    longitudes: np.ndarray) -> np.ndarray:
+        """Locate every coordinate in the grid. Returns an array of shape (n, 2) holding x and y index. Grids with a
+        kernel are located in one vectorized pass, only coordinates close to a border are located by the grid."""
+        kernel = self.get_kernel(grid_type, grid_cell_height)
+        if kernel is None:
+            return self._get_exact_indices(grid_type, grid_cell_height, latitudes, longitudes)
+        indices, uncertain = kernel.get_indices(latitudes, longitudes)
+        if uncertain.any():
+            indices[uncertain] = self._get_exact_indices(grid_type, grid_cell_height, latitudes[uncertain],
+                                                         longitudes[uncertain])
+        return indices
+
+    def get_nested_indices(self, grid_type: str, grid_cell_heights: list, latitudes: np.ndarray,
+                           longitudes: np.ndarray) -> dict:
+        """Locate every coordinate in the grids of one type with the given cell heights. Returns a dict that maps the
+        cell height to an array of shape (n, 2) like get_indices.
+
+        The grids are located from the finest to the coarsest and the coordinates are projected only once for all
+        kernels. A grid with a nesting kernel (squares) whose cell height is a multiple of a finer one shares its origin
+        and cell borders, so its indices are the finer indices divided by the ratio of the cell heights. Coordinates
+        close to a border of the finer grid and grids without kernel are located exactly."""
+        indices = {}
+        base_indices = {}  # Kernel indices and uncertain flags of the grids that others are derived from.
+        xy = None
+        for grid_cell_height in sorted(set(grid_cell_heights)):
+            kernel = self.get_kernel(grid_type, grid_cell_height)
+            if kernel is None:
+                indices[grid_cell_height] = self._get_exact_indices(grid_type, grid_cell_height, latitudes,
+                                                                    longitudes)
+                continue
+            base_cell_height = next((base_cell_height for base_cell_height in base_indices
+                                     if grid_cell_height % base_cell_height == 0), None) \
+                if self.nest_grids and kernel.nests else None
+            if base_cell_height is None:
+                if xy is None:
+                    xy = np.array(project(latitudes, longitudes))
+                grid_indices, uncertain = kernel.locate(xy)
+                if kernel.nests:
+                    base_indices[grid_cell_height] = (grid_indices.copy(), uncertain)
+            else:
+                finer_indices, uncertain = base_indices[base_cell_height]
+                grid_indices = np.where(finer_indices == NOT_IN_GRID, NOT_IN_GRID,
+                                        finer_indices // (grid_cell_height // base_cell_height))
+            if uncertain.any():
+                grid_indices[uncertain] = self._get_exact_indices(grid_type, grid_cell_height, latitudes[uncertain],
+                                                                  longitudes[uncertain])
+            indices[grid_cell_height] = grid_indices
+        return indices
+
+    def _get_exact_indices(self, grid_type: str, grid_cell_height: int, latitudes: np.ndarray,
+                           longitudes: np.ndarray) -> np.ndarray:
+        """Locate the coordinates one by one with grid.get_index, which is not vectorized. Results are kept in the
+        memo under the quantized coordinates."""
+        grid = self.get_grid(grid_type, grid_cell_height)
+        if not self.memo_size:
+            return np.array([grid.get_index(latitude, longitude) for latitude, longitude
+                             in zip(latitudes.tolist(), longitudes.tolist())], dtype=np.int64).reshape(-1, 2)
+        if self.quantization_decimals is not None:
+            latitudes = np.round(latitudes, self.quantization_decimals)
+            longitudes = np.round(longitudes, self.quantization_decimals)
+        indices = []
+        for latitude, longitude in zip(latitudes.tolist(), longitudes.tolist()):
+            key = (grid_type, grid_cell_height, latitude, longitude)
+            index = self.memo.get(key)
+            if index is None:
+                self.misses += 1
+                index = grid.get_index(latitude, longitude)
+                self.memo[key] = index
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+            else:
+                self.hits += 1
+                self.memo.move_to_end(key)
+            indices.append(index)
+        return np.array(indices, dtype=np.int64).reshape(-1, 2)
+
+    def get_statistics(self) -> dict:
+        """Get the memo counters to tune memo_size and quantization_decimals."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self.memo)}
+
+
+@lru_cache(maxsize=None)
+def get_grid_registry() -> GridRegistry:
+    """Get the grid registry of this process."""
+    return GridRegistry(getattr(config, 'tt_grid_memo_size', 0),
+                        getattr(config, 'tt_grid_memo_quantization_decimals', None))
+
+
+class GridIndexer:
+    """Assigns grid indices to whole arrays of coordinates for several grids at once.
+
+    Trip coordinates repeat a lot, so every distinct coordinate is located only once per grid and the resulting
+    (x, y) index is scattered back to all coordinates sharing it. Square, triangle and hexagon grids are located in a
+    vectorized pass by their kernels. A grid that none of its kernels matches (see GridRegistry.get_kernel) is located
+    point by point, where only the deduplication and the memo of the registry save work."""
+
+    def __init__(self, grids: list, registry: GridRegistry = None):
+        """The grids are given as (grid_type, grid_cell_height) tuples."""
+        self.grids = grids
+        self.registry = registry or get_grid_registry()
+        self.grid_cell_heights = {}
+        for grid_type, grid_cell_height in grids:
+            self.grid_cell_heights.setdefault(grid_type, []).append(grid_cell_height)
+
+    def get_indices(self, latitudes: np.ndarray, longitudes: np.ndarray) -> dict:
+        """Get the x and y index arrays of every coordinate for all grids. The result maps (grid_type,
+        grid_cell_height) to a tuple (x_indices, y_indices)."""
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        if len(latitudes) <= MAX_UNDEDUPLICATED_COORDINATES:
+            unique_latitudes, unique_longitudes, inverse = latitudes, longitudes, slice(None)
+        else:
+            unique_coordinates, inverse = np.unique(latitudes + 1j * longitudes, return_inverse=True)
+            unique_latitudes = unique_coordinates.real
+            unique_longitudes = unique_coordinates.imag
+
+        indices = {}
+        for grid_type, grid_cell_heights in self.grid_cell_heights.items():
+            nested_indices = self.registry.get_nested_indices(grid_type, grid_cell_heights, unique_latitudes,
+                                                              unique_longitudes)
+            for grid_cell_height, unique_indices in nested_indices.items():
+                indices[(grid_type, grid_cell_height)] = tuple(unique_indices[inverse].T)
+        return {grid: indices[grid] for grid in self.grids}
@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+from functools import lru_cache
+
+import numpy as np
+
+
+def _get_nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    """Get the n-th weekday (0 = Monday) of a month. A negative n counts from the end of the month."""
+    if n > 0:
+        first_day = date(year, month, 1)
+        return first_day + timedelta(days=(weekday - first_day.weekday()) % 7 + (n - 1) * 7)
+    last_day = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last_day - timedelta(days=(last_day.weekday() - weekday) % 7 + (-n - 1) * 7)
+
+
+def _get_observed(holiday: date) -> date:
+    """Holidays on a Saturday are observed on Friday, holidays on a Sunday on Monday."""
+    if holiday.weekday() == 5:
+        return holiday - timedelta(days=1)
+    if holiday.weekday() == 6:
+        return holiday + timedelta(days=1)
+    return holiday
+
+
+@lru_cache(maxsize=None)
+def get_dc_holidays(year: int) -> tuple:
+    """Get the observed public holidays in Washington, DC: the federal holidays, DC Emancipation Day and Inauguration
+    Day. If New Year's Day is a Saturday, it is observed on December 31 of the previous year."""
+    holidays = [
+        _get_observed(date(year, 1, 1)),  # New Year's Day
+        _get_nth_weekday(year, 1, 0, 3),  # Birthday of Martin Luther King, Jr.
+        _get_nth_weekday(year, 2, 0, 3),  # Washington's Birthday
+        _get_observed(date(year, 4, 16)),  # DC Emancipation Day
+        _get_nth_weekday(year, 5, 0, -1),  # Memorial Day
+        _get_observed(date(year, 7, 4)),  # Independence Day
+        _get_nth_weekday(year, 9, 0, 1),  # Labor Day
+        _get_nth_weekday(year, 10, 0, 2),  # Columbus Day
+        _get_observed(date(year, 11, 11)),  # Veterans Day
+        _get_nth_weekday(year, 11, 3, 4),  # Thanksgiving Day
+        _get_observed(date(year, 12, 25)),  # Christmas Day
+    ]
+    if year >= 2021:
+        holidays.append(_get_observed(date(year, 6, 19)))  # Juneteenth
+    if year % 4 == 1:
+        inauguration_day = date(year, 1, 20)
+        holidays.append(inauguration_day + timedelta(days=1) if inauguration_day.weekday() == 6 else inauguration_day)
+    return tuple(sorted(holidays))
+
+
+def is_holiday(dates: np.ndarray) -> np.ndarray:
+    """Check for an array of datetime64 dates whether they are holidays in Washington, DC."""
+    dates = np.asarray(dates, dtype='datetime64[D]')
+    if len(dates) == 0:
+        return np.zeros(0, dtype=bool)
+    # The next year is included for New Year's Day observed on December 31.
+    years = range(dates.min().astype(object).year, dates.max().astype(object).year + 2)
+    holidays = np.array([holiday for year in years for holiday in get_dc_holidays(year)], dtype='datetime64[D]')
+    return np.isin(dates, holidays)
@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from data_preparation.DC2017TripTransformer import parse_start_date_times, read_trips_from_csv
+from data_preparation.StageProfiler import get_peak_rss
+from data_preparation.SyntheticData import write_trip_file
+
+
+def measure_ingest(file_name: str, variant: str) -> dict:
+    """Measure the load time, the memory of the resulting data frame and the peak resident memory in bytes. It is
+    called in a fresh process, so the peak memory is not influenced by other variants."""
+    start = time.perf_counter()
+    if variant == 'inferred':
+        df = pd.read_csv(file_name)
+        df['StartDateTime'] = pd.to_datetime(df['StartDateTime'], format='%Y-%m-%d %H:%M:%S.%f %z')
+    else:
+        df = read_trips_from_csv(file_name, engine=variant)
+        df['StartDateTime'] = parse_start_date_times(df['StartDateTime'])
+    load_time = time.perf_counter() - start
+    return {'load_time': load_time, 'memory': int(df.memory_usage(deep=True).sum()), 'rows': len(df),
+            'peak_memory': get_peak_rss()}  # None if it cannot be measured on this platform.
+
+
+def main():
+    """Compare the inferred csv import with the typed import, e.g. python IngestBenchmark.py 1000000"""
+    number_of_trips = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'trips.csv')
+        write_trip_file(file_name, number_of_trips)
+        results = {}
+        for variant in ['inferred', 'c', 'pyarrow']:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                results[variant] = executor.submit(measure_ingest, file_name, variant).result()
+    for variant, result in results.items():
+        per_million_rows = 1000000 / result['rows']
+        peak_memory = 'unknown' if result['peak_memory'] is None else f'{result["peak_memory"] / 1024 / 1024:.1f} MiB'
+        print(f'{variant}: {result["load_time"] * per_million_rows:.2f} s and '
+              f'{result["memory"] * per_million_rows / 1024 / 1024:.1f} MiB data frame per million rows, '
+              f'{peak_memory} peak resident memory')
+
+
+if __name__ == '__main__':
+    main()
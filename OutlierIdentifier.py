@@ -1,113 +1,120 @@
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
 
 
 class OutlierIdentifier:
+    """Identifies outliers among the Trip nodes of the graph. Every rule is a single query that matches the trips
+    (bound to `trip`) and either marks them on the server or returns their ids. Values are passed as query parameters,
+    so the query plans are cached."""
 
-    def _get_trips_with_unreasonable_high_duration(self, tx, duration:int, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Trip) 
-            WHERE a.duration > """ + str(duration) + """
-            RETURN id(a)""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
+    _MARK_AS_OUTLIERS = """
+        WITH DISTINCT trip
+        SET trip.outlier = TRUE,
+        trip.outlierMethod = trip.outlierMethod + $method_identifier
+        RETURN count(trip);"""
+
+    _RETURN_IDS = """
+        RETURN DISTINCT id(trip);"""
+
+    GRID_CELL_HEIGHTS = [1000, 500, 250, 150, 100, 50, 25, 15, 10, 5]
+
+    def __init__(self, batch_size: int = 10000):
+        self.batch_size = batch_size  # Number of trip ids sent with a single query when marking a list of ids.
+
+    def _run_rule(self, tx, query, parameters, mark_as_outliers, method_identifier):
+        """Mark the matched trips as outliers and return their number, or return their ids if they are not marked."""
         if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+            result = tx.run(query + self._MARK_AS_OUTLIERS, dict(parameters, method_identifier=method_identifier))
+            return result.single()[0]
+        result = tx.run(query + self._RETURN_IDS, parameters)
+        return [record[0] for record in result]
+
+    @staticmethod
+    def _check_label(label):
+        """Labels can not be passed as parameters, so they are checked before being inserted into a query."""
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', label):
+            raise ValueError('Invalid node label: ' + str(label))
+        return label
+
+    def _get_trips_with_unreasonable_high_duration(self, tx, duration:int, mark_as_outliers, method_identifier):
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE trip.duration > $duration""", {'duration': duration}, mark_as_outliers, method_identifier)
 
     def _get_trips_with_zero_duration(self, tx, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Trip) 
-                WHERE a.duration = 0
-                RETURN id(a)""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE trip.duration = 0""", {}, mark_as_outliers, method_identifier)
 
     def _get_trips_with_very_low_duration(self, tx, duration:int, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Trip) 
-                    WHERE a.duration < """ + str(duration) + """
-                    RETURN id(a)""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE trip.duration < $duration""", {'duration': duration}, mark_as_outliers, method_identifier)
 
     def _get_trips_where_duration_is_much_higher_than_travelled_distance(self, tx, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Trip)
-            WHERE a.haversineDistance > 0
-            AND (a.haversineDistance / 11.4263 * 50) < a.duration
-            RETURN id(a);""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE trip.haversineDistance > 0
+            AND (trip.haversineDistance / 11.4263 * 50) < trip.duration""", {}, mark_as_outliers, method_identifier)
 
     def _get_trips_with_very_low_duration_despite_large_distance(self, tx, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Trip)
-            WHERE a.duration > 0
-            AND ((a.haversineDistance / 1000) / (toFloat(a.duration) / (60*60))) > 112.654
-            RETURN id(a);""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE trip.duration > 0
+            AND ((trip.haversineDistance / 1000) / (toFloat(trip.duration) / (60*60))) > 112.654""", {},
+                              mark_as_outliers, method_identifier)
 
     def _get_trips_with_very_low_duration_despite_large_haversine(self, tx, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Trip)
-            WHERE ((a.haversineDistance / 1000) / (11.4263 * 25)) < (a.duration / (60*60))
-            RETURN id(a);""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE ((trip.haversineDistance / 1000) / (11.4263 * 25)) < (trip.duration / (60*60))""", {},
+                              mark_as_outliers, method_identifier)
 
     def _get_trip_ids_not_in_shape_collection(self, tx, cell_name, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Coordinate)<-[:IS_DROPPED_OFF_AT]-(b:Trip)
-            WHERE NOT (a)-[:BELONGS_TO]->(:""" + cell_name + """)
-            RETURN id(b) AS id
-            UNION ALL MATCH (c:Coordinate)<-[:IS_PICKED_UP_AT]-(d:Trip)
-            WHERE NOT (c)-[:BELONGS_TO]->(:""" + cell_name + """)
-            RETURN id(d) AS id;""")
-        trip_ids = set([])
-        [trip_ids.add(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+        return self._run_rule(tx, """MATCH (a:Coordinate)<-[:IS_DROPPED_OFF_AT|IS_PICKED_UP_AT]-(trip:Trip)
+            WHERE NOT (a)-[:BELONGS_TO]->(:""" + self._check_label(cell_name) + """)""", {},
+                              mark_as_outliers, method_identifier)
 
     def _get_trip_ids_not_in_grid(self, tx, cell_name, filter_node_name, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (endGF:""" + filter_node_name + """)<-[:HAS]-(a:Coordinate)<-[:IS_DROPPED_OFF_AT]-(b:Trip)
-            WHERE NOT (:""" + cell_name + """IndexX)<-[:BELONGS_TO]-(endGF)-[:BELONGS_TO]->(:""" + cell_name + """IndexY)
-            RETURN id(b) AS id
-            UNION ALL MATCH (endGF:""" + filter_node_name + """)<-[:HAS]-(a:Coordinate)<-[:IS_PICKED_UP_AT]-(b:Trip)
-            WHERE NOT (:""" + cell_name + """IndexX)<-[:BELONGS_TO]-(endGF)-[:BELONGS_TO]->(:""" + cell_name + """IndexY)
-            RETURN id(b) AS id;""")
-        trip_ids = set([])
-        [trip_ids.add(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
-
-    @staticmethod
-    def _mark_as_outliers(tx, trip_ids, method_identifier):
-        for trip_id in trip_ids:
-            tx.run("""MATCH (n:Trip) 
-                WHERE id(n) = """ + str(trip_id) + """ 
+        cell_name = self._check_label(cell_name)
+        return self._run_rule(tx, """MATCH (endGF:""" + self._check_label(filter_node_name) + """)<-[:HAS]-(a:Coordinate)
+            <-[:IS_DROPPED_OFF_AT|IS_PICKED_UP_AT]-(trip:Trip)
+            WHERE NOT (:""" + cell_name + """IndexX)<-[:BELONGS_TO]-(endGF)-[:BELONGS_TO]->(:""" + cell_name + """IndexY)""",
+                              {}, mark_as_outliers, method_identifier)
+
+    def _mark_as_outliers(self, tx, trip_ids, method_identifier):
+        """Mark the trips with the given ids as outliers. The ids are sent in batches of batch_size."""
+        trip_ids = list(trip_ids)
+        for start in range(0, len(trip_ids), self.batch_size):
+            tx.run("""UNWIND $trip_ids AS trip_id
+                MATCH (n:Trip)
+                WHERE id(n) = trip_id
                 SET n.outlier = TRUE,
-                n.outlierMethod = n.outlierMethod + toInteger(""" + str(method_identifier) + """);""")
-
-    @staticmethod
-    def _get_all_outlier_ids(tx):
-        result = tx.run("""MATCH (a:Trip)
-            WHERE a.outlier = TRUE
-            RETURN id(a);""")
-        outlier = []
-        [outlier.append(record[0]) for record in result]
-        return outlier
-
-    @staticmethod
-    def _get_outliers_from_method(tx, method_id):
-        result = tx.run("""MATCH (a:Trip)
-            WHERE a.outlier = TRUE
-            AND toInteger(""" + str(method_id) + """) IN a.outlierMethod
-            RETURN id(a);""")
-        outlier = []
-        [outlier.append(record[0]) for record in result]
-        return outlier
+                n.outlierMethod = n.outlierMethod + $method_identifier;""",
+                   {'trip_ids': trip_ids[start:start + self.batch_size], 'method_identifier': method_identifier})
+
+    def _apply_precomputed_outliers(self, tx, outlier_rows):
+        """Mark the trips with the method identifiers computed by the transformation (see
+        OutlierRules.get_graph_outlier_methods). The rows are sent in batches of batch_size."""
+        for start in range(0, len(outlier_rows), self.batch_size):
+            tx.run("""UNWIND $rows AS row
+                MATCH (trip:Trip {tripId: row.tripId})
+                SET trip.outlier = TRUE,
+                trip.outlierMethod = trip.outlierMethod + row.methods;""",
+                   {'rows': outlier_rows[start:start + self.batch_size]})
+
+    def _covers_all_trips(self, tx, trip_ids) -> bool:
+        """True if every Trip node of the graph has one of the given tripIds. The ids are sent in batches of
+        batch_size."""
+        trip_ids = list(set(trip_ids))
+        number_of_trips = tx.run("""MATCH (trip:Trip)
+            RETURN count(trip) AS number_of_trips;""").single()[0]
+        if len(trip_ids) < number_of_trips:
+            return False
+        number_of_covered_trips = 0
+        for start in range(0, len(trip_ids), self.batch_size):
+            number_of_covered_trips += tx.run("""UNWIND $trip_ids AS trip_id
+                MATCH (trip:Trip {tripId: trip_id})
+                RETURN count(trip) AS number_of_covered_trips;""",
+                                              {'trip_ids': trip_ids[start:start + self.batch_size]}).single()[0]
+        return number_of_covered_trips == number_of_trips
 
     @staticmethod
     def _reset_outliers(tx):
@@ -116,88 +123,106 @@ class OutlierIdentifier:
             SET n.outlier = FALSE, n.outlierMethod = [0];""")
 
     def _get_trips_with_haversine_distance_of_zero(self, tx, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (a:Trip)
-                WHERE a.haversineDistance = 0
-                RETURN id(a);""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE trip.haversineDistance = 0""", {}, mark_as_outliers, method_identifier)
 
     def _get_trips_with_unusual_passenger_count(self, tx, mark_as_outliers, method_identifier):
-        result = tx.run("""MATCH (n:Trip)
-            WHERE n.passengerCount = 0 OR n.passengerCount > 7 
-            RETURN id(n);""")
-        trip_ids = []
-        [trip_ids.append(record[0]) for record in result]
-        if mark_as_outliers:
-            self._mark_as_outliers(tx, trip_ids, method_identifier)
-
-    def identify_outliers(self, tx):
-        # TODO: List of ids should be returned directly by _get_trip_methods
+        return self._run_rule(tx, """MATCH (trip:Trip)
+            WHERE trip.passengerCount = 0 OR trip.passengerCount > 7""", {}, mark_as_outliers, method_identifier)
+
+    def _get_rules(self):
+        """Get all rules as (method_identifier, rule, arguments) in the order they are applied."""
+        rules = [
+            # District-based
+            (1, self._get_trip_ids_not_in_shape_collection, ('CD',)),
+            (2, self._get_trip_ids_not_in_shape_collection, ('NTA',)),
+            (3, self._get_trip_ids_not_in_shape_collection, ('TaxiZone',)),
+        ]
+
+        # Grid-based
+        for grid_shape, filter_node_name, first_method_identifier in [('S', 'SquareGridFilter', 4),
+                                                                       ('H', 'HexagonGridFilter', 14),
+                                                                       ('T', 'TriangleGridFilter', 24)]:
+            for i, grid_cell_height in enumerate(self.GRID_CELL_HEIGHTS):
+                rules.append((first_method_identifier + i, self._get_trip_ids_not_in_grid,
+                              (grid_shape + 'GC' + str(grid_cell_height), filter_node_name)))
+
+        rules += [
+            # Duration-based
+            (34, self._get_trips_with_unreasonable_high_duration, (10902,)),
+            (35, self._get_trips_with_zero_duration, ()),
+            (36, self._get_trips_with_very_low_duration, (30,)),
+            (37, self._get_trips_where_duration_is_much_higher_than_travelled_distance, ()),
+            (38, self._get_trips_with_very_low_duration_despite_large_distance, ()),
+            (39, self._get_trips_with_very_low_duration_despite_large_haversine, ()),
+
+            # Distance-based
+            (40, self._get_trips_with_haversine_distance_of_zero, ()),
+
+            # Passenger-based
+            (41, self._get_trips_with_unusual_passenger_count, ()),
+        ]
+        return rules
 
+    @staticmethod
+    def _get_outlier_report(tx):
+        """Count the outliers overall and per method with a single scan. Every outlier is counted once with the
+        additional method -1, which gives the overall number."""
+        result = tx.run("""MATCH (a:Trip)
+            WHERE a.outlier = TRUE
+            UNWIND [-1] + a.outlierMethod AS method
+            RETURN method, count(DISTINCT a);""")
+        return {record[0]: record[1] for record in result}
+
+    def identify_outliers(self, tx, precomputed_outliers: tuple = None) -> dict:
+        """Apply all rules and report the result. The report contains the overall number of outliers (total), the
+        number of outliers per method identifier (methods) and the seconds each rule took (timings).
+
+        precomputed_outliers is the result of OutlierRules.get_graph_outlier_methods: the covered method identifiers,
+        the ids of the trips they were computed for and the outlier methods per trip. The outliers are reset and the
+        covered methods are skipped for all trips of the graph. Therefore, they are only used if they were computed for
+        every trip of the graph. They are then written in one batched pass, whose time (including the check) is
+        reported as precomputed_timing. Otherwise, all methods are run in the graph."""
         # Reset outlier identification
         self._reset_outliers(tx)
 
-        # District-based
-        self._get_trip_ids_not_in_shape_collection(tx, 'CD', True, 1)
-        self._get_trip_ids_not_in_shape_collection(tx, 'NTA', True, 2)
-        self._get_trip_ids_not_in_shape_collection(tx, 'TaxiZone', True, 3)
-
-        # SquareGrid-based
-        self._get_trip_ids_not_in_grid(tx, 'SGC1000', 'SquareGridFilter', True, 4)
-        self._get_trip_ids_not_in_grid(tx, 'SGC500', 'SquareGridFilter', True, 5)
-        self._get_trip_ids_not_in_grid(tx, 'SGC250', 'SquareGridFilter', True, 6)
-        self._get_trip_ids_not_in_grid(tx, 'SGC150', 'SquareGridFilter', True, 7)
-        self._get_trip_ids_not_in_grid(tx, 'SGC100', 'SquareGridFilter', True, 8)
-        self._get_trip_ids_not_in_grid(tx, 'SGC50', 'SquareGridFilter', True, 9)
-        self._get_trip_ids_not_in_grid(tx, 'SGC25', 'SquareGridFilter', True, 10)
-        self._get_trip_ids_not_in_grid(tx, 'SGC15', 'SquareGridFilter', True, 11)
-        self._get_trip_ids_not_in_grid(tx, 'SGC10', 'SquareGridFilter', True, 12)
-        self._get_trip_ids_not_in_grid(tx, 'SGC5', 'SquareGridFilter', True, 13)
-
-        # HexagonGrid-based
-        self._get_trip_ids_not_in_grid(tx, 'HGC1000', 'HexagonGridFilter', True, 14)
-        self._get_trip_ids_not_in_grid(tx, 'HGC500', 'HexagonGridFilter', True, 15)
-        self._get_trip_ids_not_in_grid(tx, 'HGC250', 'HexagonGridFilter', True, 16)
-        self._get_trip_ids_not_in_grid(tx, 'HGC150', 'HexagonGridFilter', True, 17)
-        self._get_trip_ids_not_in_grid(tx, 'HGC100', 'HexagonGridFilter', True, 18)
-        self._get_trip_ids_not_in_grid(tx, 'HGC50', 'HexagonGridFilter', True, 19)
-        self._get_trip_ids_not_in_grid(tx, 'HGC25', 'HexagonGridFilter', True, 20)
-        self._get_trip_ids_not_in_grid(tx, 'HGC15', 'HexagonGridFilter', True, 21)
-        self._get_trip_ids_not_in_grid(tx, 'HGC10', 'HexagonGridFilter', True, 22)
-        self._get_trip_ids_not_in_grid(tx, 'HGC5', 'HexagonGridFilter', True, 23)
-
-        # TriangleGrid-based
-        self._get_trip_ids_not_in_grid(tx, 'TGC1000', 'TriangleGridFilter', True, 24)
-        self._get_trip_ids_not_in_grid(tx, 'TGC500', 'TriangleGridFilter', True, 25)
-        self._get_trip_ids_not_in_grid(tx, 'TGC250', 'TriangleGridFilter', True, 26)
-        self._get_trip_ids_not_in_grid(tx, 'TGC150', 'TriangleGridFilter', True, 27)
-        self._get_trip_ids_not_in_grid(tx, 'TGC100', 'TriangleGridFilter', True, 28)
-        self._get_trip_ids_not_in_grid(tx, 'TGC50', 'TriangleGridFilter', True, 29)
-        self._get_trip_ids_not_in_grid(tx, 'TGC25', 'TriangleGridFilter', True, 30)
-        self._get_trip_ids_not_in_grid(tx, 'TGC15', 'TriangleGridFilter', True, 31)
-        self._get_trip_ids_not_in_grid(tx, 'TGC10', 'TriangleGridFilter', True, 32)
-        self._get_trip_ids_not_in_grid(tx, 'TGC5', 'TriangleGridFilter', True, 33)
-
-        # Duration-based
-        self._get_trips_with_unreasonable_high_duration(tx, 10902, True, 34)
-        self._get_trips_with_zero_duration(tx, True, 35)
-        self._get_trips_with_very_low_duration(tx, 30, True, 36)
-        self._get_trips_where_duration_is_much_higher_than_travelled_distance(tx, True, 37)
-        self._get_trips_with_very_low_duration_despite_large_distance(tx, True, 38)
-        self._get_trips_with_very_low_duration_despite_large_haversine(tx, True, 39)
-
-        # Distance-based
-        self._get_trips_with_haversine_distance_of_zero(tx, True, 40)
-
-        # Passenger-based
-        self._get_trips_with_unusual_passenger_count(tx, True, 41)
+        precomputed_method_identifiers = set()
+        precomputed_timing = None
+        if precomputed_outliers is not None:
+            method_identifiers, trip_ids, outlier_rows = precomputed_outliers
+            start = time.perf_counter()
+            if self._covers_all_trips(tx, trip_ids):
+                self._apply_precomputed_outliers(tx, outlier_rows)
+                precomputed_timing = time.perf_counter() - start
+                precomputed_method_identifiers = set(method_identifiers)
+            else:
+                logger.warning('The precomputed outliers do not cover all trips of the graph. All outlier methods are '
+                               'run in the graph.')
+
+        timings = {}
+        rules = self._get_rules()
+        for method_identifier, rule, arguments in rules:
+            if method_identifier in precomputed_method_identifiers:
+                continue
+            start = time.perf_counter()
+            rule(tx, *arguments, True, method_identifier)
+            timings[method_identifier] = time.perf_counter() - start
 
         # Produce report
-        ids_of_all_outliers = self._get_all_outlier_ids(tx)
-        print(f'\nOUTLIER REPORT\n{len(ids_of_all_outliers)} outliers overall.')
-        for i in range(1, 42):
-            print(f'{len(self._get_outliers_from_method(tx, i))} by outlier method {i}')
-
-        return None
\ No newline at end of file
+        counts = self._get_outlier_report(tx)
+        report = {
+            'total': counts.get(-1, 0),
+            'methods': {method_identifier: counts.get(method_identifier, 0) for method_identifier, _, _ in rules},
+            'timings': timings,
+            'precomputed_timing': precomputed_timing
+        }
+        logger.info('%d outliers overall.', report['total'])
+        if precomputed_timing is not None:
+            logger.info('%d precomputed outlier methods applied in %.2f s', len(precomputed_method_identifiers),
+                        precomputed_timing)
+        for method_identifier, count in report['methods'].items():
+            if method_identifier in timings:
+                logger.info('%d by outlier method %d (%.2f s)', count, method_identifier, timings[method_identifier])
+            else:
+                logger.info('%d by outlier method %d (precomputed)', count, method_identifier)
+        return report
@@ -0,0 +1,137 @@
+import unittest
+
+import pandas as pd
+
+from data_preparation.OutlierIdentifier import OutlierIdentifier
+from data_preparation.OutlierRules import evaluate_outlier_rules, get_graph_outlier_methods, get_outlier_rules
+
+
+class FakeResult:
+    """Stand-in for a neo4j result that holds a list of records."""
+
+    def __init__(self, records):
+        self.records = records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def single(self):
+        return self.records[0] if self.records else None
+
+    def consume(self):
+        return None
+
+
+class FakeTransaction:
+    """Stand-in for a neo4j transaction that records every query and answers with canned records. Queries containing
+    one of the keys of responses are answered with its records."""
+
+    def __init__(self, records=None, responses=None):
+        self.queries = []
+        self.records = records if records is not None else [[0]]
+        self.responses = responses or {}
+
+    def run(self, query, parameters=None):
+        self.queries.append((query, parameters or {}))
+        for query_part, records in self.responses.items():
+            if query_part in query:
+                return FakeResult(records)
+        return FakeResult(self.records)
+
+
+class OutlierIdentifierTest(unittest.TestCase):
+
+    def test_rule_marks_outliers_with_a_single_parameterized_query(self):
+        tx = FakeTransaction([[3]])
+        marked = OutlierIdentifier()._get_trips_with_unreasonable_high_duration(tx, 10902, True, 34)
+        self.assertEqual(3, marked)
+        self.assertEqual(1, len(tx.queries))
+        query, parameters = tx.queries[0]
+        self.assertIn('SET trip.outlier = TRUE', query)
+        self.assertNotIn('10902', query)
+        self.assertEqual({'duration': 10902, 'method_identifier': 34}, parameters)
+
+    def test_rule_returns_ids_without_marking(self):
+        tx = FakeTransaction([[1], [5]])
+        trip_ids = OutlierIdentifier()._get_trip_ids_not_in_grid(tx, 'SGC1000', 'SquareGridFilter', False, 4)
+        self.assertEqual([1, 5], trip_ids)
+        self.assertNotIn('SET', tx.queries[0][0])
+
+    def test_mark_as_outliers_sends_ids_in_batches(self):
+        tx = FakeTransaction()
+        OutlierIdentifier(batch_size=2)._mark_as_outliers(tx, [1, 2, 3, 4, 5], 7)
+        self.assertEqual([[1, 2], [3, 4], [5]], [parameters['trip_ids'] for _, parameters in tx.queries])
+        self.assertTrue(all(parameters['method_identifier'] == 7 for _, parameters in tx.queries))
+
+    def test_invalid_label_is_rejected(self):
+        with self.assertRaises(ValueError):
+            OutlierIdentifier()._get_trip_ids_not_in_shape_collection(FakeTransaction(), 'CD) DETACH DELETE (n', True, 1)
+
+    def test_identify_outliers_runs_one_query_per_rule(self):
+        tx = FakeTransaction(responses={'UNWIND [-1]': []})
+        OutlierIdentifier().identify_outliers(tx)
+        marking_queries = [query for query, _ in tx.queries if 'SET trip.outlier = TRUE' in query]
+        self.assertEqual(41, len(marking_queries))
+
+    def test_identify_outliers_reports_counts_of_a_single_scan(self):
+        tx = FakeTransaction(responses={'UNWIND [-1]': [[-1, 10], [0, 10], [4, 7], [34, 3]]})
+        report = OutlierIdentifier().identify_outliers(tx)
+        self.assertEqual(1, len([query for query, _ in tx.queries if 'count(DISTINCT a)' in query]))
+        self.assertEqual(10, report['total'])
+        self.assertEqual(7, report['methods'][4])
+        self.assertEqual(3, report['methods'][34])
+        self.assertEqual(0, report['methods'][41])
+        self.assertEqual(list(range(1, 42)), list(report['methods']))
+        self.assertEqual(list(range(1, 42)), list(report['timings']))
+
+    def test_identify_outliers_skips_precomputed_methods(self):
+        tx = FakeTransaction(responses={'UNWIND [-1]': [], 'AS number_of_trips': [[4]],
+                                        'AS number_of_covered_trips': [[2]]})
+        outlier_rows = [{'tripId': 1, 'methods': [4]}, {'tripId': 2, 'methods': [4, 5]},
+                        {'tripId': 3, 'methods': [1]}]
+        report = OutlierIdentifier(batch_size=2).identify_outliers(tx, ([1, 4, 5], [1, 2, 3, 4], outlier_rows))
+        precomputed_queries = [parameters['rows'] for query, parameters in tx.queries if 'row.methods' in query]
+        self.assertEqual([outlier_rows[:2], outlier_rows[2:]], precomputed_queries)
+        marking_queries = [parameters['method_identifier'] for query, parameters in tx.queries
+                           if 'SET trip.outlier = TRUE' in query and 'method_identifier' in parameters]
+        self.assertEqual([i for i in range(1, 42) if i not in [1, 4, 5]], marking_queries)
+        self.assertNotIn(4, report['timings'])
+        self.assertIsNotNone(report['precomputed_timing'])
+
+    def test_identify_outliers_ignores_precomputed_methods_of_some_trips(self):
+        # The graph holds 6 trips, but the methods were only computed for 4 of them (e.g. a single batch).
+        tx = FakeTransaction(responses={'UNWIND [-1]': [], 'AS number_of_trips': [[6]],
+                                        'AS number_of_covered_trips': [[2]]})
+        report = OutlierIdentifier(batch_size=2).identify_outliers(
+            tx, ([1, 4, 5], [1, 2, 3, 4], [{'tripId': 1, 'methods': [4]}]))
+        self.assertFalse(any('row.methods' in query for query, _ in tx.queries))
+        self.assertEqual(list(range(1, 42)), list(report['timings']))
+        self.assertIsNone(report['precomputed_timing'])
+
+    def test_get_graph_outlier_methods(self):
+        df = pd.DataFrame({
+            'OriginCity': ['WASHINGTON', 'WASHINGTON', 'WASHINGTON'],
+            'DestinationCity': ['WASHINGTON', 'WASHINGTON', 'WASHINGTON'],
+            'Duration': [600, 0, 600],
+            'haversineDistance': [3000, 3000, 3000],
+            'communityDistrictStart': [1, 2, 999999999],
+            'communityDistrictEnd': [1, 2, 3]
+        }, index=[10, 11, 12])
+        for grid_name in ['SGC500Index', 'TGC500Index', 'HGC500Index']:
+            for column in ['PU' + grid_name + 'X', 'PU' + grid_name + 'Y', 'DO' + grid_name + 'X',
+                           'DO' + grid_name + 'Y']:
+                df[column] = [1, 1, 1]
+        df.loc[11, 'DOHGC500IndexY'] = 999999999
+        rules = get_outlier_rules([500])
+        for column, bitmask in evaluate_outlier_rules(df, rules).items():
+            df[column] = bitmask
+        method_identifiers, trip_ids, outlier_rows = get_graph_outlier_methods(df, [500], 'batch')
+        # Grid methods of 500m: square 4 + 1, hexagon 14 + 1, triangle 24 + 1.
+        self.assertEqual([1, 5, 15, 25], method_identifiers)
+        self.assertEqual(['batch:10', 'batch:11', 'batch:12'], trip_ids)
+        self.assertEqual([{'tripId': 'batch:11', 'methods': [15]},
+                          {'tripId': 'batch:12', 'methods': [1]}], outlier_rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
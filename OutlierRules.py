@@ -0,0 +1,150 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from configuration import config
+from data_preparation.GraphLoader import get_trip_ids
+from data_preparation.GridIndexer import NOT_IN_GRID, get_grid_name
+from data_preparation.OutlierIdentifier import OutlierIdentifier
+from data_preparation.ShapeIndex import NOT_IN_SHAPE
+
+OutlierRule = namedtuple('OutlierRule', ['name', 'predicate'])
+OutlierRule.__doc__ = """A named outlier rule. The predicate maps a data frame to a boolean array that is True for
+outliers."""
+
+BITS_PER_BITMASK = 64
+
+# First method identifier of OutlierIdentifier for every grid type, followed by one per grid cell height.
+FIRST_GRAPH_METHOD_IDENTIFIER_OF_GRID = {
+    'square': 4,
+    'hexagon': 14,
+    'triangle': 24
+}
+
+
+def _is_equal_to(column: str, value):
+    return lambda df: df[column].to_numpy() == value
+
+
+def _is_category_equal_to(column: str, value):
+    """Categories are read as strings, so they are compared with the string representation of the value."""
+    def predicate(df: pd.DataFrame) -> np.ndarray:
+        values = df[column]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            return values.to_numpy() == value
+        is_value = np.append(values.cat.categories.astype(str) == str(value), False)
+        return is_value[values.cat.codes.to_numpy()]  # Code -1 (missing) selects the appended False.
+    return predicate
+
+
+def get_outlier_rules(grid_cell_heights: list) -> list:
+    """Get all outlier rules in a fixed order. The position of a rule is its bit in the outlier bitmask."""
+    rules = [
+        # District-based
+        OutlierRule('OriginCity', _is_category_equal_to('OriginCity', 999999999)),
+        OutlierRule('DestinationCity', _is_category_equal_to('DestinationCity', 999999999)),
+    ]
+
+    # Grid-based
+    for grid_cell_height in grid_cell_heights:
+        for grid_type in ['square', 'triangle', 'hexagon']:
+            for index_dimension in ['X', 'Y']:
+                for location in ['PU', 'DO']:
+                    index_name = location + get_grid_name(grid_type, grid_cell_height) + index_dimension
+                    rules.append(OutlierRule(index_name, _is_equal_to(index_name, NOT_IN_GRID)))
+
+    rules += [
+        # Duration-based
+        OutlierRule('unreasonable_high_duration', lambda df: df['Duration'].to_numpy() > 10902),
+        OutlierRule('zero_duration', _is_equal_to('Duration', 0)),
+        OutlierRule('very_low_duration', lambda df: df['Duration'].to_numpy() < 30),
+        OutlierRule('duration_is_much_higher_than_travelled_distance', _is_duration_much_higher_than_distance),
+        OutlierRule('very_low_duration_despite_large_distance', _is_speed_unreasonable_high),
+        OutlierRule('very_low_duration_despite_large_haversine', _is_duration_low_despite_large_haversine),
+
+        # Distance-based
+        OutlierRule('distance', _is_equal_to('haversineDistance', 0)),
+
+        # Passenger-based
+        # OutlierRule('passenger_count', lambda df: (df['passenger_count'] > 7) | (df['passenger_count'] == 0)),
+    ]
+    return rules
+
+
+def _is_duration_much_higher_than_distance(df: pd.DataFrame) -> np.ndarray:
+    haversine_distance = df['haversineDistance'].to_numpy(dtype=np.float64)
+    return (haversine_distance > 0) & (haversine_distance / 11.4263 * 50 < df['Duration'].to_numpy())
+
+
+def _is_speed_unreasonable_high(df: pd.DataFrame) -> np.ndarray:
+    haversine_distance = df['haversineDistance'].to_numpy(dtype=np.float64)
+    duration = df['Duration'].to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (duration > 0) & (haversine_distance / 1000 / duration / 60 * 60 > 112.654)
+
+
+def _is_duration_low_despite_large_haversine(df: pd.DataFrame) -> np.ndarray:
+    haversine_distance = df['haversineDistance'].to_numpy(dtype=np.float64)
+    return haversine_distance / 1000 / 11.4263 * 25 > df['Duration'].to_numpy(dtype=np.float64) / 60 * 60
+
+
+def get_bitmask_column_names(rules: list) -> list:
+    """Every bitmask column holds the bits of up to 64 rules."""
+    number_of_bitmasks = max(1, -(-len(rules) // BITS_PER_BITMASK))
+    return [config.tt_outlier_prefix + 'bitmask' + str(i) for i in range(number_of_bitmasks)]
+
+
+def evaluate_outlier_rules(df: pd.DataFrame, rules: list) -> dict:
+    """Evaluate all rules and pack the results into bitmask columns. Bit i % 64 of bitmask i // 64 is set if rule i
+    identifies the trip as outlier. Returns a dict mapping the column name to the bitmask array."""
+    bitmasks = {column: np.zeros(len(df), dtype=np.uint64) for column in get_bitmask_column_names(rules)}
+    bitmask_columns = list(bitmasks)
+    for rule_id, rule in enumerate(rules):
+        is_outlier = np.asarray(rule.predicate(df), dtype=bool)
+        bitmasks[bitmask_columns[rule_id // BITS_PER_BITMASK]] |= \
+            is_outlier.astype(np.uint64) << np.uint64(rule_id % BITS_PER_BITMASK)
+    return bitmasks
+
+
+def decode_outlier_bitmasks(df: pd.DataFrame, rules: list) -> pd.DataFrame:
+    """Unpack the bitmask columns of the data frame into one boolean column per rule."""
+    bitmask_columns = get_bitmask_column_names(rules)
+    flags = {}
+    for rule_id, rule in enumerate(rules):
+        bitmask = df[bitmask_columns[rule_id // BITS_PER_BITMASK]].to_numpy(dtype=np.uint64)
+        flags[rule.name] = (bitmask >> np.uint64(rule_id % BITS_PER_BITMASK)) & np.uint64(1) == 1
+    return pd.DataFrame(flags, index=df.index)
+
+
+def get_graph_outlier_methods(df: pd.DataFrame, grid_cell_heights: list, source: str) -> tuple:
+    """Translate the outlier bitmasks and community districts of the trips into the spatial method identifiers of
+    OutlierIdentifier (1 and 4 to 33). A trip is a grid outlier if its pickup or dropoff is outside of the grid and a
+    district outlier if one of them is not in a community district, like in the graph. The duration and distance
+    methods are not covered, since their rules in the graph differ from the bitmask rules and only run on properties
+    of the trips anyway.
+
+    Returns the method identifiers that are covered, the ids of all trips and a row {'tripId': ..., 'methods': [...]}
+    for every trip with at least one of them. The trip ids are those GraphLoader gives the trips when loading them from
+    the same source."""
+    flags = decode_outlier_bitmasks(df, get_outlier_rules(grid_cell_heights))
+    methods = {}
+    if 'communityDistrictStart' in df.columns and 'communityDistrictEnd' in df.columns:
+        methods[1] = (df['communityDistrictStart'].to_numpy() == NOT_IN_SHAPE) \
+            | (df['communityDistrictEnd'].to_numpy() == NOT_IN_SHAPE)
+    for grid_type, first_method_identifier in FIRST_GRAPH_METHOD_IDENTIFIER_OF_GRID.items():
+        for i, grid_cell_height in enumerate(OutlierIdentifier.GRID_CELL_HEIGHTS):
+            if grid_cell_height in grid_cell_heights:
+                grid_name = get_grid_name(grid_type, grid_cell_height)
+                methods[first_method_identifier + i] = flags[[location + grid_name + index_dimension
+                                                              for location in ['PU', 'DO']
+                                                              for index_dimension in ['X', 'Y']]].to_numpy().any(axis=1)
+
+    method_identifiers = sorted(methods)
+    is_outlier = np.column_stack([methods[method_identifier] for method_identifier in method_identifiers])
+    trip_ids = get_trip_ids(df, source)
+    rows = []
+    for position in np.flatnonzero(is_outlier.any(axis=1)).tolist():
+        rows.append({'tripId': trip_ids[position],
+                     'methods': [method_identifiers[i] for i in np.flatnonzero(is_outlier[position]).tolist()]})
+    return method_identifiers, trip_ids, rows
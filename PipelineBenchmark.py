@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from configuration import config
+from data_preparation.SyntheticData import write_district_shapefile, write_trip_file, write_weather_file
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+
+
+def measure_stages(directory: str, trip_file_name: str, number_of_trips: int) -> dict:
+    """Transform all trips of the file as a single chunk and get the wall time of every stage in seconds. It is called
+    in a fresh process, so the configuration only points to the synthetic data in that process and nothing is shared
+    with other runs."""
+    config.dc_wp_weather_output_file = os.path.join(directory, 'weather.csv')
+    config.dc_wp_weather_daily_output_file = None
+    config.di_cd_shapes_file = os.path.join(directory, 'districts.shp')
+    config.tt_export_directory = os.path.join(directory, 'export') + os.sep
+    config.tt_export_format = 'csv'
+    config.tt_cache_directory = None
+    config.tt_reference_data_directory = None
+    config.tt_aggregation_directory = os.path.join(directory, 'aggregation')
+    config.tt_profile_file = os.path.join(directory, 'profile_' + str(number_of_trips) + '_' + str(os.getpid()) +
+                                          '.jsonl')
+    config.tt_profiler = None
+    os.makedirs(config.tt_export_directory, exist_ok=True)
+    from data_preparation.DC2017TripTransformer import DC2017TripTransformer  # Imported after the configuration.
+
+    transformer = DC2017TripTransformer(trip_file_name, 0)
+    start = time.perf_counter()
+    next(transformer.import_trips_in_chunks(number_of_trips))
+    timings = {'import': time.perf_counter() - start}
+    transformer.chunk_id = 0
+    transformer.transform_imported_trips()
+    with open(config.tt_profile_file) as profile_file:
+        for line in profile_file:
+            record = json.loads(line)
+            timings[record['stage']] = record['wall_time']
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def run_benchmark(sizes: list, repeats: int, seed: int) -> dict:
+    """Time every stage for all sizes. The minimum of the repeated runs is kept, as it is least affected by other
+    processes on the machine."""
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_weather_file(os.path.join(directory, 'weather.csv'), seed)
+        write_district_shapefile(os.path.join(directory, 'districts.shp'))
+        for number_of_trips in sizes:
+            trip_file_name = os.path.join(directory, 'trips_' + str(number_of_trips) + '.csv')
+            write_trip_file(trip_file_name, number_of_trips, seed)
+            runs = []
+            for _ in range(repeats):
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    runs.append(executor.submit(measure_stages, directory, trip_file_name, number_of_trips).result())
+            results[str(number_of_trips)] = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float, min_difference: float) -> list:
+    """Get a message for every stage that is more than threshold (e.g. 0.2 for 20%) slower than in the baseline.
+    Differences below min_difference seconds are ignored, as short stages vary a lot between runs."""
+    regressions = []
+    for size, timings in results.items():
+        for stage, wall_time in timings.items():
+            baseline_wall_time = baseline.get(size, {}).get(stage)
+            if baseline_wall_time and wall_time > baseline_wall_time * (1 + threshold) \
+                    and wall_time - baseline_wall_time > min_difference:
+                regressions.append(f'{stage} with {size} trips: {wall_time:.3f} s instead of '
+                                   f'{baseline_wall_time:.3f} s (+{wall_time / baseline_wall_time - 1:.0%})')
+    return regressions
+
+
+def main():
+    """Benchmark the DC 2017 transformation on synthetic data, e.g. python PipelineBenchmark.py --sizes 10000 100000.
+    The results are compared with the baseline file and the exit code is 1 if a stage got slower than the threshold.
+    With --update-baseline the results are stored as new baseline instead."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--min-difference', type=float, default=0.05)
+    parser.add_argument('--update-baseline', action='store_true')
+    arguments = parser.parse_args()
+
+    results = run_benchmark(arguments.sizes, arguments.repeats, arguments.seed)
+    for size, timings in results.items():
+        print(f'{size} trips: ' + ', '.join(f'{stage} {wall_time:.3f} s' for stage, wall_time in timings.items()))
+
+    if arguments.update_baseline or not os.path.isfile(arguments.baseline):
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print('Baseline written to ' + arguments.baseline)
+        return 0
+    with open(arguments.baseline) as baseline_file:
+        regressions = find_regressions(results, json.load(baseline_file), arguments.threshold,
+                                       arguments.min_difference)
+    for regression in regressions:
+        print('Regression: ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,26 @@
+from functools import lru_cache
+
+from pyproj import Transformer
+
+WGS84 = 'epsg:4326'
+WEB_MERCATOR = 'epsg:3857'
+
+
+@lru_cache(maxsize=None)
+def get_transformer(source_crs: str, target_crs: str) -> Transformer:
+    """Get the transformer between two coordinate reference systems. It is created once per process. Its axis order is
+    always (x, y), i.e. (longitude, latitude) for geographic systems, so callers never depend on the axis order
+    defined by the EPSG registry."""
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def project(latitudes, longitudes, crs: str = WEB_MERCATOR) -> tuple:
+    """Project WGS84 coordinates to crs in a single call. Accepts scalars or arrays and returns the (x, y) tuple in
+    the same form."""
+    return get_transformer(WGS84, crs).transform(longitudes, latitudes)
+
+
+def unproject(x, y, crs: str = WEB_MERCATOR) -> tuple:
+    """Inverse of project. Accepts scalars or arrays and returns the (latitudes, longitudes) tuple in the same form."""
+    longitudes, latitudes = get_transformer(crs, WGS84).transform(x, y)
+    return latitudes, longitudes
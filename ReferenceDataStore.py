@@ -0,0 +1,82 @@
+import hashlib
+import os
+from functools import lru_cache
+from os.path import splitext
+
+import pandas as pd
+import shapefile
+import shapely
+from pyarrow import feather
+from shapely.geometry import shape
+
+from configuration import config
+from data_preparation.FeatureCache import get_file_fingerprint
+from data_preparation.ShapeIndex import ShapeIndex
+
+
+def get_shapefile_fingerprint(file_name: str) -> tuple:
+    """Fingerprint of a shapefile (given with or without extension). It covers the geometries (.shp) and the records
+    (.dbf)."""
+    return tuple(get_file_fingerprint(splitext(file_name)[0] + extension) for extension in ['.shp', '.dbf'])
+
+
+class ReferenceDataStore:
+    """Read-only reference data like weather tables and district shapes. Every source file is converted once into an
+    uncompressed Arrow file in directory (dates as datetime64 columns, geometries as WKB), which is read memory-mapped
+    afterwards. Without a directory, the sources are converted in memory only. Tables are loaded on first use and kept
+    for all later requests of the process, until their source file changes."""
+
+    WKB_COLUMN = 'geometry_wkb'
+
+    def __init__(self, directory: str = None):
+        self.directory = directory
+        self.tables = {}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _get(self, kind: str, source_file_name: str, convert, load, fingerprint=None):
+        """Get the loaded table of a source file. convert reads the source into a data frame and load turns the data
+        frame into the object that is returned. The fingerprint defaults to the one of the source file."""
+        fingerprint = fingerprint or get_file_fingerprint(source_file_name)
+        key = (kind, fingerprint)
+        if key not in self.tables:
+            if not self.directory:
+                df = convert(source_file_name)
+            else:
+                file_name = os.path.join(self.directory, kind + '_' + hashlib.sha256(
+                    repr(fingerprint).encode('utf-8')).hexdigest()[:32] + '.arrow')
+                if not os.path.isfile(file_name):
+                    temporary_file_name = file_name + '.' + str(os.getpid()) + '.tmp'
+                    feather.write_feather(convert(source_file_name), temporary_file_name, compression='uncompressed')
+                    os.replace(temporary_file_name, file_name)
+                df = feather.read_table(file_name, memory_map=True).to_pandas()
+            self.tables[key] = load(df)
+        return self.tables[key]
+
+    def get_weather(self, file_name: str, date_columns: list, date_format: str = None) -> pd.DataFrame:
+        """Get a weather table with its date columns parsed."""
+        def convert(source_file_name):
+            df = pd.read_csv(source_file_name, dtype={column: str for column in date_columns})
+            for column in date_columns:
+                df[column] = pd.to_datetime(df[column], format=date_format)
+            return df
+        return self._get('weather', file_name, convert, lambda df: df)
+
+    def get_shape_index(self, file_name: str) -> ShapeIndex:
+        """Get the index of the shapes of a shapefile (given with or without extension)."""
+        def convert(source_file_name):
+            shapes = shapefile.Reader(source_file_name)
+            df = pd.DataFrame([record.as_dict() for record in shapes.records()], index=range(len(shapes)))
+            df[self.WKB_COLUMN] = shapely.to_wkb([shape(raw_shape) for raw_shape in shapes.shapes()])
+            return df
+
+        def load(df):
+            geometries = shapely.from_wkb(df[self.WKB_COLUMN].to_numpy())
+            return ShapeIndex(list(geometries), df.drop(columns=self.WKB_COLUMN).to_dict('records'))
+        return self._get('shapes', splitext(file_name)[0] + '.shp', convert, load, get_shapefile_fingerprint(file_name))
+
+
+@lru_cache(maxsize=None)
+def get_reference_data_store() -> ReferenceDataStore:
+    """Get the reference data store of this process."""
+    return ReferenceDataStore(getattr(config, 'tt_reference_data_directory', None))
@@ -0,0 +1,46 @@
+import io
+import math
+import random
+from itertools import islice
+
+
+def _skip_lines(lines, count: int):
+    """Advance the line iterator by count lines without keeping them."""
+    next(islice(lines, count, count), None)
+
+
+def sample_lines(file_name: str, sample_size: int, seed=None) -> tuple:
+    """Draw a uniform random sample of the lines after the header in a single pass with reservoir sampling
+    (Algorithm L, Li 1994). Only the sample is kept in memory and the lines between two replacements are skipped
+    without being looked at, so files of several gigabytes can be sampled without counting their lines first.
+
+    Returns the header and the sampled lines in the order of the file. Records must not contain line breaks inside
+    of quoted fields, which holds for the trip files."""
+    random_generator = random.Random(seed)
+    with open(file_name, 'rb') as input_file:
+        header = input_file.readline()
+        reservoir = list(enumerate(islice(input_file, sample_size)))
+        if len(reservoir) < sample_size or sample_size == 0:
+            return header, [line for _, line in reservoir]
+
+        line_number = sample_size - 1
+        w = math.exp(math.log(random_generator.random()) / sample_size)
+        while True:
+            skip = math.floor(math.log(random_generator.random()) / math.log(1 - w))
+            _skip_lines(input_file, skip)
+            line = input_file.readline()
+            if not line:
+                break
+            line_number += skip + 1
+            reservoir[random_generator.randrange(sample_size)] = (line_number, line)
+            w *= math.exp(math.log(random_generator.random()) / sample_size)
+    return header, [line for _, line in sorted(reservoir)]
+
+
+def sample_file(file_name: str, sample_size: int, seed=None) -> io.BytesIO:
+    """Get a random sample of the records of a csv-file as in-memory csv-file including the header, which can be
+    passed to pandas.read_csv."""
+    header, lines = sample_lines(file_name, sample_size, seed)
+    if lines and not lines[-1].endswith(b'\n'):
+        lines[-1] += b'\n'  # The last line of the file may lack the line break.
+    return io.BytesIO(header + b''.join(lines))
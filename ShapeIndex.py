@@ -0,0 +1,42 @@
+import numpy as np
+import shapefile
+import shapely
+from shapely.geometry import shape
+
+NOT_IN_SHAPE = 999999999  # Shape id used for coordinates that are not in any shape.
+
+
+class ShapeIndex:
+    """Spatial index over a collection of shapes like community districts, neighborhood clusters, neighborhood
+    tabulation areas or taxi zones. The shapes are converted once and indexed by their bounding boxes, so whole
+    coordinate arrays can be assigned to shapes in bulk."""
+
+    def __init__(self, geometries: list, records: list = None):
+        self.geometries = np.array(geometries, dtype=object)
+        self.records = records
+        self.tree = shapely.STRtree(self.geometries)
+
+    @classmethod
+    def from_shapefile(cls, file_name: str):
+        """Create the index from the shapes of a shapefile. The shape id is the position in the shapefile."""
+        shapes = shapefile.Reader(file_name)
+        return cls([shape(raw_shape) for raw_shape in shapes.shapes()], shapes.records())
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def get_shape_ids(self, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        """Get the id of the shape every coordinate lies within. If shapes overlap, the smallest id wins like in a
+        sequential search. Coordinates outside of all shapes get the id 999999999."""
+        coordinates = np.asarray(latitudes, dtype=np.float64) + 1j * np.asarray(longitudes, dtype=np.float64)
+        unique_coordinates, inverse = np.unique(coordinates, return_inverse=True)
+        points = shapely.points(unique_coordinates.imag, unique_coordinates.real)  # Points are (x=lon, y=lat).
+
+        point_ids, shape_ids = self.tree.query(points, predicate='within')
+        unique_shape_ids = np.full(len(points), NOT_IN_SHAPE, dtype=np.int64)
+        np.minimum.at(unique_shape_ids, point_ids, shape_ids)
+        return unique_shape_ids[inverse]
+
+    def get_shape_id(self, latitude: float, longitude: float) -> int:
+        """Get the id of the shape a single coordinate lies within."""
+        return int(self.get_shape_ids(np.array([latitude]), np.array([longitude]))[0])
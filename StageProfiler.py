@@ -0,0 +1,90 @@
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Only available on Unix.
+    resource = None
+
+
+def get_peak_rss():
+    """Peak resident memory of this process in bytes. Without the resource module (e.g. on Windows), psutil is used if
+    it is installed. Returns None if the peak memory cannot be measured."""
+    if resource is not None:
+        # ru_maxrss is given in bytes on macOS and in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    try:
+        import psutil  # Optional dependency, only needed without the resource module.
+    except ImportError:
+        return None
+    memory_info = psutil.Process().memory_info()
+    return getattr(memory_info, 'peak_wset', memory_info.rss)  # peak_wset is the peak on Windows.
+
+
+class StageProfiler:
+    """Measures wall time, CPU time, rows in/out, peak resident memory and data frame memory of every stage and appends
+    them as JSON line to file_name. If profiler is 'cprofile' or 'pyinstrument', every stage is additionally profiled
+    and the result is written next to file_name."""
+
+    def __init__(self, file_name: str, profiler: str = None):
+        self.file_name = file_name
+        self.profiler = profiler
+
+    @contextmanager
+    def profile(self, stage_name: str, transformer):
+        """Profile the stage that runs inside the with-block. The rows are taken from transformer.data_frame."""
+        rows_in = len(transformer.data_frame)
+        peak_rss_before = get_peak_rss()
+        stage_profiler = self._start_profiler()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            # The profiler is also stopped if the stage fails, but only successful stages are recorded.
+            cpu_time = time.process_time() - cpu_start
+            wall_time = time.perf_counter() - wall_start
+            file_name_prefix = os.path.splitext(self.file_name)[0] + '_' + stage_name + '_' + str(
+                getattr(transformer, 'batch_id', 0)) + '_' + str(transformer.chunk_id or 0)
+            self._stop_profiler(stage_profiler, file_name_prefix)
+
+        peak_rss = get_peak_rss()
+        record = {
+            'stage': stage_name,
+            'batch_id': getattr(transformer, 'batch_id', None),
+            'chunk_id': transformer.chunk_id,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'rows_in': rows_in,
+            'rows_out': len(transformer.data_frame),
+            'peak_rss': peak_rss,
+            'peak_rss_increase': None if peak_rss is None else peak_rss - peak_rss_before,
+            'data_frame_memory': int(transformer.data_frame.memory_usage(deep=True).sum())
+        }
+        with open(self.file_name, 'a') as output_file:
+            output_file.write(json.dumps(record) + '\n')
+
+    def _start_profiler(self):
+        if self.profiler == 'cprofile':
+            stage_profiler = cProfile.Profile()
+            stage_profiler.enable()
+            return stage_profiler
+        if self.profiler == 'pyinstrument':
+            from pyinstrument import Profiler  # Optional dependency, only needed for this profiler.
+            stage_profiler = Profiler()
+            stage_profiler.start()
+            return stage_profiler
+        return None
+
+    def _stop_profiler(self, stage_profiler, file_name_prefix: str):
+        if self.profiler == 'cprofile':
+            stage_profiler.disable()
+            stage_profiler.dump_stats(file_name_prefix + '.prof')
+        elif self.profiler == 'pyinstrument':
+            stage_profiler.stop()
+            with open(file_name_prefix + '.html', 'w') as output_file:
+                output_file.write(stage_profiler.output_html())
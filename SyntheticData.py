@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import shapefile
+
+from configuration import config
+
+
+def write_trip_file(file_name: str, number_of_trips: int, seed: int = 0, year: int = 2017):
+    """Write a csv-file with the columns of the DC 2017 trip files. About 10% of the coordinates lie outside of the
+    configured grid and the start times are given in local time with their UTC offset like in the original files."""
+    random_generator = np.random.default_rng(seed)
+    latitude_margin = (config.dc_grid_tr_lat - config.dc_grid_bl_lat) * 0.05
+    longitude_margin = (config.dc_grid_tr_lon - config.dc_grid_bl_lon) * 0.05
+
+    def get_coordinates():
+        latitudes = random_generator.uniform(config.dc_grid_bl_lat - latitude_margin,
+                                             config.dc_grid_tr_lat + latitude_margin, number_of_trips)
+        longitudes = random_generator.uniform(config.dc_grid_bl_lon - longitude_margin,
+                                              config.dc_grid_tr_lon + longitude_margin, number_of_trips)
+        return latitudes.round(3), longitudes.round(3)  # Coordinates are rounded to blocks in the original data.
+
+    origin_latitudes, origin_longitudes = get_coordinates()
+    destination_latitudes, destination_longitudes = get_coordinates()
+    start_date_times = (pd.Timestamp(str(year), tz='UTC') + pd.to_timedelta(
+        random_generator.integers(0, 365 * 24 * 60 * 60, number_of_trips), unit='s')).tz_convert('America/New_York')
+    cities = ['WASHINGTON', 'ARLINGTON', 'ALEXANDRIA', 'BETHESDA', '999999999']
+    pd.DataFrame({
+        'OBJECTID': np.arange(number_of_trips),
+        'Provider': random_generator.choice(['Transco', 'Yellow Cab', 'Grand Cab'], number_of_trips),
+        'MeterFare': random_generator.uniform(3, 50, number_of_trips).round(2),
+        'OriginCity': random_generator.choice(cities, number_of_trips, p=[0.7, 0.1, 0.1, 0.09, 0.01]),
+        'OriginZip': random_generator.integers(20001, 20099, number_of_trips),
+        'DestinationCity': random_generator.choice(cities, number_of_trips, p=[0.7, 0.1, 0.1, 0.09, 0.01]),
+        'DestinationZip': random_generator.integers(20001, 20099, number_of_trips),
+        'Milage': random_generator.uniform(0, 20, number_of_trips).round(2),
+        'Duration': np.minimum(random_generator.lognormal(6.5, 0.8, number_of_trips), 20000).astype(np.int64),
+        'OriginLatitude': origin_latitudes,
+        'OriginLongitude': origin_longitudes,
+        'DestinationLatitude': destination_latitudes,
+        'DestinationLongitude': destination_longitudes,
+        'StartDateTime': start_date_times.strftime('%Y-%m-%d %H:%M:%S.000 %z')
+    }).to_csv(file_name, index=False)
+
+
+def write_weather_file(file_name: str, seed: int = 0, year: int = 2017):
+    """Write an hourly weather csv-file for the whole year in the format of the weather preparation output."""
+    random_generator = np.random.default_rng(seed)
+    start_date_times = pd.date_range(str(year), str(year + 1), freq='h', inclusive='left')
+    pd.DataFrame({
+        'id': np.arange(len(start_date_times)),
+        'reported_date_time': (start_date_times + pd.Timedelta(minutes=52)).strftime('%Y-%m-%d %H:%M:%S'),
+        'start_date_time': start_date_times.strftime('%Y-%m-%d %H:%M:%S'),
+        'temperature': random_generator.normal(14, 9, len(start_date_times)).round(1),
+        'precipitation': np.maximum(random_generator.normal(0, 0.5, len(start_date_times)), 0).round(2),
+        'wind_speed': random_generator.uniform(0, 15, len(start_date_times)).round(1)
+    }).to_csv(file_name, index=False)
+
+
+def write_district_shapefile(file_name: str, rows: int = 4, columns: int = 4):
+    """Write a shapefile with a rows x columns raster of rectangular districts covering the configured grid."""
+    latitudes = np.linspace(config.dc_grid_bl_lat, config.dc_grid_tr_lat, rows + 1)
+    longitudes = np.linspace(config.dc_grid_bl_lon, config.dc_grid_tr_lon, columns + 1)
+    writer = shapefile.Writer(file_name, shapeType=shapefile.POLYGON)
+    writer.field('name', 'C')
+    for row in range(rows):
+        for column in range(columns):
+            bottom, top = latitudes[row], latitudes[row + 1]
+            left, right = longitudes[column], longitudes[column + 1]
+            writer.poly([[[left, bottom], [left, top], [right, top], [right, bottom], [left, bottom]]])
+            writer.record('District ' + str(row * columns + column))
+    writer.close()
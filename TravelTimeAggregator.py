@@ -0,0 +1,204 @@
+import logging
+import os
+import shutil
+from glob import glob
+
+import numpy as np
+import pandas as pd
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
+
+from configuration import config
+
+logger = logging.getLogger(__name__)
+
+CELL_INDEX_BITS = 16  # Bits per grid index in a cell key. 4 indices (PU x, PU y, DO x, DO y) fill 64 bits.
+QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+# Durations below this many seconds get a bucket each, longer ones share buckets that are DURATION_BUCKET_PRECISION
+# wide relative to the duration, i.e. about 780 buckets up to a day.
+EXACT_DURATION_SECONDS = 100
+DURATION_BUCKET_PRECISION = 0.01
+PARTIAL_VERSION = 2  # 2: Histograms of duration buckets instead of counts per duration.
+PARTIAL_SCHEMA = pyarrow.schema([('grid', pyarrow.string()), ('time_bin_column', pyarrow.string()),
+                                 ('cell_key', pyarrow.uint64()), ('time_bin', pyarrow.int16()),
+                                 ('duration_bucket', pyarrow.int16()), ('count', pyarrow.int32()),
+                                 ('duration_sum', pyarrow.int64())])
+
+
+def get_cell_keys(pu_x: np.ndarray, pu_y: np.ndarray, do_x: np.ndarray, do_y: np.ndarray) -> np.ndarray:
+    """Encode the grid cells of pickup and dropoff into one integer key per trip."""
+    keys = np.zeros(len(pu_x), dtype=np.uint64)
+    for indices in [pu_x, pu_y, do_x, do_y]:
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) and (indices.min() < 0 or indices.max() >= 1 << CELL_INDEX_BITS):
+            raise ValueError('Grid indices must be between 0 and ' + str((1 << CELL_INDEX_BITS) - 1) + '.')
+        keys = (keys << np.uint64(CELL_INDEX_BITS)) | indices.astype(np.uint64)
+    return keys
+
+
+def decode_cell_keys(keys: np.ndarray) -> tuple:
+    """Inverse of get_cell_keys. Returns the arrays pu_x, pu_y, do_x and do_y."""
+    keys = np.asarray(keys, dtype=np.uint64)
+    mask = np.uint64((1 << CELL_INDEX_BITS) - 1)
+    return tuple(((keys >> np.uint64(CELL_INDEX_BITS * shift)) & mask).astype(np.int32) for shift in [3, 2, 1, 0])
+
+
+def get_duration_buckets(durations: np.ndarray) -> np.ndarray:
+    """Get the bucket of every duration in seconds (see EXACT_DURATION_SECONDS)."""
+    durations = np.maximum(np.asarray(durations, dtype=np.float64), 0)
+    with np.errstate(divide='ignore'):
+        log_buckets = EXACT_DURATION_SECONDS + np.floor(
+            np.log(durations / EXACT_DURATION_SECONDS) / np.log1p(DURATION_BUCKET_PRECISION))
+    return np.where(durations < EXACT_DURATION_SECONDS, durations, log_buckets).astype(np.int16)
+
+
+def get_duration_histograms(df: pd.DataFrame, grid_names: list, time_bin_columns: list) -> pd.DataFrame:
+    """Summarize the durations of the trips per grid (e.g. SGC500), time-bin column, cell key and time bin as a
+    histogram of duration buckets. Every bucket keeps the number and the sum of its durations, so the histograms of
+    several batches are merged by adding them up. Means are exact, quantiles are exact below EXACT_DURATION_SECONDS
+    and within DURATION_BUCKET_PRECISION above."""
+    histograms = []
+    durations = df['Duration'].to_numpy(dtype=np.int64)
+    duration_buckets = get_duration_buckets(durations)
+    for grid_name in grid_names:
+        cell_keys = get_cell_keys(*(df[location + grid_name + 'Index' + index_dimension].to_numpy()
+                                    for location in ['PU', 'DO'] for index_dimension in ['X', 'Y']))
+        for time_bin_column in time_bin_columns:
+            grid_histograms = pd.DataFrame({
+                'cell_key': cell_keys,
+                'time_bin': df[time_bin_column].to_numpy(dtype=np.int16),
+                'duration_bucket': duration_buckets,
+                'duration': durations
+            }).groupby(['cell_key', 'time_bin', 'duration_bucket'], sort=False)['duration'].agg(['size', 'sum']) \
+                .rename(columns={'size': 'count', 'sum': 'duration_sum'}).reset_index()
+            grid_histograms.insert(0, 'grid', grid_name)
+            grid_histograms.insert(1, 'time_bin_column', time_bin_column)
+            histograms.append(grid_histograms)
+    if not histograms:
+        return PARTIAL_SCHEMA.empty_table().to_pandas()
+    histograms = pd.concat(histograms, ignore_index=True)
+    histograms['count'] = histograms['count'].astype(np.int32)
+    return histograms
+
+
+def write_partial(histograms: pd.DataFrame, file_name: str):
+    """Write the histograms of a batch with one row group per grid and time-bin column, so build_travel_time_tables
+    reads only the row groups of the table it builds."""
+    with pyarrow.parquet.ParquetWriter(file_name, PARTIAL_SCHEMA) as writer:
+        for _, combination in histograms.groupby(['grid', 'time_bin_column'], sort=False):
+            writer.write_table(pyarrow.Table.from_pandas(combination, schema=PARTIAL_SCHEMA, preserve_index=False))
+
+
+def get_travel_time_statistics(histograms: pd.DataFrame, quantiles: list = QUANTILES) -> pd.DataFrame:
+    """Reduce the duration histograms of one grid and time-bin column to count, mean, median and quantiles of the
+    duration per cell key and time bin. A quantile is the mean duration of the bucket that holds the observed duration
+    of the 'lower' method of numpy.quantile, rounded to seconds."""
+    histograms = histograms.groupby(['cell_key', 'time_bin', 'duration_bucket'])[['count', 'duration_sum']].sum() \
+        .reset_index()  # Sorted by the keys.
+    if histograms.empty:
+        return pd.DataFrame(columns=['cell_key', 'pu_x', 'pu_y', 'do_x', 'do_y', 'time_bin', 'count', 'mean'] + [
+            get_quantile_column_name(quantile) for quantile in quantiles])
+    cell_keys = histograms['cell_key'].to_numpy()
+    time_bins = histograms['time_bin'].to_numpy()
+    bucket_counts = histograms['count'].to_numpy(dtype=np.int64)
+    bucket_sums = histograms['duration_sum'].to_numpy(dtype=np.int64)
+
+    group_starts = np.flatnonzero(np.concatenate(
+        ([True], (cell_keys[1:] != cell_keys[:-1]) | (time_bins[1:] != time_bins[:-1]))))
+    cumulative_counts = np.cumsum(bucket_counts)
+    group_counts = np.add.reduceat(bucket_counts, group_starts)
+    counts_before_group = cumulative_counts[group_starts] - bucket_counts[group_starts]
+
+    pu_x, pu_y, do_x, do_y = decode_cell_keys(cell_keys[group_starts])
+    statistics = {
+        'cell_key': cell_keys[group_starts], 'pu_x': pu_x, 'pu_y': pu_y, 'do_x': do_x, 'do_y': do_y,
+        'time_bin': time_bins[group_starts],
+        'count': group_counts,
+        'mean': np.add.reduceat(bucket_sums, group_starts) / group_counts
+    }
+    bucket_means = np.rint(bucket_sums / bucket_counts).astype(np.int32)
+    for quantile in quantiles:
+        # The bucket of the duration at position floor(q * (n - 1)) of the sorted durations of the group.
+        positions = counts_before_group + np.floor(quantile * (group_counts - 1)).astype(np.int64) + 1
+        statistics[get_quantile_column_name(quantile)] = bucket_means[np.searchsorted(cumulative_counts, positions)]
+    return pd.DataFrame(statistics)
+
+
+def get_quantile_column_name(quantile: float) -> str:
+    return 'median' if quantile == 0.5 else 'q' + str(int(round(quantile * 100)))
+
+
+def get_partials_directory(directory: str, config_hash: str) -> str:
+    """The partials of every configuration are kept in their own directory, so they are never merged."""
+    return os.path.join(directory, 'partials', config_hash)
+
+
+def get_partial_file_names(directory: str, config_hash: str) -> list:
+    return sorted(glob(os.path.join(get_partials_directory(directory, config_hash), '*.parquet')))
+
+
+def remove_stale_partials(directory: str, config_hash: str):
+    """Remove the partials of all other configurations."""
+    for path in glob(os.path.join(directory, 'partials', '*')):
+        if os.path.basename(path) == config_hash:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)  # Partials written before they were kept per configuration.
+
+
+def get_combinations(partials: pyarrow.dataset.Dataset) -> list:
+    """Get the (grid, time-bin column) combinations of the partials from the statistics of their row groups, which
+    hold a single combination each (see write_partial)."""
+    combinations = []
+    for fragment in partials.get_fragments():
+        for row_group in fragment.split_by_row_group():
+            statistics = row_group.row_groups[0].statistics
+            combination = (statistics['grid']['min'], statistics['time_bin_column']['min'])
+            if combination not in combinations:
+                combinations.append(combination)
+    return combinations
+
+
+def build_travel_time_tables(directory: str, partial_file_names: list, quantiles: list = QUANTILES) -> list:
+    """Merge the duration histograms of the given partials and export a table of travel time statistics per grid and
+    time-bin column to directory/tables. The histograms of one grid and time-bin column are read at a time, so a year
+    of trips fits into memory. Since every row group of a partial holds one grid and time-bin column, the partials are
+    read only once in total. Returns the names of the exported files."""
+    if not partial_file_names:
+        return []
+    partials = pyarrow.dataset.dataset(partial_file_names, format='parquet')
+
+    os.makedirs(os.path.join(directory, 'tables'), exist_ok=True)
+    file_names = []
+    for grid_name, time_bin_column in get_combinations(partials):
+        histograms = partials.to_table(
+            columns=['cell_key', 'time_bin', 'duration_bucket', 'count', 'duration_sum'],
+            filter=(pyarrow.dataset.field('grid') == grid_name)
+            & (pyarrow.dataset.field('time_bin_column') == time_bin_column)).to_pandas()
+        file_name = os.path.join(directory, 'tables', 'travel_times_' + grid_name + '_' + time_bin_column + '.parquet')
+        get_travel_time_statistics(histograms, quantiles).to_parquet(file_name, index=False)
+        file_names.append(file_name)
+    logger.info('Exported %d travel time tables to %s.', len(file_names), os.path.join(directory, 'tables'))
+    return file_names
+
+
+def main():
+    """Build the travel time tables from the batches aggregated in config.tt_aggregation_directory. The partials of a
+    single configuration are merged, i.e. those of the last run."""
+    aggregation_directory = getattr(config, 'tt_aggregation_directory', None)
+    if not aggregation_directory:
+        raise ValueError('config.tt_aggregation_directory is not set.')
+    config_hashes = [os.path.basename(partials_directory) for partials_directory
+                     in glob(os.path.join(aggregation_directory, 'partials', '*'))
+                     if os.path.isdir(partials_directory)]
+    if len(config_hashes) != 1:
+        raise ValueError('Expected the partials of one configuration in ' + aggregation_directory +
+                         ', found ' + str(len(config_hashes)) + '.')
+    build_travel_time_tables(aggregation_directory, get_partial_file_names(aggregation_directory, config_hashes[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+from datetime import date, timedelta
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from configuration import config
+from data_preparation.DC2017TripTransformer import DC_TIME_ZONE, DC2017TripTransformer, initialize_worker
+from data_preparation.GridIndexer import GridIndexer, get_grid_name
+from data_preparation.Holidays import is_holiday
+
+NANOSECONDS_PER_MINUTE = 60 * 10 ** 9
+NANOSECONDS_PER_DAY = 24 * 60 * NANOSECONDS_PER_MINUTE
+DAY_FEATURES = ['year', 'month', 'week', 'weekday', 'holiday']
+
+
+@lru_cache(maxsize=None)
+def get_day_features(day: int) -> tuple:
+    """Get year, month, ISO week, weekday and holiday flag of a day since 1970-01-01 like the datetime accessors used by
+    add_basic_time_features and like is_holiday. The trips of a few years fall on some thousand days, so the features
+    are memoized."""
+    local_date = date(1970, 1, 1) + timedelta(days=day)
+    return (local_date.year, local_date.month, local_date.isocalendar()[1], local_date.weekday(),
+            is_holiday(np.array([day], dtype='datetime64[D]'))[0])
+
+
+class TripFeaturizer:
+    """Computes the features of DC2017TripTransformer for trips given by start time, origin and destination, e.g. to
+    predict their travel time. The grids, the district index and the weather tables are loaded once when the
+    featurizer is created and stay loaded for all requests of the process.
+
+    The stages of DC2017TripTransformer that do not need the duration of the trip are computed on plain numpy arrays
+    by the same helpers (grid kernels, searchsorted weather positions, time bins, the district index and the distance
+    kernels), so the features are identical to the exported ones without the overhead of building a data frame stage
+    by stage. The calendar features of the days are memoized by get_day_features. The trips keep the order in which
+    they were given. See FeaturizerBenchmark for the latency of single trips."""
+
+    def __init__(self):
+        initialize_worker()
+        self.transformer = DC2017TripTransformer(None, 0)  # No input file, features are never cached or exported.
+        self.cd_index = self.transformer.cd_index  # Looked up once, the property checks the shapefile on every access.
+        grids = [(grid_type, grid_cell_height) for grid_cell_height in config.dc_grid_cell_heights
+                 for grid_type in ['square', 'triangle', 'hexagon']]
+        self.grid_indexer = GridIndexer(grids)
+        self.grid_names = [get_grid_name(grid_type, grid_cell_height) for grid_type, grid_cell_height in grids]
+        # Like in add_weather_features, hourly records are matched in UTC and daily records on the date in DC.
+        self.weather_tables = []
+        for weather_df, period, prefix, local in [
+                (self.transformer.weather_hourly_df, np.timedelta64(1, 'h'), 'weather_hourly_', False),
+                (self.transformer.weather_daily_df, np.timedelta64(1, 'D'), 'weather_daily_', True)]:
+            if weather_df is not None:
+                self.weather_tables.append((self.get_weather_table(weather_df, period, prefix), local))
+        # Dtypes of the pandas datetime accessors, e.g. UInt32 for the ISO week.
+        start_date_times = pd.Series(pd.DatetimeIndex([0], tz=DC_TIME_ZONE))
+        self.time_feature_dtypes = {'year': start_date_times.dt.year.dtype,
+                                    'month': start_date_times.dt.month.dtype,
+                                    'week': start_date_times.dt.isocalendar().week.dtype,
+                                    'weekday': start_date_times.dt.weekday.dtype,
+                                    'hour': start_date_times.dt.hour.dtype,
+                                    'minute': start_date_times.dt.minute.dtype}
+        self.time_feature_numpy_dtypes = {name: getattr(dtype, 'numpy_dtype', dtype)
+                                          for name, dtype in self.time_feature_dtypes.items()}
+        self.time_feature_numpy_dtypes['holiday'] = bool
+
+    def get_weather_table(self, weather_df: pd.DataFrame, period: np.timedelta64, prefix: str) -> tuple:
+        """Get the start times of the weather records and the columns of join_weather as numpy arrays, together with
+        the value that join_weather uses for times without a record."""
+        columns = self.transformer.join_weather(weather_df, np.arange(len(weather_df)), prefix)
+        missing = self.transformer.join_weather(weather_df, np.array([-1]), prefix)
+        return weather_df['start_date_time'].to_numpy(dtype='datetime64[ns]'), period, [
+            (column, columns[column].to_numpy(), missing[column].to_numpy()) for column in columns.columns]
+
+    def get_utc_times(self, start_date_times) -> np.ndarray:
+        """Get the start times as UTC nanoseconds. Start times without time zone are taken as local time in DC."""
+        if isinstance(start_date_times, (list, tuple)) and all(
+                isinstance(start_date_time, pd.Timestamp) and start_date_time.tzinfo is not None
+                for start_date_time in start_date_times):
+            return np.array([start_date_time.value for start_date_time in start_date_times], dtype=np.int64)
+        start_date_times = pd.DatetimeIndex(start_date_times)
+        if start_date_times.tz is None:
+            start_date_times = start_date_times.tz_localize(DC_TIME_ZONE)
+        return start_date_times.tz_convert(None).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+    @staticmethod
+    def get_start_date_times(utc_times: np.ndarray) -> pd.DatetimeIndex:
+        """Get the start times in the DC time zone like the StartDateTime column of the transformer."""
+        return pd.DatetimeIndex(utc_times.view('datetime64[ns]')).tz_localize('UTC').tz_convert(DC_TIME_ZONE)
+
+    def get_time_features(self, local_times: np.ndarray) -> dict:
+        """Get the time features of add_basic_time_features and add_time_bin_features from the local nanoseconds."""
+        days = local_times // NANOSECONDS_PER_DAY
+        day_features = np.array([get_day_features(day) for day in days.tolist()], dtype=np.int64).reshape(-1, 5)
+        day_features = {name: day_features[:, position].astype(self.time_feature_numpy_dtypes[name])
+                        for position, name in enumerate(DAY_FEATURES)}
+        minutes = (local_times - days * NANOSECONDS_PER_DAY) // NANOSECONDS_PER_MINUTE
+        features = {name: day_features[name] for name in ['year', 'month', 'week', 'weekday']}
+        features['hour'] = (minutes // 60).astype(self.time_feature_numpy_dtypes['hour'])
+        features['minute'] = (minutes % 60).astype(self.time_feature_numpy_dtypes['minute'])
+        minute_of_day = self.transformer.get_minute_of_day(features['hour'], features['minute'])
+        for time_bin_size in config.tt_time_bins:
+            features['timeBin' + str(time_bin_size)] = self.transformer.get_time_bins(minute_of_day, time_bin_size)
+            features['timeBinWWDS' + str(time_bin_size)] = self.transformer.get_time_bins_with_wds(
+                minute_of_day, features['weekday'], time_bin_size)
+        features['holiday'] = day_features['holiday']
+        return features
+
+    def get_feature_arrays(self, utc_times: np.ndarray, pickup_latitudes: np.ndarray, pickup_longitudes: np.ndarray,
+                           dropoff_latitudes: np.ndarray, dropoff_longitudes: np.ndarray) -> dict:
+        """Get the features of the trips in the column order of the transformer. StartDateTime holds the start times in
+        DC, all other features are numpy arrays. The coordinates are float32 like the columns read from the trip files
+        (see DC_TRIP_DTYPES)."""
+        number_of_trips = len(utc_times)
+        if number_of_trips == 1:  # A single timestamp is created much faster than an index.
+            start_date_times = [pd.Timestamp(utc_times[0], tz='UTC').tz_convert(DC_TIME_ZONE)]
+            local_times = np.array([start_date_times[0].tz_localize(None).value])
+        else:
+            start_date_times = self.get_start_date_times(utc_times)
+            local_times = start_date_times.tz_localize(None).asi8
+        features = {'StartDateTime': start_date_times, 'pickup_latitude': pickup_latitudes,
+                    'pickup_longitude': pickup_longitudes, 'dropoff_latitude': dropoff_latitudes,
+                    'dropoff_longitude': dropoff_longitudes}
+        features.update(self.get_time_features(local_times))
+
+        # Pickup and dropoff coordinates are located together like in create_indices_for_grids. All helpers compute in
+        # float64, so the coordinates are converted only once.
+        latitudes = np.concatenate((pickup_latitudes, dropoff_latitudes)).astype(np.float64)
+        longitudes = np.concatenate((pickup_longitudes, dropoff_longitudes)).astype(np.float64)
+        grid_indices = self.grid_indexer.get_indices(latitudes, longitudes)
+        for grid_name, (x_indices, y_indices) in zip(self.grid_names, grid_indices.values()):
+            features['PU' + grid_name + 'X'] = x_indices[:number_of_trips]
+            features['PU' + grid_name + 'Y'] = y_indices[:number_of_trips]
+            features['DO' + grid_name + 'X'] = x_indices[number_of_trips:]
+            features['DO' + grid_name + 'Y'] = y_indices[number_of_trips:]
+
+        for (weather_start_times, period, columns), local in self.weather_tables:
+            positions = self.transformer.get_weather_row_positions(
+                weather_start_times, (local_times if local else utc_times).view('datetime64[ns]'), period)
+            not_covered = positions == -1
+            covered = not not_covered.any()
+            for column, values, missing_value in columns:
+                if covered:
+                    features[column] = values[positions]
+                elif len(values) == 0:
+                    features[column] = np.repeat(missing_value, number_of_trips)
+                else:  # Same dtype as the reindexed column of join_weather, e.g. float64 for integers.
+                    features[column] = np.where(not_covered, missing_value, values[np.maximum(positions, 0)])
+
+        district_ids = self.cd_index.get_shape_ids(latitudes, longitudes)
+        features['communityDistrictStart'] = district_ids[:number_of_trips]
+        features['communityDistrictEnd'] = district_ids[number_of_trips:]
+        # The distance and both legs of the Manhattan distance (see get_manhattan_distances) in one call.
+        latitudes_1, latitudes_2 = latitudes[:number_of_trips], latitudes[number_of_trips:]
+        longitudes_1, longitudes_2 = longitudes[:number_of_trips], longitudes[number_of_trips:]
+        distances = self.transformer.get_haversine_distances(
+            np.concatenate((latitudes_1, latitudes_1, latitudes_2)),
+            np.concatenate((longitudes_1, longitudes_1, longitudes_1)),
+            np.concatenate((latitudes_2, latitudes_2, latitudes_2)),
+            np.concatenate((longitudes_2, longitudes_1, longitudes_2))).reshape(3, number_of_trips)
+        features['haversineDistance'] = distances[0]
+        features['manhattanDistance'] = distances[1] + distances[2]
+        return features
+
+    def featurize(self, start_date_times, pickup_latitudes, pickup_longitudes, dropoff_latitudes,
+                  dropoff_longitudes) -> pd.DataFrame:
+        """Get the features of a batch of trips as data frame with the columns and dtypes of the transformer. Start
+        times without time zone are taken as local time in DC."""
+        features = self.get_feature_arrays(self.get_utc_times(start_date_times), *(
+            np.asarray(coordinates, dtype=np.float32)
+            for coordinates in [pickup_latitudes, pickup_longitudes, dropoff_latitudes, dropoff_longitudes]))
+        return pd.DataFrame(features).astype(self.time_feature_dtypes)
+
+    def featurize_trips(self, start_date_times, origins, destinations) -> list:
+        """Get the features of several trips as one dict per trip, which maps the columns of the transformer to their
+        values. Origins and destinations are (latitude, longitude) pairs. StartDateTime is a Timestamp in DC, all other
+        values are Python scalars."""
+        utc_times = self.get_utc_times(start_date_times)
+        coordinates = np.array([*origins, *destinations], dtype=np.float32).reshape(2, len(utc_times), 2)
+        features = self.get_feature_arrays(utc_times, coordinates[0, :, 0], coordinates[0, :, 1], coordinates[1, :, 0],
+                                           coordinates[1, :, 1])
+        # Lists are iterated much faster than numpy arrays and the index.
+        columns = [values.tolist() if isinstance(values, np.ndarray) else list(values) for values in features.values()]
+        return [dict(zip(features, values)) for values in zip(*columns)]
+
+    def featurize_trip(self, start_date_time, origin: tuple, destination: tuple) -> dict:
+        """Get the features of a single trip like featurize_trips."""
+        return self.featurize_trips([start_date_time], [origin], [destination])[0]
+
+
+class AsyncTripFeaturizer:
+    """Asyncio front end of a TripFeaturizer. Concurrent requests are collected for up to max_delay seconds or until
+    max_batch_size requests are waiting and are then featurized together in one vectorized call. The batches are
+    featurized by the executor, so the event loop keeps serving requests meanwhile. By default, this is a single
+    thread, since the memo of the grid registry must not be used by several threads at once."""
+
+    def __init__(self, featurizer: TripFeaturizer, max_batch_size: int = 256, max_delay: float = 0.001,
+                 executor: Executor = None):
+        self.featurizer = featurizer
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.owns_executor = executor is None
+        self.pending = []
+        self.flush_handle = None
+
+    async def featurize_trip(self, start_date_time, origin: tuple, destination: tuple) -> dict:
+        """Get the features of a single trip like TripFeaturizer.featurize_trip."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((start_date_time, origin, destination, future))
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_delay, self.flush)
+        return await future
+
+    def flush(self):
+        """Featurize all waiting requests at once."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        requests, self.pending = self.pending, []
+        if not requests:
+            return
+        start_date_times, origins, destinations, futures = zip(*requests)
+        batch = asyncio.get_running_loop().run_in_executor(self.executor, self.featurizer.featurize_trips,
+                                                           start_date_times, origins, destinations)
+        batch.add_done_callback(lambda _: self.set_results(batch, futures))
+
+    @staticmethod
+    def set_results(batch: asyncio.Future, futures: tuple):
+        exception = batch.exception()
+        for position, future in enumerate(futures):
+            if future.done():  # The request may have been cancelled meanwhile.
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(batch.result()[position])
+
+    def close(self):
+        """Shut down the executor if it was created by this front end."""
+        if self.owns_executor:
+            self.executor.shutdown()
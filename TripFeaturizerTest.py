@@ -0,0 +1,109 @@
+import asyncio
+import unittest
+from unittest.mock import PropertyMock, patch
+
+import numpy as np
+import pandas as pd
+
+from configuration import config
+from data_preparation.DC2017TripTransformer import DC_TIME_ZONE, DC2017TripTransformer
+from data_preparation.TripFeaturizer import AsyncTripFeaturizer, TripFeaturizer
+
+TRIP_COLUMNS = ['StartDateTime', 'pickup_latitude', 'pickup_longitude', 'dropoff_latitude', 'dropoff_longitude']
+
+
+class TripFeaturizerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        importer = DC2017TripTransformer(config.tt_trips_dc, 0)
+        importer.transform_trips()
+        cls.transformed_trips = importer.data_frame.reset_index(drop=True)
+        cls.featurizer = TripFeaturizer()
+
+    def test_features_match_transformer(self):
+        features = self.featurizer.featurize(*(self.transformed_trips[column] for column in TRIP_COLUMNS))
+        self.assertEqual(len(self.transformed_trips), len(features))
+        for column in features.columns:
+            pd.testing.assert_series_equal(self.transformed_trips[column], features[column], check_names=False,
+                                           obj=column)
+
+    def test_single_trip_matches_transformer(self):
+        trip = self.transformed_trips.iloc[3]
+        features = self.featurizer.featurize_trip(trip['StartDateTime'], (trip['pickup_latitude'],
+                                                                          trip['pickup_longitude']),
+                                                  (trip['dropoff_latitude'], trip['dropoff_longitude']))
+        for column in features:
+            self.assertEqual(trip[column], features[column], column)
+
+    @staticmethod
+    def get_stage_features(trips: pd.DataFrame) -> pd.DataFrame:
+        """Run the stages of the transformer that the featurizer replaces."""
+        transformer = DC2017TripTransformer(None, 0)
+        transformer.data_frame = trips.copy()
+        for stage in [transformer.add_basic_time_features, transformer.add_time_bin_features,
+                      transformer.add_grid_indices, transformer.add_weather_features,
+                      transformer.add_district_features, transformer.add_distance_features]:
+            stage()
+        return transformer.data_frame
+
+    def test_features_around_time_changes_and_new_year_match_stages(self):
+        start_date_times = pd.DatetimeIndex(
+            [time for day in ['2016-01-03', '2017-03-12', '2017-11-05', '2018-12-31', '2020-12-31']
+             for time in pd.date_range(day, periods=48, freq='37min', tz='UTC')]).tz_convert('America/New_York')
+        trips = self.transformed_trips[TRIP_COLUMNS].sample(len(start_date_times), replace=True, random_state=0) \
+            .reset_index(drop=True)
+        trips['StartDateTime'] = start_date_times
+        features = self.featurizer.featurize(*(trips[column] for column in TRIP_COLUMNS))
+        pd.testing.assert_frame_equal(self.get_stage_features(trips), features)
+
+    def test_features_of_later_years_without_weather_match_stages(self):
+        trips = self.transformed_trips[TRIP_COLUMNS].copy()
+        trips['StartDateTime'] += pd.DateOffset(years=150)
+        features = self.featurizer.featurize(*(trips[column] for column in TRIP_COLUMNS))
+        pd.testing.assert_frame_equal(self.get_stage_features(trips), features)
+        self.assertTrue(features['weather_hourly_id'].isna().all())
+
+    def test_daily_weather_of_evening_trips_matches_stages(self):
+        days = pd.date_range('2016-12-01', '2018-01-31', freq='D')
+        weather_daily_df = pd.DataFrame({'id': np.arange(len(days)), 'start_date_time': days,
+                                         'precipitation': np.linspace(0, 1, len(days))})
+        start_date_times = pd.date_range('2017-03-01 18:00', periods=48, freq='37min', tz=DC_TIME_ZONE)
+        trips = self.transformed_trips[TRIP_COLUMNS][:48].copy()
+        trips['StartDateTime'] = start_date_times
+        with patch.object(DC2017TripTransformer, 'weather_daily_df', new_callable=PropertyMock,
+                          return_value=weather_daily_df):
+            features = TripFeaturizer().featurize(*(trips[column] for column in TRIP_COLUMNS))
+            pd.testing.assert_frame_equal(self.get_stage_features(trips), features)
+        self.assertEqual((start_date_times.tz_localize(None).normalize() - days[0]).days.tolist(),
+                         features['weather_daily_id'].tolist())
+
+    def test_concurrent_requests_are_coalesced(self):
+        featurized_batch_sizes = []
+        featurize = self.featurizer.featurize_trips
+
+        def featurize_and_record(*arguments):
+            featurized_batch_sizes.append(len(arguments[0]))
+            return featurize(*arguments)
+
+        async def request_all(async_featurizer, trips):
+            return await asyncio.gather(*(async_featurizer.featurize_trip(
+                trip.StartDateTime, (trip.pickup_latitude, trip.pickup_longitude),
+                (trip.dropoff_latitude, trip.dropoff_longitude)) for trip in trips.itertuples()))
+
+        self.featurizer.featurize_trips = featurize_and_record
+        async_featurizer = AsyncTripFeaturizer(self.featurizer, max_batch_size=4)
+        try:
+            trips = self.transformed_trips[:10]
+            results = asyncio.run(request_all(async_featurizer, trips))
+        finally:
+            async_featurizer.close()
+            del self.featurizer.featurize_trips
+        self.assertEqual([4, 4, 2], featurized_batch_sizes)
+        for (_, trip), features in zip(trips.iterrows(), results):
+            self.assertEqual(trip['haversineDistance'], features['haversineDistance'])
+            self.assertEqual(trip['timeBin10'], features['timeBin10'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,37 +1,143 @@
-import random
+import io
+import logging
+import time
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
 
+import numpy as np
 import pandas as pd
 from haversine import haversine, Unit
 
 from configuration import config
-from grid_creation.PseudoGridCreator import PseudoSquareGrid, PseudoTriangleGrid, PseudoHexagonGrid
+from data_preparation.FeatureCache import FeatureCache
+from data_preparation.GridIndexer import GridIndexer, GRID_CLASSES, get_grid_name
+from data_preparation.ReservoirSampler import sample_file
+from data_preparation.StageProfiler import StageProfiler
+
+logger = logging.getLogger(__name__)
+
+AVERAGE_EARTH_RADIUS_METERS = 6371008.8  # Same radius as used by the haversine package.
+DEFAULT_CHUNK_SIZE = 100000  # Trips per chunk if config.tt_chunk_size is not set.
 
 
 class TripTransformer(ABC):
 
+    # Version of the output of every cached stage. It is part of the cache key, so it has to be increased whenever the
+    # columns a stage adds change. Otherwise, features cached by an older version would still be loaded.
+    STAGE_VERSIONS = {}
+
     def __init__(self):
         self.batch_size = config.tt_batch_size
         self.data_frame = pd.DataFrame()
+        self.chunk_id = None  # Set while the trips are transformed chunk by chunk.
+        self.input_fingerprint = None  # Identifies the imported trips. Features are only cached if it is set.
+        # Caching, profiling and aggregation are opt-in, so configurations without their keys keep working.
+        self.feature_cache = None
+        if getattr(config, 'tt_cache_directory', None):
+            self.feature_cache = FeatureCache(config.tt_cache_directory, getattr(config, 'tt_cache_max_size', None))
+        self.stage_profiler = None
+        if getattr(config, 'tt_profile_file', None):
+            self.stage_profiler = StageProfiler(config.tt_profile_file, getattr(config, 'tt_profiler', None))
 
     def transform_trips(self):
         """All transformations are combined in this method."""
-        self.import_trips_from_csv()
-        self.add_basic_time_features()
-        self.add_time_bin_features()
-        self.add_grid_indices()
-        self.add_weather_features()
-        self.add_district_features()
-        self.add_distance_features()
-        self.identify_outliers()
-        self.export_to_csv()
-        print(self.data_frame.tail())
+        with self.profile_stage('import'):
+            self.import_trips_from_csv()
+        self.transform_imported_trips()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Transformed trips:\n%s', self.data_frame.tail())
+
+    def transform_trips_in_chunks(self, chunk_size: int = None):
+        """Stream the whole input file through all transformations. Every chunk is transformed on its own and appended
+        to the exports, so the memory usage is bounded by the chunk size instead of the file size."""
+        chunk_size = chunk_size or getattr(config, 'tt_chunk_size', DEFAULT_CHUNK_SIZE)
+        self.chunk_id = 0
+        chunks = self.import_trips_in_chunks(chunk_size)
+        chunk_start = time.perf_counter()
+        while True:
+            # The chunk is read when the generator resumes. The last import record covers the read that hits the end.
+            with self.profile_stage('import'):
+                if next(chunks, False) is False:
+                    break
+            self.transform_imported_trips()
+            duration = time.perf_counter() - chunk_start
+            logger.info('Chunk %d: %d trips transformed in %.2f s (%.0f trips/s).', self.chunk_id,
+                        len(self.data_frame), duration, len(self.data_frame) / duration if duration > 0 else 0)
+            self.chunk_id += 1
+            chunk_start = time.perf_counter()
+        self.chunk_id = None
+
+    def transform_imported_trips(self):
+        """Add all features to the imported trips, identify the outliers and export them."""
+        with self.profile_stage('time'):
+            self.run_cached_stage('time', self.add_basic_time_features)
+        with self.profile_stage('timeBins'):
+            self.run_cached_stage('timeBins', self.add_time_bin_features)
+        with self.profile_stage('grid'):
+            self.add_grid_indices()
+        with self.profile_stage('weather'):
+            self.run_cached_stage('weather', self.add_weather_features)
+        with self.profile_stage('districts'):
+            self.run_cached_stage('districts', self.add_district_features)
+        with self.profile_stage('distances'):
+            self.run_cached_stage('distances', self.add_distance_features)
+        with self.profile_stage('outliers'):
+            self.identify_outliers()
+        if getattr(config, 'tt_aggregation_directory', None):
+            with self.profile_stage('aggregation'):
+                self.aggregate_travel_times()
+        with self.profile_stage('export'):
+            self.export_trips()
+
+    def profile_stage(self, stage_name: str):
+        """Context manager that profiles a stage if profiling is enabled by config.tt_profile_file."""
+        if self.stage_profiler is None:
+            return nullcontext()
+        return self.stage_profiler.profile(stage_name, self)
+
+    def get_stage_config_values(self, stage_name: str) -> tuple:
+        """Get the configuration values the result of a stage depends on besides the imported trips."""
+        return ()
+
+    def load_cached_features(self, stage_name: str, *values) -> bool:
+        """Add the cached columns of a stage to data_frame. Returns False if they are not cached."""
+        if self.feature_cache is None or self.input_fingerprint is None:
+            return False
+        cached_df = self.feature_cache.load(stage_name, self.STAGE_VERSIONS.get(stage_name, 0), self.input_fingerprint,
+                                            *values)
+        if cached_df is None or not cached_df.index.equals(self.data_frame.index):
+            return False
+        for column in cached_df.columns:
+            self.data_frame[column] = cached_df[column]
+        return True
+
+    def store_cached_features(self, columns: list, stage_name: str, *values):
+        if self.feature_cache is not None and self.input_fingerprint is not None:
+            self.feature_cache.store(self.data_frame[columns], stage_name, self.STAGE_VERSIONS.get(stage_name, 0),
+                                     self.input_fingerprint, *values)
+
+    def run_cached_stage(self, stage_name: str, stage):
+        """Run a stage or load its columns from the feature cache if the trips and the configuration values of the
+        stage have not changed."""
+        values = self.get_stage_config_values(stage_name)
+        if self.load_cached_features(stage_name, *values):
+            return
+        existing_columns = set(self.data_frame.columns)
+        stage()
+        self.store_cached_features([column for column in self.data_frame.columns if column not in existing_columns],
+                                   stage_name, *values)
 
     @abstractmethod
     def import_trips_from_csv(self):
         """Import trips from a csv-file."""
         pass
 
+    @abstractmethod
+    def import_trips_in_chunks(self, chunk_size: int):
+        """Import the trips of a csv-file chunk by chunk. Each chunk is imported into data_frame before the generator
+        yields."""
+        pass
+
     @abstractmethod
     def add_basic_time_features(self):
         """Add the basic time features year, month, week, weekday, hour, and minute."""
@@ -69,8 +175,15 @@ class TripTransformer(ABC):
         pass
 
     @abstractmethod
-    def export_to_csv(self):
-        """Export the trips to two csv-files. Separate between inlier and outlier dataset."""
+    def aggregate_travel_times(self):
+        """Summarize the durations of the inliers per grid cell pair and time bin for the travel time tables. Only
+        called if config.tt_aggregation_directory is set."""
+        pass
+
+    @abstractmethod
+    def export_trips(self):
+        """Export the trips to two csv-files or parquet datasets. Separate between inlier and outlier dataset. While
+        transforming in chunks, every chunk after the first one is appended to the exports."""
         pass
 
     @staticmethod
@@ -89,40 +202,82 @@ class TripTransformer(ABC):
             number_of_bins_per_day = 24 * 60 // bin_size
             return number_of_bins_per_day + minute_of_day // bin_size
 
+    @staticmethod
+    def get_minute_of_day(hours: np.ndarray, minutes: np.ndarray) -> np.ndarray:
+        return (np.asarray(hours, dtype=np.int16) * 60 + np.asarray(minutes, dtype=np.int16)).astype(np.int16)
+
+    @staticmethod
+    def get_time_bins(minute_of_day: np.ndarray, bin_size: int) -> np.ndarray:
+        """Vectorized variant of get_time_bin."""
+        return (minute_of_day // bin_size).astype(np.int16)
+
+    @staticmethod
+    def get_time_bins_with_wds(minute_of_day: np.ndarray, weekdays: np.ndarray, bin_size: int) -> np.ndarray:
+        """Vectorized variant of get_time_bin_with_wds."""
+        number_of_bins_per_day = 24 * 60 // bin_size
+        return (minute_of_day // bin_size + np.where(np.asarray(weekdays) <= 5, 0, number_of_bins_per_day)) \
+            .astype(np.int16)
+
     def create_index_for_grid(self, grid_type: str, grid_cell_height: int):
-        grid_name = grid_type[0].capitalize() + 'GC' + str(grid_cell_height) + 'Index'
-        if grid_type == 'square':
-            grid = PseudoSquareGrid(
-                grid_cell_height,
-                None,  # Volume is None, so the grid_cell_height is used to create the grid.
-                config.dc_grid_bl_lat, config.dc_grid_bl_lon,
-                config.dc_grid_tr_lat, config.dc_grid_tr_lon
-            )
-        elif grid_type == 'triangle':
-            grid = PseudoTriangleGrid(
-                grid_cell_height,
-                None,  # Volume is None, so the grid_cell_height is used to create the grid.
-                config.dc_grid_bl_lat, config.dc_grid_bl_lon,
-                config.dc_grid_tr_lat, config.dc_grid_tr_lon
-            )
-        elif grid_type == 'hexagon':
-            grid = PseudoHexagonGrid(
-                grid_cell_height,
-                None,  # Volume is None, so the grid_cell_height is used to create the grid.
-                config.dc_grid_bl_lat, config.dc_grid_bl_lon,
-                config.dc_grid_tr_lat, config.dc_grid_tr_lon
-            )
-        else:
-            print('No valid grid type was passed. No grid is created.')
+        if grid_type not in GRID_CLASSES:
+            logger.warning('No valid grid type was passed. No grid is created.')
             return None
-        self.data_frame['PU' + grid_name + 'X'] = self.data_frame.apply(
-            lambda x: grid.get_index(x['pickup_latitude'], x['pickup_longitude'])[0], axis=1)
-        self.data_frame['PU' + grid_name + 'Y'] = self.data_frame.apply(
-            lambda x: grid.get_index(x['pickup_latitude'], x['pickup_longitude'])[1], axis=1)
-        self.data_frame['DO' + grid_name + 'X'] = self.data_frame.apply(
-            lambda x: grid.get_index(x['dropoff_latitude'], x['dropoff_longitude'])[0], axis=1)
-        self.data_frame['DO' + grid_name + 'Y'] = self.data_frame.apply(
-            lambda x: grid.get_index(x['dropoff_latitude'], x['dropoff_longitude'])[1], axis=1)
+        self.create_indices_for_grids([(grid_type, grid_cell_height)])
+
+    def create_indices_for_grids(self, grids: list):
+        """Add the grid indices of start and end point for every grid given as (grid_type, grid_cell_height). The
+        pickup and dropoff coordinates are located together in one batched call."""
+        number_of_trips = len(self.data_frame)
+        latitudes = np.concatenate((self.data_frame['pickup_latitude'].to_numpy(dtype=np.float64),
+                                    self.data_frame['dropoff_latitude'].to_numpy(dtype=np.float64)))
+        longitudes = np.concatenate((self.data_frame['pickup_longitude'].to_numpy(dtype=np.float64),
+                                     self.data_frame['dropoff_longitude'].to_numpy(dtype=np.float64)))
+        indices = GridIndexer(grids).get_indices(latitudes, longitudes)
+        for (grid_type, grid_cell_height), (x_indices, y_indices) in indices.items():
+            grid_name = get_grid_name(grid_type, grid_cell_height)
+            self.data_frame['PU' + grid_name + 'X'] = x_indices[:number_of_trips]
+            self.data_frame['PU' + grid_name + 'Y'] = y_indices[:number_of_trips]
+            self.data_frame['DO' + grid_name + 'X'] = x_indices[number_of_trips:]
+            self.data_frame['DO' + grid_name + 'Y'] = y_indices[number_of_trips:]
+
+    @staticmethod
+    def get_compact_data_frame(df: pd.DataFrame) -> pd.DataFrame:
+        """Downcast the features to the smallest dtypes that hold their values. Grid indices keep 32 bits for the
+        999999999 sentinel, districts and cities become categories."""
+        dtypes = {}
+        for column in df.columns:
+            if column.startswith(('PU', 'DO')) and 'GC' in column and column[-1] in 'XY':
+                dtypes[column] = np.int32
+            elif column.startswith('timeBin') or column == 'year':
+                dtypes[column] = np.int16
+            elif column in ['month', 'week', 'weekday', 'hour', 'minute']:
+                dtypes[column] = np.int8
+            elif column.startswith('communityDistrict') or column in ['OriginCity', 'DestinationCity']:
+                dtypes[column] = 'category'
+            elif column in ['haversineDistance', 'manhattanDistance']:
+                dtypes[column] = np.int32
+        return df.astype(dtypes)
+
+    @staticmethod
+    def get_weather_row_positions(weather_start_times: np.ndarray, times: np.ndarray,
+                                  period: np.timedelta64) -> np.ndarray:
+        """Get the position of the weather record that covers each time. Each record covers its start time until the
+        start time of the next record, the last one covers one period. Times outside of the covered range get -1."""
+        weather_start_times = np.asarray(weather_start_times, dtype='datetime64[ns]')
+        times = np.asarray(times, dtype='datetime64[ns]')
+        if len(weather_start_times) == 0:
+            return np.full(len(times), -1, dtype=np.int64)
+        positions = np.searchsorted(weather_start_times, times, side='right') - 1
+        positions[(times > weather_start_times[-1] + period) | (times < weather_start_times[0])] = -1
+        return positions
+
+    @staticmethod
+    def join_weather(weather_df: pd.DataFrame, positions: np.ndarray, prefix: str) -> pd.DataFrame:
+        """Get the weather records at the given positions as prefixed columns. The first column is used as id and the
+        time columns are dropped. Rows with position -1 are left empty."""
+        weather_df = weather_df.drop(columns=['reported_date_time', 'start_date_time'], errors='ignore')
+        weather_df_for_trips = weather_df.reset_index(drop=True).reindex(positions).add_prefix(prefix)
+        return weather_df_for_trips.rename(columns={weather_df_for_trips.columns[0]: prefix + 'id'})
 
     @staticmethod
     def get_haversine_distance(point_1, point_2):
@@ -137,9 +292,36 @@ class TripTransformer(ABC):
                int(round(haversine((point_2[0], point_1[1]), point_2, unit=Unit.METERS), 0))
 
     @staticmethod
-    def get_random_sample_from_file(file_name: str, sample_size: int = 1000):
-        """Based on: https://stackoverflow.com/a/22259008/2908475. This solution is relatively slow."""
-        input_file = open(file_name)
-        number_of_records_in_file = sum(1 for line in input_file)
-        input_file.close()
-        return sorted(random.sample(range(1, number_of_records_in_file+1), number_of_records_in_file - sample_size))
\ No newline at end of file
+    def get_haversine_distances(latitudes_1: np.ndarray, longitudes_1: np.ndarray, latitudes_2: np.ndarray,
+                                longitudes_2: np.ndarray) -> np.ndarray:
+        """Get the Haversine distances in meters between two arrays of points. Vectorized variant of
+        get_haversine_distance."""
+        return np.rint(_get_haversine_distances_in_meters(
+            latitudes_1, longitudes_1, latitudes_2, longitudes_2)).astype(np.int32)
+
+    @staticmethod
+    def get_manhattan_distances(latitudes_1: np.ndarray, longitudes_1: np.ndarray, latitudes_2: np.ndarray,
+                                longitudes_2: np.ndarray) -> np.ndarray:
+        """Get the Manhattan distances in meters between two arrays of points. Vectorized variant of
+        get_manhattan_distance, both legs are rounded separately."""
+        latitude_leg = np.rint(_get_haversine_distances_in_meters(
+            latitudes_1, longitudes_1, latitudes_2, longitudes_1)).astype(np.int32)
+        longitude_leg = np.rint(_get_haversine_distances_in_meters(
+            latitudes_2, longitudes_1, latitudes_2, longitudes_2)).astype(np.int32)
+        return latitude_leg + longitude_leg
+
+    @staticmethod
+    def get_random_sample_from_file(file_name: str, sample_size: int = 1000, seed=None) -> io.BytesIO:
+        """Get a uniform random sample of the records of a csv-file, read in one pass with memory for the sample
+        only. The result is an in-memory csv-file including the header. The same seed gives the same sample."""
+        return sample_file(file_name, sample_size, seed)
+
+
+def _get_haversine_distances_in_meters(latitudes_1, longitudes_1, latitudes_2, longitudes_2) -> np.ndarray:
+    """Same formula as the haversine package, applied to whole arrays of degrees."""
+    latitudes_1, longitudes_1, latitudes_2, longitudes_2 = (
+        np.radians(np.asarray(values, dtype=np.float64))
+        for values in (latitudes_1, longitudes_1, latitudes_2, longitudes_2))
+    d = np.sin((latitudes_2 - latitudes_1) * 0.5) ** 2 \
+        + np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) * 0.5) ** 2
+    return 2 * AVERAGE_EARTH_RADIUS_METERS * np.arcsin(np.sqrt(d))
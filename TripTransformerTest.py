@@ -1,14 +1,73 @@
+import math
+import os
+import tempfile
 import unittest
 from datetime import datetime
+from unittest.mock import PropertyMock, patch
 
+import numpy as np
+import pandas as pd
 from haversine import haversine, Unit
+from shapely.geometry import Point, Polygon
 
 from configuration import config
-from data_preparation.DC2017TripTransformer import DC2017TripTransformer
+from data_preparation.DC2017TripTransformer import DC_TIME_ZONE, DC2017TripTransformer, get_transformation_config_hash
+from data_preparation.FeatureCache import FeatureCache
+from data_preparation.GridIndexer import GridRegistry, KERNELS, NOT_IN_GRID, SquareGridKernel
+from data_preparation.Holidays import is_holiday
 from data_preparation.NYC2016TripTransformer import NYC2016TripTransformer
+from data_preparation.Projection import project
+from data_preparation.TravelTimeAggregator import DURATION_BUCKET_PRECISION, EXACT_DURATION_SECONDS, \
+    build_travel_time_tables, decode_cell_keys, get_cell_keys, get_duration_histograms, get_partial_file_names, \
+    get_partials_directory, get_travel_time_statistics, remove_stale_partials, write_partial
 from data_preparation.TripTransformer import TripTransformer
 
 
+class ReferenceGrid:
+    """Grid in the layout of a kernel that locates a coordinate by testing which cell polygon around it covers it."""
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+
+    def get_index(self, latitude: float, longitude: float) -> tuple:
+        x, y = project(latitude, longitude)
+        if not (self.kernel.x_min <= x <= self.kernel.x_max and self.kernel.y_min <= y <= self.kernel.y_max):
+            return NOT_IN_GRID, NOT_IN_GRID
+        return next(index for index, corners in self.get_cells_around(x - self.kernel.x_min, y - self.kernel.y_min)
+                    if Polygon([(self.kernel.x_min + corner_x, self.kernel.y_min + corner_y)
+                                for corner_x, corner_y in corners]).covers(Point(x, y)))
+
+    def get_cells_around(self, x: float, y: float):
+        """Get the index and the corners relative to the bottom left corner of the grid of the cells around x, y."""
+        height = self.kernel.grid_cell_height
+        if hasattr(self.kernel, 'shifted_rows'):
+            half_side = height / math.sqrt(3)
+            row = math.floor(y / height)
+            shift = row % 2 if self.kernel.shifted_rows else 0
+            for column in range(math.floor(x / half_side + shift) - 1, math.floor(x / half_side + shift) + 3):
+                corners = [(column - 1, 0), (column + 1, 0), (column, 1)] if column % 2 else \
+                    [(column - 1, 1), (column + 1, 1), (column, 0)]
+                yield (column, row), [((u - shift) * half_side, (row + v) * height) for u, v in corners]
+            return
+        flat_top = self.kernel.flat_top
+        radius = height / math.sqrt(3) if flat_top else height / 2
+        line_distance, center_distance = 1.5 * radius, height if flat_top else math.sqrt(3) * radius
+        p, q = (x, y) if flat_top else (y, x)
+        first_line = math.floor((p - radius) / line_distance)
+        for line in range(first_line - 1, first_line + 3):
+            shift = 0.5 * (line % 2)
+            first_center = round((q - center_distance / 2) / center_distance - shift)
+            for center in range(first_center - 1, first_center + 2):
+                center_p = radius + line * line_distance
+                center_q = center_distance / 2 + (center + shift) * center_distance
+                corners = [(center_p + radius * math.cos(angle), center_q + radius * math.sin(angle))
+                           for angle in np.radians(np.arange(0, 360, 60))]
+                if flat_top:
+                    yield (line, center), corners
+                else:
+                    yield (center, line), [(corner_q, corner_p) for corner_p, corner_q in corners]
+
+
 class TripImporterTest(unittest.TestCase):
 
     def test_get_time_bin(self):
@@ -33,6 +92,187 @@ class TripImporterTest(unittest.TestCase):
         self.assertEqual(143, TripTransformer.get_time_bin_with_wds(23, 59, 5, 10))
         self.assertEqual(287, TripTransformer.get_time_bin_with_wds(23, 59, 7, 10))
 
+    def test_vectorized_time_bins_match_scalar_time_bins(self):
+        hours, minutes, weekdays = (values.ravel() for values in np.meshgrid(range(24), range(60), range(8)))
+        minute_of_day = TripTransformer.get_minute_of_day(hours, minutes)
+        for bin_size in [5, 10, 15, 30, 60]:
+            time_bins = TripTransformer.get_time_bins(minute_of_day, bin_size)
+            time_bins_with_wds = TripTransformer.get_time_bins_with_wds(minute_of_day, weekdays, bin_size)
+            for i in range(len(hours)):
+                self.assertEqual(TripTransformer.get_time_bin(hours[i], minutes[i], bin_size), time_bins[i])
+                self.assertEqual(TripTransformer.get_time_bin_with_wds(hours[i], minutes[i], weekdays[i], bin_size),
+                                 time_bins_with_wds[i])
+
+    def test_is_holiday(self):
+        dates = np.array(['2017-01-02', '2017-01-20', '2017-04-16', '2017-04-17', '2017-11-10', '2017-11-23',
+                          '2021-12-31', '2017-07-05'], dtype='datetime64[D]')
+        self.assertEqual([True, True, False, True, True, True, True, False], is_holiday(dates).tolist())
+
+    def test_get_weather_row_positions(self):
+        weather_start_times = np.arange('2016-02-01T00', '2016-03-01T00', dtype='datetime64[h]')
+        times = np.array(['2016-02-19T20:51:23', '2016-02-01T00:51:00', '2016-02-01T00:00:00', '2015-02-01T00:00:00',
+                          '2016-02-29T23:59:59', '2016-03-01T00:00:00', '2016-03-01T00:00:01', '2017-02-01T00:00:00'],
+                         dtype='datetime64[s]')
+        positions = TripTransformer.get_weather_row_positions(weather_start_times, times, np.timedelta64(1, 'h'))
+        self.assertEqual([452, 0, 0, -1, 695, 695, -1, -1], positions.tolist())
+        positions = TripTransformer.get_weather_row_positions(np.array([], dtype='datetime64[h]'), times,
+                                                              np.timedelta64(1, 'D'))
+        self.assertEqual([-1] * len(times), positions.tolist())
+
+    def test_vectorized_distances_match_scalar_distances(self):
+        random_generator = np.random.default_rng(2017)
+        latitudes_1, latitudes_2 = random_generator.uniform(38.79, 39.0, (2, 1000))
+        longitudes_1, longitudes_2 = random_generator.uniform(-77.12, -76.9, (2, 1000))
+        haversine_distances = TripTransformer.get_haversine_distances(
+            latitudes_1, longitudes_1, latitudes_2, longitudes_2)
+        manhattan_distances = TripTransformer.get_manhattan_distances(
+            latitudes_1, longitudes_1, latitudes_2, longitudes_2)
+        self.assertEqual(np.int32, haversine_distances.dtype)
+        self.assertEqual(np.int32, manhattan_distances.dtype)
+        for i in range(1000):
+            point_1 = (latitudes_1[i], longitudes_1[i])
+            point_2 = (latitudes_2[i], longitudes_2[i])
+            self.assertEqual(TripTransformer.get_haversine_distance(point_1, point_2), haversine_distances[i])
+            self.assertEqual(TripTransformer.get_manhattan_distance(point_1, point_2), manhattan_distances[i])
+
+    def test_get_random_sample_from_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'trips.csv')
+            with open(file_name, 'w') as trip_file:
+                trip_file.write('id,value\n' + ''.join(str(i) + ',' + str(i * 2) + '\n' for i in range(10000)))
+            sample = TripTransformer.get_random_sample_from_file(file_name, 100, 2017).read().decode().splitlines()
+            self.assertEqual('id,value', sample[0])
+            ids = [int(line.split(',')[0]) for line in sample[1:]]
+            self.assertEqual(100, len(set(ids)))
+            self.assertEqual(sorted(ids), ids)
+            self.assertTrue(all(line == str(i) + ',' + str(i * 2) for i, line in zip(ids, sample[1:])))
+            self.assertEqual(sample, TripTransformer.get_random_sample_from_file(
+                file_name, 100, 2017).read().decode().splitlines())
+            self.assertNotEqual(sample, TripTransformer.get_random_sample_from_file(
+                file_name, 100, 2018).read().decode().splitlines())
+            self.assertEqual(10001, len(TripTransformer.get_random_sample_from_file(
+                file_name, 20000).read().decode().splitlines()))
+
+    def test_vectorized_grid_indices_match_grid(self):
+        random_generator = np.random.default_rng(2017)
+        latitudes = random_generator.uniform(config.dc_grid_bl_lat - 0.01, config.dc_grid_tr_lat + 0.01, 10000)
+        longitudes = random_generator.uniform(config.dc_grid_bl_lon - 0.01, config.dc_grid_tr_lon + 0.01, 10000)
+        for grid_cell_height in [1000, 100, 10]:
+            np.testing.assert_array_equal(
+                GridRegistry(use_kernels=False).get_indices('square', grid_cell_height, latitudes, longitudes),
+                GridRegistry().get_indices('square', grid_cell_height, latitudes, longitudes))
+
+    def test_only_the_memo_quantizes_coordinates(self):
+        random_generator = np.random.default_rng(2017)
+        latitudes = random_generator.uniform(config.dc_grid_bl_lat, config.dc_grid_tr_lat, 2000)
+        longitudes = random_generator.uniform(config.dc_grid_bl_lon, config.dc_grid_tr_lon, 2000)
+        exact_indices = GridRegistry(use_kernels=False).get_indices('square', 100, latitudes, longitudes)
+        np.testing.assert_array_equal(exact_indices, GridRegistry(quantization_decimals=2).get_indices(
+            'square', 100, latitudes, longitudes))
+        # Coordinates located point by point get the cell of their rounded coordinate.
+        np.testing.assert_array_equal(
+            GridRegistry(use_kernels=False).get_indices('square', 100, np.round(latitudes, 2), np.round(longitudes, 2)),
+            GridRegistry(1000, 2, use_kernels=False).get_indices('square', 100, latitudes, longitudes))
+        # The kernel only leaves coordinates close to a cell border to the memo.
+        _, uncertain = SquareGridKernel(100).get_indices(latitudes, longitudes)
+        np.testing.assert_array_equal(exact_indices[~uncertain], GridRegistry(1000, 2).get_indices(
+            'square', 100, latitudes, longitudes)[~uncertain])
+
+    def test_triangle_and_hexagon_kernels_locate_like_grids_of_their_layout(self):
+        random_generator = np.random.default_rng(2017)
+        latitudes = random_generator.uniform(config.dc_grid_bl_lat - 0.01, config.dc_grid_tr_lat + 0.01, 1000)
+        longitudes = random_generator.uniform(config.dc_grid_bl_lon - 0.01, config.dc_grid_tr_lon + 0.01, 1000)
+        for grid_type in ['triangle', 'hexagon']:
+            for kernel_class, arguments in KERNELS[grid_type]:
+                grid = ReferenceGrid(kernel_class(100, **arguments))
+                registry = GridRegistry()
+                registry.grids[(grid_type, 100)] = grid
+                kernel = registry.get_kernel(grid_type, 100)
+                self.assertIsInstance(kernel, kernel_class)
+                self.assertEqual(arguments, {name: getattr(kernel, name) for name in arguments})
+                exact_registry = GridRegistry(use_kernels=False)
+                exact_registry.grids[(grid_type, 100)] = grid
+                np.testing.assert_array_equal(exact_registry.get_indices(grid_type, 100, latitudes, longitudes),
+                                              registry.get_indices(grid_type, 100, latitudes, longitudes))
+
+    def test_kernel_differing_in_last_column_is_rejected(self):
+        registry = GridRegistry()
+        grid = registry.get_grid('square', 5)
+        kernel = SquareGridKernel(5)
+        last_column = int((kernel.x_max - kernel.x_min) // 5)
+
+        class GridWithoutLastColumn:
+            @staticmethod
+            def get_index(latitude, longitude):
+                x_index, y_index = grid.get_index(latitude, longitude)
+                return (x_index, y_index) if x_index == NOT_IN_GRID else (min(x_index, last_column - 1), y_index)
+
+        registry.grids[('square', 5)] = GridWithoutLastColumn()
+        self.assertIsNone(registry.get_kernel('square', 5))
+
+    def test_nested_grid_indices_match_grid(self):
+        random_generator = np.random.default_rng(2017)
+        latitudes = random_generator.uniform(config.dc_grid_bl_lat - 0.01, config.dc_grid_tr_lat + 0.01, 10000)
+        longitudes = random_generator.uniform(config.dc_grid_bl_lon - 0.01, config.dc_grid_tr_lon + 0.01, 10000)
+        grid_cell_heights = [1000, 500, 250, 150, 100, 50, 25, 15, 10, 5]
+        for grid_type in ['square', 'triangle', 'hexagon']:
+            nested_indices = GridRegistry().get_nested_indices(grid_type, grid_cell_heights, latitudes, longitudes)
+            self.assertEqual(sorted(grid_cell_heights), sorted(nested_indices))
+            for grid_cell_height in grid_cell_heights:
+                np.testing.assert_array_equal(
+                    GridRegistry(use_kernels=False).get_indices(grid_type, grid_cell_height, latitudes, longitudes),
+                    nested_indices[grid_cell_height])
+
+    def test_travel_time_statistics_match_numpy(self):
+        random_generator = np.random.default_rng(2017)
+        df = pd.DataFrame({'Duration': random_generator.integers(1, 3000, 5000),
+                           'timeBin10': random_generator.integers(0, 3, 5000)})
+        for column in ['PUSGC500IndexX', 'PUSGC500IndexY', 'DOSGC500IndexX', 'DOSGC500IndexY']:
+            df[column] = random_generator.integers(0, 3, 5000)
+        cell_keys = get_cell_keys(df['PUSGC500IndexX'], df['PUSGC500IndexY'], df['DOSGC500IndexX'],
+                                  df['DOSGC500IndexY'])
+        np.testing.assert_array_equal(df['DOSGC500IndexY'], decode_cell_keys(cell_keys)[3])
+
+        # Histograms of two batches are merged like the histogram of a single batch.
+        histograms = pd.concat([get_duration_histograms(df[:2000], ['SGC500'], ['timeBin10']),
+                                get_duration_histograms(df[2000:], ['SGC500'], ['timeBin10'])])
+        statistics = get_travel_time_statistics(histograms).set_index(['cell_key', 'time_bin'])
+        df['cell_key'] = cell_keys
+        for (cell_key, time_bin), durations in df.groupby(['cell_key', 'timeBin10'])['Duration']:
+            row = statistics.loc[(cell_key, time_bin)]
+            self.assertEqual(len(durations), row['count'])
+            self.assertAlmostEqual(durations.mean(), row['mean'])
+            for quantile, column in [(0.1, 'q10'), (0.5, 'median'), (0.9, 'q90')]:
+                duration = np.quantile(durations, quantile, method='lower')
+                if duration < EXACT_DURATION_SECONDS:
+                    self.assertEqual(duration, row[column])
+                else:
+                    self.assertLessEqual(abs(duration - row[column]), DURATION_BUCKET_PRECISION * duration + 1)
+
+        # A cell pair and time bin has at most one row per duration bucket.
+        df[['PUSGC500IndexX', 'PUSGC500IndexY', 'DOSGC500IndexX', 'DOSGC500IndexY', 'timeBin10']] = 0
+        self.assertLess(len(get_duration_histograms(df, ['SGC500'], ['timeBin10'])), 500)
+
+    def test_partials_of_other_configurations_are_not_merged(self):
+        df = pd.DataFrame({'Duration': [600, 600, 30], 'timeBin10': [3, 3, 4], 'timeBinWWDS10': [3, 3, 148]})
+        for grid_name in ['SGC500', 'SGC1000']:
+            for column in ['PU' + grid_name + 'IndexX', 'PU' + grid_name + 'IndexY', 'DO' + grid_name + 'IndexX',
+                           'DO' + grid_name + 'IndexY']:
+                df[column] = [1, 1, 2]
+        histograms = get_duration_histograms(df, ['SGC500', 'SGC1000'], ['timeBin10', 'timeBinWWDS10'])
+        with tempfile.TemporaryDirectory() as directory:
+            for config_hash in ['old', 'new']:
+                os.makedirs(get_partials_directory(directory, config_hash))
+                write_partial(histograms, os.path.join(get_partials_directory(directory, config_hash), 'a_0_0.parquet'))
+            remove_stale_partials(directory, 'new')
+            self.assertEqual(['new'], os.listdir(os.path.join(directory, 'partials')))
+            file_names = build_travel_time_tables(directory, get_partial_file_names(directory, 'new'))
+            self.assertEqual(4, len(file_names))
+            for file_name in file_names:
+                table = pd.read_parquet(file_name)
+                self.assertEqual([2, 1], table['count'].tolist())
+                self.assertEqual([600, 30], table['median'].tolist())
+
 
 class DC2017TripTransformerTest(unittest.TestCase):
 
@@ -42,6 +282,63 @@ class DC2017TripTransformerTest(unittest.TestCase):
             0)
         importer.transform_trips()
 
+    def test_daily_weather_of_evening_trips_is_the_weather_of_the_local_date(self):
+        transformer = DC2017TripTransformer(None, 0)
+        # The first trip starts at 02:30 UTC on the next day.
+        transformer.data_frame = pd.DataFrame({'StartDateTime': pd.DatetimeIndex(
+            ['2017-03-01 21:30', '2017-03-02 08:00'], tz=DC_TIME_ZONE)})
+        weather_hourly_df = pd.DataFrame({'id': [7], 'reported_date_time': pd.to_datetime(['2017-03-02 02:51']),
+                                          'start_date_time': pd.to_datetime(['2017-03-02 02:00']),
+                                          'temperature': [3.0]})
+        weather_daily_df = pd.DataFrame({'id': [10, 11],
+                                         'start_date_time': pd.to_datetime(['2017-03-01', '2017-03-02']),
+                                         'precipitation': [0.1, 0.2]})
+        with patch.object(DC2017TripTransformer, 'weather_hourly_df', new_callable=PropertyMock,
+                          return_value=weather_hourly_df), \
+                patch.object(DC2017TripTransformer, 'weather_daily_df', new_callable=PropertyMock,
+                             return_value=weather_daily_df):
+            transformer.add_weather_features()
+        self.assertEqual([10, 11], transformer.data_frame['weather_daily_id'].tolist())
+        self.assertEqual([0.1, 0.2], transformer.data_frame['weather_daily_precipitation'].tolist())
+        self.assertEqual(7, transformer.data_frame['weather_hourly_id'][0])
+        self.assertTrue(np.isnan(transformer.data_frame['weather_hourly_id'][1]))
+
+    def test_cached_grid_indices_are_not_loaded_for_other_grid_bounds(self):
+        with tempfile.TemporaryDirectory() as directory:
+            transformer = DC2017TripTransformer(None, 0)
+            transformer.feature_cache = FeatureCache(directory, 10 ** 9)
+            transformer.input_fingerprint = ('trips',)
+            transformer.data_frame = pd.DataFrame({'pickup_latitude': [38.9], 'pickup_longitude': [-77.0],
+                                                   'dropoff_latitude': [38.95], 'dropoff_longitude': [-77.05]})
+            transformer.add_grid_indices()
+            grid = ('square', config.dc_grid_cell_heights[0])
+            self.assertTrue(transformer.load_cached_features('grid', *grid,
+                                                             *transformer.get_stage_config_values('grid')))
+            with patch.object(config, 'dc_grid_bl_lat', config.dc_grid_bl_lat - 0.01):
+                self.assertFalse(transformer.load_cached_features('grid', *grid,
+                                                                  *transformer.get_stage_config_values('grid')))
+
+
+    def test_configurations_without_optional_keys_transform_trips(self):
+        optional_keys = ['dc_csv_engine', 'dc_wp_weather_daily_output_file', 'tt_aggregation_directory',
+                         'tt_cache_directory', 'tt_cache_max_size', 'tt_chunk_size', 'tt_export_format',
+                         'tt_grid_memo_quantization_decimals', 'tt_grid_memo_size', 'tt_manifest_file',
+                         'tt_number_of_workers', 'tt_profile_file', 'tt_profiler', 'tt_random_seed',
+                         'tt_reference_data_directory']
+        values = {key: getattr(config, key) for key in optional_keys if hasattr(config, key)}
+        for key in values:
+            delattr(config, key)
+        try:
+            importer = DC2017TripTransformer(config.tt_trips_dc, 0)
+            self.assertIsNone(importer.feature_cache)
+            self.assertIsNone(importer.stage_profiler)
+            importer.transform_trips()
+            importer.transform_trips_in_chunks()
+            get_transformation_config_hash()
+        finally:
+            for key, value in values.items():
+                setattr(config, key, value)
+
 
 class NYC2016TripImporterTest(unittest.TestCase):
 
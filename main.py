@@ -1,33 +1,32 @@
 from data_preparation.DataTransformer import DataTransformer
 from grid_creation.GridCreator import Grid, SquareGrid, TriangleGrid, HexagonGrid
 
-from pyproj import Transformer
+import numpy as np
 import shapely.geometry
 
+from data_preparation.Projection import project, unproject
+
 
 def calculate_sw_corner_of_grid_from_center(lat, lon, grid_size, x_number_of_grids, y_number_of_grids):
-    transformed_center = Transformer.from_crs('epsg:4326', 'epsg:3857').transform(lat, lon)
-    return shapely.geometry.Point(
-        Transformer.from_crs('epsg:3857', 'epsg:4326').transform(
-            transformed_center[0] - grid_size * x_number_of_grids / 2,  # Movement in x direction
-            transformed_center[1] - grid_size * y_number_of_grids / 2))  # Movement in y direction
+    center_x, center_y = project(lat, lon)
+    return shapely.geometry.Point(unproject(
+        center_x - grid_size * x_number_of_grids / 2,  # Movement in x direction
+        center_y - grid_size * y_number_of_grids / 2))  # Movement in y direction
 
 
 def get_corners_of_grid(sw_corner):
-    coordinate_to_sth = Transformer.from_crs('epsg:4326', 'epsg:3857')
-    sth_to_coordinate = Transformer.from_crs('epsg:3857', 'epsg:4326')
-    trans_bl = coordinate_to_sth.transform(sw_corner[0], sw_corner[1])
-    br = sth_to_coordinate.transform(trans_bl[0] + 212 * 150, trans_bl[1])
-    tl = sth_to_coordinate.transform(trans_bl[0], trans_bl[1] + 219 * 150)
-    tr = sth_to_coordinate.transform(trans_bl[0] + 212 * 150, trans_bl[1] + 219 * 150)
+    bl_x, bl_y = project(sw_corner[0], sw_corner[1])
+    # The other three corners are transformed in a single call: bottom right, top left and top right.
+    latitudes, longitudes = unproject(np.array([bl_x + 212 * 150, bl_x, bl_x + 212 * 150]),
+                                      np.array([bl_y, bl_y + 219 * 150, bl_y + 219 * 150]))
+    br, tl, tr = zip(latitudes.tolist(), longitudes.tolist())
     return sw_corner, tl, tr, br
 
 
 def move_sw_corner_of_grid():
     bottom_left_old = calculate_sw_corner_of_grid_from_center(40.7128, -74.0060, 150, 212, 219)
-    transformed_bl_old = Transformer.from_crs('epsg:4326', 'epsg:3857').transform(bottom_left_old.x, bottom_left_old.y)
-    return Transformer.from_crs('epsg:3857', 'epsg:4326').transform(transformed_bl_old[0] + 13140,
-                                                                    transformed_bl_old[1] + 6360)
+    transformed_bl_old = project(bottom_left_old.x, bottom_left_old.y)  # The point holds latitude as x.
+    return unproject(transformed_bl_old[0] + 13140, transformed_bl_old[1] + 6360)
 
 
 def main():